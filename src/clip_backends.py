@@ -0,0 +1,327 @@
+"""
+Embedding backends for the CLIP server.
+A backend owns everything model-specific: turning a decoded image into model inputs, batched forward
+passes for images and texts, and the embedding size. The server's batching, caching and HTTP layers
+only talk to this interface, so they can be exercised with the deterministic synthetic backend,
+which needs no model download, no torch and no accelerator.
+"""
+
+import hashlib
+import io
+import math
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+import numpy as np
+from PIL import Image
+
+CLIP_BACKENDS = ("eager", "torchscript", "onnx")
+BACKENDS = (*CLIP_BACKENDS, "synthetic")
+
+
+class ImagePreprocessor(ABC):
+    """Turns a decoded RGB image into the backend's input array. Must be picklable for process pools."""
+
+    # Decode JPEGs at a reduced DCT scale (PIL draft mode) when the input is larger than the model needs
+    reduced_decode: bool = False
+
+    @abstractmethod
+    def __call__(self, image: Image.Image) -> np.ndarray: ...
+
+    def decode_size(self, size: tuple[int, int]) -> tuple[int, int] | None:
+        """Smallest (width, height) an image of `size` can be decoded at without losing output detail."""
+        return None
+
+    def load(self, image_bytes: bytes) -> Image.Image:
+        """Decode raw image bytes into an RGB PIL image, at reduced scale if `reduced_decode` is set."""
+        # BytesIO over an immutable bytes object shares its buffer instead of copying it
+        image = Image.open(io.BytesIO(image_bytes))
+        if self.reduced_decode:
+            size = self.decode_size(image.size)
+            if size is not None:
+                # Only JPEG supports this: it picks the smallest 1/2, 1/4 or 1/8 scale at least `size` large
+                image.draft("RGB", size)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.load()
+        return image
+
+
+@dataclass
+class TokenizedTexts:
+    """A batch of texts with their token counts, and their token ids when the backend embeds from those.
+
+    Indexing with a slice or an array of rows gives the matching sub-batch, so texts tokenized once can
+    be split into length buckets (and bisected on failure) without being tokenized again.
+    """
+
+    texts: list[str]
+    lengths: np.ndarray
+    # Unpadded ids of each text, special tokens included and truncated like the forward pass
+    token_ids: list[np.ndarray] | None = None
+    pad_token_id: int = 0
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __getitem__(self, rows: slice | np.ndarray) -> "TokenizedTexts":
+        if isinstance(rows, slice):
+            texts, token_ids = self.texts[rows], self.token_ids[rows] if self.token_ids is not None else None
+        else:
+            texts = [self.texts[row] for row in rows]
+            token_ids = [self.token_ids[row] for row in rows] if self.token_ids is not None else None
+        return TokenizedTexts(texts, self.lengths[rows], token_ids, self.pad_token_id)
+
+    def padded(self) -> tuple[np.ndarray, np.ndarray]:
+        """(input_ids, attention_mask) int64 arrays, right-padded to the longest text like a padding tokenizer."""
+        input_ids = np.full((len(self), int(self.lengths.max())), self.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros_like(input_ids)
+        for row, ids in enumerate(self.token_ids):
+            input_ids[row, : len(ids)] = ids
+            attention_mask[row, : len(ids)] = 1
+        return input_ids, attention_mask
+
+
+class TextTokenCounter(ABC):
+    """Counts the positions each text occupies in the text tower, special tokens included."""
+
+    @abstractmethod
+    def __call__(self, texts: list[str]) -> np.ndarray: ...
+
+    def tokenize(self, texts: list[str]) -> TokenizedTexts:
+        """The texts with their token counts, plus token ids if the matching backend embeds from them."""
+        return TokenizedTexts(list(texts), self(texts))
+
+
+class EmbeddingBackend(ABC):
+    """Batched forward passes returning L2-normalized float32 embeddings, one row per input."""
+
+    embedding_dim: int
+    # Drift report of a quantized model, None otherwise
+    quantization_report: dict | None = None
+    # Multiplier CLIP applies to image-text cosine similarities before a softmax over texts
+    logit_scale: float = 100.0
+
+    @property
+    @abstractmethod
+    def cache_namespace(self) -> str:
+        """Identifies the embedding space in cache keys; backends producing different vectors must differ."""
+
+    @abstractmethod
+    def embed_images(self, pixel_values: np.ndarray) -> np.ndarray:
+        """Embed a batch of preprocessed images stacked along the first axis."""
+
+    @abstractmethod
+    def embed_texts(self, texts: list[str]) -> np.ndarray:
+        """Embed a batch of raw texts."""
+
+    def embed_tokens(self, tokens: TokenizedTexts) -> np.ndarray:
+        """Embed texts tokenized by the matching token counter; backends that can skip re-tokenizing override this."""
+        return self.embed_texts(tokens.texts)
+
+
+class CLIPImagePreprocessor(ImagePreprocessor):
+    """CLIPProcessor resize, crop and normalization. Pickles as the model name; workers reload the processor.
+
+    With `reduced_decode`, JPEGs are decoded at the smallest DCT scale that keeps the shortest edge at
+    least the processor's resize target, and the processor's resize, center crop and normalization are
+    applied directly with PIL and numpy.
+    """
+
+    def __init__(self, model_name: str, reduced_decode: bool = False):
+        self.model_name = model_name
+        self.reduced_decode = reduced_decode
+        self._load()
+
+    def _load(self):
+        from transformers import CLIPProcessor
+
+        self.processor = CLIPProcessor.from_pretrained(self.model_name)
+        image_processor = self.processor.image_processor
+        self.shortest_edge = image_processor.size["shortest_edge"]
+        self.crop_size = (image_processor.crop_size["width"], image_processor.crop_size["height"])
+        self.resample = image_processor.resample
+        self.rescale_factor = np.float32(image_processor.rescale_factor)
+        self.mean = np.asarray(image_processor.image_mean, dtype=np.float32)
+        self.std = np.asarray(image_processor.image_std, dtype=np.float32)
+
+    def __getstate__(self):
+        return {"model_name": self.model_name, "reduced_decode": self.reduced_decode}
+
+    def __setstate__(self, state):
+        self.model_name = state["model_name"]
+        self.reduced_decode = state["reduced_decode"]
+        self._load()
+
+    def decode_size(self, size: tuple[int, int]) -> tuple[int, int] | None:
+        width, height = size
+        scale = self.shortest_edge / min(width, height)
+        if scale >= 1:
+            return None
+        return math.ceil(width * scale), math.ceil(height * scale)
+
+    def _resize_and_crop(self, image: Image.Image) -> np.ndarray:
+        """CLIPImageProcessor's semantics: shortest edge to the target, center crop, rescale, normalize."""
+        width, height = image.size
+        if width <= height:
+            size = (self.shortest_edge, int(self.shortest_edge * height / width))
+        else:
+            size = (int(self.shortest_edge * width / height), self.shortest_edge)
+        image = image.resize(size, resample=self.resample)
+        crop_width, crop_height = self.crop_size
+        left, top = (size[0] - crop_width) // 2, (size[1] - crop_height) // 2
+        image = image.crop((left, top, left + crop_width, top + crop_height))
+        pixels = np.asarray(image, dtype=np.float32) * self.rescale_factor
+        return ((pixels - self.mean) / self.std).transpose(2, 0, 1)
+
+    def __call__(self, image: Image.Image) -> np.ndarray:
+        if self.reduced_decode:
+            return self._resize_and_crop(image)
+        return self.processor(images=image, return_tensors="np")["pixel_values"][0]
+
+
+class CLIPTokenCounter(TextTokenCounter):
+    """Token counts from the model's tokenizer, truncated to its context length like the forward pass."""
+
+    def __init__(self, model_name: str):
+        from transformers import CLIPTokenizerFast
+
+        self.tokenizer = CLIPTokenizerFast.from_pretrained(model_name)
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        encoded = self.tokenizer(texts, truncation=True, return_length=True, return_attention_mask=False)
+        return np.asarray(encoded["length"], dtype=np.int64)
+
+    def tokenize(self, texts: list[str]) -> TokenizedTexts:
+        encoded = self.tokenizer(texts, truncation=True, return_length=True, return_attention_mask=False)
+        token_ids = [np.asarray(ids, dtype=np.int64) for ids in encoded["input_ids"]]
+        lengths = np.asarray(encoded["length"], dtype=np.int64)
+        return TokenizedTexts(list(texts), lengths, token_ids, self.tokenizer.pad_token_id)
+
+
+class SyntheticImagePreprocessor(ImagePreprocessor):
+    """Bilinear resize to a small square, scaled to [0, 1], channels first."""
+
+    def __init__(self, image_size: int = 32, reduced_decode: bool = False):
+        self.image_size = image_size
+        self.reduced_decode = reduced_decode
+
+    def decode_size(self, size: tuple[int, int]) -> tuple[int, int] | None:
+        return (self.image_size, self.image_size)
+
+    def __call__(self, image: Image.Image) -> np.ndarray:
+        image = image.resize((self.image_size, self.image_size), Image.BILINEAR)
+        return (np.asarray(image, dtype=np.float32) / 255.0).transpose(2, 0, 1)
+
+
+class SyntheticTokenCounter(TextTokenCounter):
+    """Whitespace words plus start and end tokens, capped at CLIP's context length."""
+
+    CONTEXT_LENGTH = 77
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        return np.minimum([len(text.split()) + 2 for text in texts], self.CONTEXT_LENGTH)
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+class SyntheticBackend(EmbeddingBackend):
+    """Deterministic stand-in for a CLIP model, for load tests and CI.
+
+    Texts are hashed into a bag of word and character-trigram features and images are reduced to
+    small thumbnails; both are mapped to the embedding space by fixed random projections. Equal inputs
+    always get equal embeddings (in every process, for a given seed), and similar inputs get similar
+    ones. Each batch sleeps `latency_ms + per_item_latency_ms * batch_size` to mimic a forward pass.
+    """
+
+    HASH_FEATURES = 4096
+
+    def __init__(
+        self,
+        dim: int = 512,
+        latency_ms: float = 0.0,
+        per_item_latency_ms: float = 0.0,
+        image_size: int = 32,
+        seed: int = 0,
+    ):
+        self.embedding_dim = dim
+        self.latency_s = latency_ms / 1000.0
+        self.per_item_latency_s = per_item_latency_ms / 1000.0
+        self.image_size = image_size
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self._text_projection = rng.standard_normal((self.HASH_FEATURES, dim), dtype=np.float32)
+        self._image_projection = rng.standard_normal((3 * image_size * image_size, dim), dtype=np.float32)
+
+    @property
+    def cache_namespace(self) -> str:
+        return f"synthetic-{self.embedding_dim}-{self.image_size}-{self.seed}"
+
+    def _simulate_forward(self, batch_size: int):
+        delay = self.latency_s + self.per_item_latency_s * batch_size
+        if delay > 0:
+            time.sleep(delay)
+
+    def _text_features(self, text: str) -> np.ndarray:
+        features = np.zeros(self.HASH_FEATURES, dtype=np.float32)
+        text = text.lower()
+        tokens = text.split() + [text[i : i + 3] for i in range(max(len(text) - 2, 0))]
+        for token in tokens:
+            digest = int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "little")
+            features[digest % self.HASH_FEATURES] += 1.0 if digest >> 63 else -1.0
+        return features
+
+    def embed_images(self, pixel_values: np.ndarray) -> np.ndarray:
+        self._simulate_forward(len(pixel_values))
+        flat = pixel_values.reshape(len(pixel_values), -1).astype(np.float32) - 0.5
+        return _normalize(flat @ self._image_projection)
+
+    def embed_texts(self, texts: list[str]) -> np.ndarray:
+        self._simulate_forward(len(texts))
+        features = np.stack([self._text_features(text) for text in texts])
+        return _normalize(features @ self._text_projection)
+
+
+def create_backend(
+    name: str,
+    model_name: str,
+    device=None,
+    quantize: str | None = None,
+    export_dir: str = "data/clip_exports",
+    **options,
+) -> EmbeddingBackend:
+    """Build a backend by name: a CLIP model run by one of the CLIP_BACKENDS runtimes, or `synthetic`.
+
+    `options` are passed to the synthetic backend (dim, latency_ms, per_item_latency_ms, image_size, seed).
+    """
+    if name == "synthetic":
+        if quantize is not None:
+            raise ValueError("The synthetic backend cannot be quantized")
+        return SyntheticBackend(**options)
+    if name in CLIP_BACKENDS:
+        from src.clip_model import CLIPModelRunner
+
+        return CLIPModelRunner(model_name, device=device, quantize=quantize, runtime=name, export_dir=export_dir)
+    raise ValueError(f"Unknown backend {name!r}, expected one of {BACKENDS}")
+
+
+def create_image_preprocessor(name: str, model_name: str, reduced_decode: bool = False, **options) -> ImagePreprocessor:
+    """The image preprocessor matching `create_backend(name, model_name, **options)`, without loading a model."""
+    if name == "synthetic":
+        return SyntheticImagePreprocessor(options.get("image_size", 32), reduced_decode=reduced_decode)
+    if name in CLIP_BACKENDS:
+        return CLIPImagePreprocessor(model_name, reduced_decode=reduced_decode)
+    raise ValueError(f"Unknown backend {name!r}, expected one of {BACKENDS}")
+
+
+def create_token_counter(name: str, model_name: str) -> TextTokenCounter:
+    """The text token counter matching `create_backend(name, model_name)`, without loading a model."""
+    if name == "synthetic":
+        return SyntheticTokenCounter()
+    if name in CLIP_BACKENDS:
+        return CLIPTokenCounter(model_name)
+    raise ValueError(f"Unknown backend {name!r}, expected one of {BACKENDS}")
@@ -0,0 +1,163 @@
+"""
+Adaptive batching for the CLIP server.
+Tunes the target batch size and the batch collection window from live measurements of the input
+arrival rate, the queued inputs and the forward pass time, so that batches are as large as possible
+while the observed p99 latency stays under a target.
+"""
+
+import time
+from collections import deque
+
+import numpy as np
+
+
+class AdaptiveBatchController:
+    """Chooses the target batch size and collection window for each batch.
+
+    Batch sizes, arrivals and queue depths all count inputs, not requests: a bulk request brings many.
+
+    Forward time is modelled as `fixed + per_item * batch_size`, fitted by least squares over recent
+    batches. For every batch the controller picks the largest size whose expected latency (time to
+    wait for enough arrivals plus the forward pass) fits the latency budget, but never one too small
+    to keep up with the arrival rate. The budget starts at the p99 target and is scaled down while the
+    measured p99 exceeds it, and back up once there is headroom again.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int,
+        max_timeout_ms: float,
+        latency_target_ms: float,
+        history: int = 1000,
+        adjust_interval_s: float = 0.5,
+    ):
+        self.max_batch_size = max_batch_size
+        self.max_timeout_s = max_timeout_ms / 1000.0
+        self.latency_target_s = latency_target_ms / 1000.0
+        self.adjust_interval_s = adjust_interval_s
+
+        self._mean_interval: float | None = None  # seconds between arriving inputs, exponentially weighted
+        self._last_arrival: float | None = None
+        self._batches: deque[tuple[int, float]] = deque(maxlen=256)
+        self._latencies: deque[float] = deque(maxlen=history)
+        self.budget_scale = 1.0
+        self._last_adjust = time.monotonic()
+
+        self.decisions: deque[dict] = deque(maxlen=100)
+        self.current: dict | None = None
+
+    def record_arrival(self, count: int = 1, now: float | None = None):
+        """Update the arrival rate estimate with a request of `count` inputs."""
+        now = time.monotonic() if now is None else now
+        if self._last_arrival is not None:
+            interval = (now - self._last_arrival) / count
+            if self._mean_interval is None:
+                self._mean_interval = interval
+            else:
+                # Weighted by the inputs, so one bulk request counts as much as that many single ones
+                decay = 0.95**count
+                self._mean_interval = decay * self._mean_interval + (1.0 - decay) * interval
+        self._last_arrival = now
+
+    @property
+    def arrival_rate(self) -> float:
+        """Inputs per second."""
+        if not self._mean_interval:
+            return 0.0
+        return 1.0 / self._mean_interval
+
+    def record_batch(self, batch_size: int, forward_seconds: float):
+        self._batches.append((batch_size, forward_seconds))
+
+    def record_latency(self, seconds: float):
+        self._latencies.append(seconds)
+
+    def p99_latency(self) -> float | None:
+        if not self._latencies:
+            return None
+        return float(np.percentile(np.fromiter(self._latencies, dtype=np.float64), 99))
+
+    def forward_model(self) -> tuple[float, float]:
+        """Return (fixed seconds, seconds per item) of the forward pass, fitted on recent batches."""
+        if not self._batches:
+            return 0.0, 0.0
+        sizes = np.array([size for size, _ in self._batches], dtype=np.float64)
+        seconds = np.array([secs for _, secs in self._batches], dtype=np.float64)
+        if np.ptp(sizes) == 0:
+            # All batches had the same size, so the split between fixed and per-item cost is unknown
+            return 0.0, float(seconds.mean() / sizes[0])
+        per_item, fixed = np.polyfit(sizes, seconds, 1)
+        return max(float(fixed), 0.0), max(float(per_item), 0.0)
+
+    def _adjust_budget(self, now: float):
+        if now - self._last_adjust < self.adjust_interval_s:
+            return
+        self._last_adjust = now
+        p99 = self.p99_latency()
+        if p99 is None:
+            return
+        if p99 > self.latency_target_s:
+            self.budget_scale = max(0.1, self.budget_scale * 0.8)
+        elif p99 < 0.7 * self.latency_target_s:
+            self.budget_scale = min(1.0, self.budget_scale * 1.05)
+
+    def decide(self, queue_depth: int, started: int = 1) -> tuple[int, float]:
+        """Return the target batch size and the collection timeout in seconds for the next batch.
+
+        `queue_depth` is the number of inputs waiting, and `started` the inputs of the request that
+        started this batch.
+        """
+        now = time.monotonic()
+        self._adjust_budget(now)
+        fixed, per_item = self.forward_model()
+        budget = self.latency_target_s * self.budget_scale
+
+        def wait_for_size(size: int) -> float:
+            # Inputs already queued (plus those that started this batch) need no waiting
+            missing = size - started - queue_depth
+            if missing <= 0:
+                return 0.0
+            return missing / self.arrival_rate if self.arrival_rate > 0 else float("inf")
+
+        # Largest batch whose fill time and forward pass fit the budget
+        batch_size = 1
+        for size in range(1, self.max_batch_size + 1):
+            wait = wait_for_size(size)
+            if wait <= self.max_timeout_s and wait + fixed + per_item * size <= budget:
+                batch_size = size
+
+        # Smallest batch that still keeps up with the arrival rate takes precedence under load
+        for size in range(batch_size, self.max_batch_size + 1):
+            forward = fixed + per_item * size
+            if forward <= 0 or size / forward >= self.arrival_rate:
+                batch_size = size
+                break
+        else:
+            batch_size = self.max_batch_size
+
+        timeout = min(wait_for_size(batch_size), self.max_timeout_s)
+        p99 = self.p99_latency()
+        self.current = {
+            "time": time.time(),
+            "queue_depth": queue_depth,
+            "arrival_rate": self.arrival_rate,
+            "forward_fixed_ms": fixed * 1000,
+            "forward_per_item_ms": per_item * 1000,
+            "p99_latency_ms": p99 * 1000 if p99 is not None else None,
+            "budget_ms": budget * 1000,
+            "batch_size": batch_size,
+            "timeout_ms": timeout * 1000,
+        }
+        self.decisions.append(self.current)
+        return batch_size, timeout
+
+    def stats(self) -> dict:
+        """Current settings and recent decisions, for auditing."""
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_timeout_ms": self.max_timeout_s * 1000,
+            "latency_target_ms": self.latency_target_s * 1000,
+            "budget_scale": self.budget_scale,
+            "current": self.current,
+            "recent_decisions": list(self.decisions),
+        }
@@ -0,0 +1,313 @@
+"""
+Closed-loop load generator and benchmark for the CLIP embedding server.
+A fixed number of concurrent clients each send a request, wait for the response and immediately
+send the next one, drawing request types from a configurable mix. The server is either started
+in-process (no network; use a local model path or `--backend synthetic`) or reached at `--url`.
+Throughput, latency percentiles and the batch sizes the server actually formed (read from
+`/metrics`) are printed as JSON so runs with different settings can be compared.
+
+Example:
+    uv run -m src.clip_benchmark --model /path/to/clip --max-batch-size 16 --batch-timeout-ms 5 \\
+        --concurrency 32 --mix text=3,image=1,bulk_text=1 --duration-s 20
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import logging
+import re
+import time
+from collections import defaultdict
+from itertools import count
+
+import httpx
+import numpy as np
+from PIL import Image
+
+LOGGER = logging.getLogger(__name__)
+
+REQUEST_TYPES = ("text", "image", "bulk_text", "bulk_image")
+
+_SAMPLE_LINE = re.compile(r'^clip_batch_size_(bucket|sum|count)\{type="(\w+)"(?:,le="([^"]+)")?\} (\S+)$')
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """Parse a request mix such as `text=3,image=1` into normalized weights."""
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in REQUEST_TYPES:
+            raise ValueError(f"Unknown request type {name!r} in mix, expected one of {REQUEST_TYPES}")
+        weights[name] = float(weight or 1)
+    total = sum(weights.values())
+    return {name: weight / total for name, weight in weights.items()}
+
+
+def make_images(count: int, width: int, height: int, seed: int = 0) -> list[bytes]:
+    """Random-noise JPEGs; noise defeats JPEG compression, so payloads are close to worst case."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+class PayloadFactory:
+    """Builds request payloads that are unique per request, so no request is answered from a cache."""
+
+    def __init__(self, images: list[bytes], text_words: tuple[int, int], bulk_size: int):
+        self.images = images
+        self.min_words, self.max_words = text_words
+        self.bulk_size = bulk_size
+        self._ids = count()
+
+    def text(self) -> str:
+        n = next(self._ids)
+        # Lengths cycle through the range, so text batches mix short and long captions
+        words = self.min_words + (n * 7919) % (self.max_words - self.min_words + 1)
+        return " ".join(f"word{(n + i) % 997}" for i in range(words - 1)) + f" request{n}"
+
+    def image(self) -> bytes:
+        n = next(self._ids)
+        # Decoders stop at the JPEG end marker, so the suffix only changes the content hash
+        return self.images[n % len(self.images)] + n.to_bytes(8, "little")
+
+    def request(self, request_type: str) -> dict:
+        """Keyword arguments for `httpx.AsyncClient.post`."""
+        if request_type == "text":
+            return {"url": "/embed_text", "json": {"text": self.text()}}
+        if request_type == "image":
+            return {
+                "url": "/embed_image",
+                "content": self.image(),
+                "headers": {"content-type": "application/octet-stream"},
+            }
+        if request_type == "bulk_text":
+            return {"url": "/embed_texts_batch", "json": {"texts": [self.text() for _ in range(self.bulk_size)]}}
+        files = [("images", (f"{i}.jpg", self.image(), "image/jpeg")) for i in range(self.bulk_size)]
+        return {"url": "/embed_images_batch", "files": files}
+
+
+def parse_batch_histogram(metrics_text: str) -> dict[str, dict]:
+    """Extract the `clip_batch_size` histogram from a /metrics scrape, per input type."""
+    histograms: dict[str, dict] = defaultdict(lambda: {"buckets": {}, "sum": 0.0, "count": 0})
+    for line in metrics_text.splitlines():
+        match = _SAMPLE_LINE.match(line)
+        if match is None:
+            continue
+        kind, request_type, bound, value = match.groups()
+        if kind == "bucket":
+            histograms[request_type]["buckets"][bound] = float(value)
+        else:
+            histograms[request_type][kind] = float(value)
+    return dict(histograms)
+
+
+def batch_size_distribution(before: dict[str, dict], after: dict[str, dict]) -> dict[str, dict]:
+    """Batches formed between two scrapes: count, mean size and the number of batches per size bucket."""
+    distribution = {}
+    for request_type, end in after.items():
+        start = before.get(request_type, {"buckets": {}, "sum": 0.0, "count": 0})
+        batches = end["count"] - start["count"]
+        if batches <= 0:
+            continue
+        buckets, previous = {}, 0.0
+        for bound, cumulative in end["buckets"].items():
+            cumulative -= start["buckets"].get(bound, 0.0)
+            label = "+Inf" if bound == "+Inf" else f"<={float(bound):g}"
+            buckets[label] = int(cumulative - previous)
+            previous = cumulative
+        distribution[request_type] = {
+            "batches": int(batches),
+            "mean_size": (end["sum"] - start["sum"]) / batches,
+            "batches_by_size": buckets,
+        }
+    return distribution
+
+
+def _latency_summary(latencies: list[float]) -> dict:
+    if not latencies:
+        return {}
+    values = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": p50, "p95": p95, "p99": p99, "mean": values.mean(), "max": values.max()}
+
+
+async def run_load(
+    client: httpx.AsyncClient,
+    payloads: PayloadFactory,
+    mix: dict[str, float],
+    concurrency: int,
+    duration_s: float,
+    seed: int = 0,
+) -> dict:
+    """Drive the server with `concurrency` closed-loop clients for `duration_s` seconds."""
+    rng = np.random.default_rng(seed)
+    names, weights = list(mix), list(mix.values())
+    latencies: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    items: dict[str, int] = defaultdict(int)
+    deadline = time.perf_counter() + duration_s
+
+    async def client_loop():
+        while time.perf_counter() < deadline:
+            request_type = names[rng.choice(len(names), p=weights)]
+            kwargs = payloads.request(request_type)
+            start = time.perf_counter()
+            try:
+                response = await client.post(**kwargs)
+                ok = response.status_code == 200
+            except httpx.HTTPError as e:
+                LOGGER.warning(f"{request_type} request failed: {e}")
+                ok = False
+            if ok:
+                latencies[request_type].append(time.perf_counter() - start)
+                items[request_type] += payloads.bulk_size if request_type.startswith("bulk") else 1
+            else:
+                errors[request_type] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        "duration_s": elapsed,
+        "requests": completed,
+        "errors": sum(errors.values()),
+        "rps": completed / elapsed,
+        "items_per_second": sum(items.values()) / elapsed,
+        "latency_ms": _latency_summary([value for values in latencies.values() for value in values]),
+        "by_type": {
+            request_type: {
+                "requests": len(latencies[request_type]),
+                "errors": errors[request_type],
+                "rps": len(latencies[request_type]) / elapsed,
+                "latency_ms": _latency_summary(latencies[request_type]),
+            }
+            for request_type in mix
+        },
+    }
+
+
+async def benchmark(client: httpx.AsyncClient, args: argparse.Namespace) -> dict:
+    """Warm up, then measure one run and attach the batch sizes the server formed during it."""
+    mix = parse_mix(args.mix)
+    width, height = (int(side) for side in args.image_size.lower().split("x"))
+    min_words, _, max_words = args.text_words.partition("-")
+    text_words = (int(min_words), int(max_words or min_words))
+    payloads = PayloadFactory(make_images(args.image_pool, width, height, args.seed), text_words, args.bulk_size)
+
+    if args.warmup_s > 0:
+        await run_load(client, payloads, mix, args.concurrency, args.warmup_s, args.seed + 1)
+    before = parse_batch_histogram((await client.get("/metrics")).text)
+    report = await run_load(client, payloads, mix, args.concurrency, args.duration_s, args.seed)
+    after = parse_batch_histogram((await client.get("/metrics")).text)
+    report["batch_size"] = batch_size_distribution(before, after)
+    report["config"] = vars(args)
+    return report
+
+
+async def run_in_process(args: argparse.Namespace) -> dict:
+    """Start the server app in this process and benchmark it without any network."""
+    import src.clip_server as clip_server_module
+
+    clip_server_module.server_config.update(
+        model_name=args.model,
+        max_batch_size=args.max_batch_size,
+        batch_timeout_ms=args.batch_timeout_ms,
+        pipeline_depth=args.pipeline_depth,
+        preprocess_workers=args.preprocess_workers,
+        adaptive_batching=args.adaptive_batching,
+        latency_target_ms=args.latency_target_ms,
+        replicas=args.replicas,
+        backend=args.backend,
+        quantize=args.quantize,
+        reduced_image_decode=args.reduced_image_decode,
+        text_length_buckets=tuple(int(bound) for bound in args.text_length_buckets.split(",") if bound),
+        backend_options=(
+            {
+                "dim": args.synthetic_dim,
+                "latency_ms": args.synthetic_latency_ms,
+                "per_item_latency_ms": args.synthetic_per_item_ms,
+            }
+            if args.backend == "synthetic"
+            else None
+        ),
+    )
+    await clip_server_module.startup_event()
+    try:
+        transport = httpx.ASGITransport(app=clip_server_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            return await benchmark(client, args)
+    finally:
+        await clip_server_module.shutdown_event()
+
+
+async def run_remote(args: argparse.Namespace) -> dict:
+    """Benchmark a server that is already running at `args.url`."""
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=None, limits=limits) as client:
+        return await benchmark(client, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Closed-loop benchmark for the CLIP embedding server")
+    parser.add_argument("--url", type=str, default=None, help="Benchmark a running server, e.g. http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent closed-loop clients (default: 16)")
+    parser.add_argument("--duration-s", type=float, default=10.0, help="Measured duration in seconds (default: 10)")
+    parser.add_argument("--warmup-s", type=float, default=2.0, help="Unmeasured warm-up in seconds (default: 2)")
+    parser.add_argument(
+        "--mix",
+        type=str,
+        default="text=1,image=1",
+        help=f"Weighted request mix over {', '.join(REQUEST_TYPES)} (default: text=1,image=1)",
+    )
+    parser.add_argument("--image-size", type=str, default="640x480", help="JPEG payload size (default: 640x480)")
+    parser.add_argument("--image-pool", type=int, default=32, help="Distinct images to generate (default: 32)")
+    parser.add_argument(
+        "--text-words", type=str, default="12", help="Words per text payload, or a MIN-MAX range (default: 12)"
+    )
+    parser.add_argument("--bulk-size", type=int, default=32, help="Inputs per bulk request (default: 32)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for payloads and the request mix")
+    parser.add_argument("--output", type=str, default=None, help="Also write the JSON report to this file")
+
+    # Settings of the in-process server, ignored with --url
+    parser.add_argument("--model", type=str, default="laion/CLIP-ViT-B-32-laion2B-s34B-b79K", help="Model name or path")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum batch size (default: 8)")
+    parser.add_argument("--batch-timeout-ms", type=int, default=2, help="Batch timeout in milliseconds (default: 2)")
+    parser.add_argument("--pipeline-depth", type=int, default=2, help="Max batches in flight (default: 2)")
+    parser.add_argument("--preprocess-workers", type=int, default=4, help="Image preprocessing workers (default: 4)")
+    parser.add_argument("--adaptive-batching", action="store_true", help="Use the adaptive batch controller")
+    parser.add_argument("--latency-target-ms", type=float, default=50.0, help="p99 target for adaptive batching")
+    parser.add_argument("--replicas", type=int, default=0, help="Model replica processes (default: 0, in-process)")
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="eager",
+        choices=["eager", "torchscript", "onnx", "synthetic"],
+        help="Inference backend; `synthetic` needs no model and runs offline",
+    )
+    parser.add_argument("--synthetic-dim", type=int, default=512, help="Synthetic backend embedding size")
+    parser.add_argument("--synthetic-latency-ms", type=float, default=0.0, help="Synthetic backend sleep per batch")
+    parser.add_argument("--synthetic-per-item-ms", type=float, default=0.0, help="Synthetic backend sleep per input")
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8"], help="Quantize the model (CPU only)")
+    parser.add_argument("--reduced-image-decode", action="store_true", help="Decode JPEGs at reduced scale")
+    parser.add_argument(
+        "--text-length-buckets", type=str, default="16,32", help="Token bounds of text forward passes ('' for one)"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    report = asyncio.run(run_remote(args) if args.url else run_in_process(args))
+    output = json.dumps(report, indent=2, default=float)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
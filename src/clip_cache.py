@@ -0,0 +1,281 @@
+"""
+Embedding caches for the CLIP server.
+Entries are content-addressed: the key hashes the model name, the input kind ('image' or 'text')
+and the raw input bytes, so identical inputs hit the cache regardless of which client sent them.
+There is a bounded in-memory LRU cache and an optional persistent, memory-mapped on-disk cache.
+"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+KEY_SIZE = 16
+
+
+def embedding_cache_key(model_name: str, kind: str, payload: bytes) -> bytes:
+    """Content hash identifying one input for one model."""
+    hasher = hashlib.blake2b(digest_size=KEY_SIZE)
+    hasher.update(model_name.encode())
+    hasher.update(b"\0")
+    hasher.update(kind.encode())
+    hasher.update(b"\0")
+    hasher.update(payload)
+    return hasher.digest()
+
+
+class EmbeddingLRUCache:
+    """Bounded in-memory LRU cache of embedding vectors, limited by entry count and total bytes."""
+
+    def __init__(self, max_entries: int = 100_000, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: bytes) -> np.ndarray | None:
+        """Return the cached embedding for `key` and mark it most recently used, or None."""
+        embedding = self._entries.get(key)
+        if embedding is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return embedding
+
+    def put(self, key: bytes, embedding: np.ndarray):
+        """Insert an embedding, evicting least recently used entries to stay within bounds."""
+        # Copy so the entry does not keep the whole batch array alive, and freeze it since it is shared
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.flags.writeable = False
+        if embedding.nbytes > self.max_bytes or self.max_entries <= 0:
+            return
+
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= previous.nbytes
+        self._entries[key] = embedding
+        self._bytes += embedding.nbytes
+
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        """Counters and occupancy for the stats endpoint."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class DiskEmbeddingCache:
+    """Persistent embedding cache shared by all server processes on a host.
+
+    Vectors live in a float32 matrix file that is memory-mapped, so lookups only page in the rows
+    they touch. A SQLite database maps keys to rows. Rows are appended until `max_rows` is reached;
+    after that the least recently used row is recycled. A parallel key file records which key each
+    row holds: readers check it before and after copying a vector, so a row that another process is
+    rewriting reads as a miss instead of a torn vector.
+
+    Lookups and stores take whole batches, one query and one transaction each. When another process
+    holds the index for longer than `busy_timeout` seconds, the lookup reads as misses and the store is
+    dropped, so a busy cache costs at most a recomputation.
+    """
+
+    # Recency updates are buffered and written to the index in batches rather than on every hit
+    TOUCH_FLUSH_SIZE = 1024
+    # Keys per lookup query, well below SQLite's limit on bound parameters
+    LOOKUP_BATCH_SIZE = 512
+
+    def __init__(self, path: str | Path, dim: int, max_rows: int = 1_000_000, busy_timeout: float = 0.5):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._touched: dict[bytes, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.busy = 0
+
+        self._db = sqlite3.connect(
+            self.path / "index.sqlite", timeout=30.0, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, row INTEGER NOT NULL UNIQUE, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._db.execute("BEGIN IMMEDIATE")
+        for name, value in (("dim", dim), ("max_rows", max_rows), ("next_row", 0)):
+            self._db.execute("INSERT OR IGNORE INTO meta (name, value) VALUES (?, ?)", (name, value))
+        self._db.execute("COMMIT")
+
+        stored_dim, self.max_rows = self._meta("dim"), self._meta("max_rows")
+        if stored_dim != dim:
+            raise ValueError(f"Disk cache at {self.path} holds {stored_dim}-d embeddings, expected {dim}-d")
+        if self.max_rows != max_rows:
+            LOGGER.warning(f"Disk cache at {self.path} was created with max_rows={self.max_rows}, ignoring {max_rows}")
+        self.dim = dim
+        # Rows are only ever freed to be reused at once, so the rows handed out are the entries. Tracked
+        # here so stats() needs neither the lock nor the index; other processes' stores show up once
+        # this one stores again.
+        self._entries = self._meta("next_row")
+
+        # Both files are sized up front; untouched regions stay sparse on disk
+        matrix_path, keys_path = self.path / "embeddings.f32", self.path / "keys.bin"
+        for file_path, row_bytes in ((matrix_path, dim * 4), (keys_path, KEY_SIZE)):
+            with open(file_path, "ab") as f:
+                if f.tell() < self.max_rows * row_bytes:
+                    f.truncate(self.max_rows * row_bytes)
+        self._matrix = np.memmap(matrix_path, dtype=np.float32, mode="r+", shape=(self.max_rows, dim))
+        self._keys = np.memmap(keys_path, dtype=np.uint8, mode="r+", shape=(self.max_rows, KEY_SIZE))
+        # Setup may wait for other processes; lookups and stores give up quickly instead
+        self._db.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+
+    def _meta(self, name: str) -> int:
+        return self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()[0]
+
+    def _row_holds(self, row: int, key: bytes) -> bool:
+        return self._keys[row].tobytes() == key
+
+    def get(self, key: bytes) -> np.ndarray | None:
+        """Return a copy of the cached embedding for `key`, or None."""
+        return self.get_many([key])[0]
+
+    def put(self, key: bytes, embedding: np.ndarray):
+        """Store an embedding, recycling the least recently used row once the file is full."""
+        self.put_many([key], [embedding])
+
+    def get_many(self, keys: list[bytes]) -> list[np.ndarray | None]:
+        """Return copies of the cached embeddings for `keys`, with None for each miss."""
+        with self._lock:
+            rows: dict[bytes, int] = {}
+            try:
+                for start in range(0, len(keys), self.LOOKUP_BATCH_SIZE):
+                    batch = keys[start : start + self.LOOKUP_BATCH_SIZE]
+                    query = f"SELECT key, row FROM entries WHERE key IN ({', '.join('?' * len(batch))})"
+                    rows.update(self._db.execute(query, batch).fetchall())
+            except sqlite3.OperationalError as e:
+                LOGGER.warning(f"Disk cache index is busy, treating {len(keys)} lookups as misses: {e}")
+                self.busy += 1
+                rows = {}
+
+            embeddings = []
+            for key in keys:
+                row = rows.get(key)
+                embedding = None
+                if row is not None and self._row_holds(row, key):
+                    embedding = np.array(self._matrix[row])
+                    if not self._row_holds(row, key):
+                        embedding = None
+                if embedding is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self._touched[key] = time.time()
+                embeddings.append(embedding)
+            if len(self._touched) >= self.TOUCH_FLUSH_SIZE:
+                self._flush_touched()
+            return embeddings
+
+    def put_many(self, keys: list[bytes], embeddings: list[np.ndarray] | np.ndarray):
+        """Store embeddings in one transaction, recycling least recently used rows once the file is full."""
+        with self._lock:
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as e:
+                LOGGER.warning(f"Disk cache index is busy, not storing {len(keys)} embeddings: {e}")
+                self.busy += 1
+                return
+            written = []
+            entries = self._meta("next_row")
+            try:
+                self._flush_touched()
+                for key, embedding in zip(keys, embeddings):
+                    now = time.time()
+                    if self._db.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None:
+                        self._db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+                        continue
+
+                    row = self._meta("next_row")
+                    if row < self.max_rows:
+                        self._db.execute("UPDATE meta SET value = ? WHERE name = 'next_row'", (row + 1,))
+                        entries = row + 1
+                    else:
+                        evicted_key, row = self._db.execute(
+                            "SELECT key, row FROM entries ORDER BY last_used LIMIT 1"
+                        ).fetchone()
+                        self._db.execute("DELETE FROM entries WHERE key = ?", (evicted_key,))
+                        self.evictions += 1
+
+                    # Invalidate the row before any reader can be pointed at it
+                    self._keys[row] = 0
+                    self._db.execute("INSERT INTO entries (key, row, last_used) VALUES (?, ?, ?)", (key, row, now))
+                    written.append((row, key, embedding))
+                self._db.execute("COMMIT")
+                self._entries = entries
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+            # In order, so a row recycled within the batch ends up holding the key the index points at
+            for row, key, embedding in written:
+                self._matrix[row] = embedding
+                self._keys[row] = np.frombuffer(key, dtype=np.uint8)
+
+    def _flush_touched(self):
+        if self._touched:
+            try:
+                self._db.executemany(
+                    "UPDATE entries SET last_used = ? WHERE key = ?", [(t, k) for k, t in self._touched.items()]
+                )
+            except sqlite3.OperationalError:
+                # Busy: recency is only a hint for eviction, so the updates wait for the next flush
+                return
+            self._touched.clear()
+
+    def close(self):
+        """Flush pending recency updates and mapped rows, and close the index."""
+        with self._lock:
+            self._flush_touched()
+            self._matrix.flush()
+            self._keys.flush()
+            self._db.close()
+
+    def stats(self) -> dict:
+        """Counters and occupancy for the stats endpoint."""
+        lookups = self.hits + self.misses
+        return {
+            "path": str(self.path),
+            "entries": self._entries,
+            "max_rows": self.max_rows,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "busy": self.busy,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
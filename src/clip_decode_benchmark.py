@@ -0,0 +1,98 @@
+"""
+Compare full and reduced-scale image decoding for the CLIP server.
+For JPEGs of several resolutions, measures the time to turn the encoded bytes into pixel values
+with the default path (full decode, then CLIPProcessor) and with `--reduced-image-decode` (JPEG draft
+decode near the model's input size, then the processor's resize and crop applied directly), and how
+far the image embeddings of the two paths drift apart.
+
+Example:
+    uv run -m src.clip_decode_benchmark --model laion/CLIP-ViT-B-32-laion2B-s34B-b79K --sizes 1920x1080,4032x3024
+"""
+
+import argparse
+import io
+import json
+import logging
+import time
+
+import numpy as np
+from PIL import Image
+
+from src.clip_backends import CLIP_BACKENDS, create_backend, create_image_preprocessor
+from src.clip_model import cosine_drift
+
+LOGGER = logging.getLogger(__name__)
+
+
+def make_photos(count: int, width: int, height: int, quality: int = 90, seed: int = 0) -> list[bytes]:
+    """Photo-like JPEGs: smooth upsampled color fields with grain, unlike noise that no decoder can shortcut."""
+    rng = np.random.default_rng(seed)
+    photos = []
+    for _ in range(count):
+        coarse = rng.integers(0, 256, (max(height // 64, 2), max(width // 64, 2), 3), dtype=np.uint8)
+        smooth = np.asarray(Image.fromarray(coarse).resize((width, height), Image.BICUBIC), dtype=np.int16)
+        grain = rng.integers(-6, 7, smooth.shape, dtype=np.int16)
+        buffer = io.BytesIO()
+        Image.fromarray(np.clip(smooth + grain, 0, 255).astype(np.uint8)).save(buffer, format="JPEG", quality=quality)
+        photos.append(buffer.getvalue())
+    return photos
+
+
+def _time_preprocessing(preprocessor, payloads: list[bytes], repeats: int) -> tuple[np.ndarray, float]:
+    """Pixel values of `payloads` and the mean milliseconds per image to decode and preprocess one."""
+    pixel_values = np.stack([preprocessor(preprocessor.load(payload)) for payload in payloads])
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for payload in payloads:
+            preprocessor(preprocessor.load(payload))
+    return pixel_values, (time.perf_counter() - start) * 1000.0 / (repeats * len(payloads))
+
+
+def compare(args: argparse.Namespace) -> dict:
+    """Time both decode paths and measure their embedding drift at each requested image size."""
+    full = create_image_preprocessor(args.backend, args.model)
+    reduced = create_image_preprocessor(args.backend, args.model, reduced_decode=True)
+    backend = create_backend(args.backend, args.model)
+
+    results = []
+    for size in args.sizes.split(","):
+        width, height = (int(value) for value in size.lower().split("x"))
+        payloads = make_photos(args.images, width, height, args.quality, args.seed)
+        full_pixels, full_ms = _time_preprocessing(full, payloads, args.repeats)
+        reduced_pixels, reduced_ms = _time_preprocessing(reduced, payloads, args.repeats)
+        drift = cosine_drift(backend.embed_images(full_pixels), backend.embed_images(reduced_pixels))
+        result = {
+            "size": f"{width}x{height}",
+            "jpeg_kb": sum(len(payload) for payload in payloads) / len(payloads) / 1024,
+            "decoded_size": "x".join(str(value) for value in reduced.load(payloads[0]).size),
+            "full_ms_per_image": full_ms,
+            "reduced_ms_per_image": reduced_ms,
+            "speedup": full_ms / reduced_ms,
+            "pixel_mean_abs_diff": float(np.abs(full_pixels - reduced_pixels).mean()),
+            **drift,
+        }
+        LOGGER.info(f"{result['size']}: {full_ms:.1f} ms -> {reduced_ms:.1f} ms, min cosine {drift['min_cosine']:.5f}")
+        results.append(result)
+    return {"model": args.model, "backend": args.backend, "images_per_size": args.images, "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full and reduced-scale JPEG decoding for CLIP")
+    parser.add_argument("--model", type=str, default="laion/CLIP-ViT-B-32-laion2B-s34B-b79K", help="Model name")
+    parser.add_argument("--backend", type=str, default="eager", choices=CLIP_BACKENDS, help="Inference backend")
+    parser.add_argument(
+        "--sizes", type=str, default="640x480,1920x1080,4032x3024", help="Comma-separated WIDTHxHEIGHT sizes"
+    )
+    parser.add_argument("--images", type=int, default=8, help="Images per size (default: 8)")
+    parser.add_argument("--quality", type=int, default=90, help="JPEG quality (default: 90)")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed passes over the images (default: 3)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the images")
+    parser.add_argument("--output", type=str, default=None, help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    report = compare(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
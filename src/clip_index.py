@@ -0,0 +1,569 @@
+"""
+In-memory vector search for the CLIP server.
+A collection maps client-chosen ids to L2-normalized float32 vectors, so cosine similarity is a dot
+product. Exact search scores the queries against the collection with one matrix multiply per chunk of
+rows and keeps a running top-k with `argpartition`, so memory stays bounded for millions of rows.
+An inverted-file (IVF) index clusters the vectors with k-means and only scans the `nprobe` clusters
+closest to each query, trading a little recall for latency that grows far slower than the collection.
+A product-quantized (PQ) index stores each vector as a few bytes of codebook indices instead of
+4 bytes per dimension, trading a little recall for memory.
+"""
+
+from abc import ABC, abstractmethod
+from collections.abc import Sequence
+
+import numpy as np
+
+# Upper bound on the (queries x rows) score block computed at once
+SEARCH_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Contiguous float32 copy of `vectors` with unit-length rows."""
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.maximum(norms, 1e-12)
+    return vectors
+
+
+def top_k(scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Columns and values of the `k` highest scores in each row, best first."""
+    count = scores.shape[1]
+    k = min(k, count)
+    if k < count:
+        # Partition on the scores themselves: negating them first would copy the whole block
+        columns = np.argpartition(scores, count - k, axis=1)[:, count - k :]
+    else:
+        columns = np.broadcast_to(np.arange(k), (len(scores), k))
+    values = np.take_along_axis(scores, columns, axis=1)
+    order = np.argsort(-values, axis=1, kind="stable")
+    return np.take_along_axis(columns, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+
+def nearest_centroids(
+    vectors: np.ndarray, centroids: np.ndarray, euclidean: bool = False, chunk_bytes: int = SEARCH_CHUNK_BYTES
+) -> np.ndarray:
+    """Index of the closest centroid for each vector, scored in bounded chunks.
+
+    Closest means the largest dot product, or with `euclidean` the smallest squared distance, found
+    as the largest `x.c - |c|^2 / 2` so no distance matrix is materialized.
+    """
+    half_norms = 0.5 * np.einsum("ij,ij->i", centroids, centroids) if euclidean else 0.0
+    chunk_rows = max(1, chunk_bytes // (4 * len(centroids)))
+    return np.concatenate(
+        [
+            np.argmax(vectors[start : start + chunk_rows] @ centroids.T - half_norms, axis=1)
+            for start in range(0, len(vectors), chunk_rows)
+        ]
+    )
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = 20, seed: int = 0, spherical: bool = False) -> np.ndarray:
+    """Centroids of `k` clusters of `vectors` by Lloyd's algorithm.
+
+    With `spherical`, vectors are expected to be normalized, similarity is cosine and centroids are kept
+    at unit length. Clusters that end up empty are re-seeded with random training vectors.
+    """
+    rng = np.random.default_rng(seed)
+    if len(vectors) < k:
+        raise ValueError(f"Need at least {k} vectors to train {k} clusters, got {len(vectors)}")
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(vectors, centroids, euclidean=not spherical)
+        counts = np.bincount(assignment, minlength=k)
+        # Sum each cluster's members as one contiguous run of the vectors sorted by cluster
+        starts = np.cumsum(counts) - counts
+        sums = np.zeros_like(centroids)
+        sums[counts > 0] = np.add.reduceat(vectors[np.argsort(assignment)], starts[counts > 0], axis=0)
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        counts[empty] = 1
+        centroids = normalize_rows(sums) if spherical else sums / counts[:, None].astype(np.float32)
+    return centroids
+
+
+def merge_top_k(
+    rows: np.ndarray, scores: np.ndarray, new_rows: np.ndarray, new_scores: np.ndarray, k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Combine two per-query candidate lists and keep the best `k` of each."""
+    rows = np.concatenate([rows, new_rows], axis=1)
+    scores = np.concatenate([scores, new_scores], axis=1)
+    columns, scores = top_k(scores, k)
+    return np.take_along_axis(rows, columns, axis=1), scores
+
+
+class VectorIndex(ABC):
+    """A searchable set of vectors, each stored under a unique string id. Adding an existing id replaces it."""
+
+    kind: str
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.ids: list[str] = []
+        self._rows: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _assign_rows(self, ids: Sequence[str]) -> np.ndarray:
+        """Row of each id, appending rows for new ids; a repeated id keeps a single row."""
+        rows = np.empty(len(ids), dtype=np.int64)
+        for i, vector_id in enumerate(ids):
+            row = self._rows.get(vector_id)
+            if row is None:
+                row = self._rows[vector_id] = len(self.ids)
+                self.ids.append(vector_id)
+            rows[i] = row
+        return rows
+
+    def _check(self, ids: Sequence[str], vectors: np.ndarray) -> np.ndarray:
+        vectors = normalize_rows(vectors)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dimensional vectors, got {vectors.shape[1]}")
+        if len(ids) != len(vectors):
+            raise ValueError(f"Got {len(ids)} ids for {len(vectors)} vectors")
+        return vectors
+
+    @abstractmethod
+    def add(self, ids: Sequence[str], vectors: np.ndarray):
+        """Add or replace vectors; they are normalized before they are stored."""
+
+    @abstractmethod
+    def search_rows(self, queries: np.ndarray, k: int, nprobe: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Rows and cosine scores of the `k` best matches of each normalized query, best first; -1 pads.
+
+        `nprobe` overrides the number of clusters scanned by indexes that cluster; others ignore it.
+        """
+
+    def search(self, queries: np.ndarray, k: int, nprobe: int | None = None) -> list[list[tuple[str, float]]]:
+        """The `k` most similar (id, cosine) pairs for each query, best first."""
+        queries = normalize_rows(queries)
+        if queries.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dimensional queries, got {queries.shape[1]}")
+        if not self.ids or k <= 0:
+            return [[] for _ in queries]
+        rows, scores = self.search_rows(queries, k, nprobe)
+        return [
+            [(self.ids[row], float(score)) for row, score in zip(query_rows, query_scores) if row >= 0]
+            for query_rows, query_scores in zip(rows, scores)
+        ]
+
+    def stats(self) -> dict:
+        return {"kind": self.kind, "dim": self.dim, "size": len(self)}
+
+
+class FlatIndex(VectorIndex):
+    """Exact search over one contiguous float32 matrix, grown by doubling."""
+
+    kind = "flat"
+
+    def __init__(self, dim: int, chunk_bytes: int = SEARCH_CHUNK_BYTES):
+        super().__init__(dim)
+        self.chunk_bytes = chunk_bytes
+        self._vectors = np.empty((1024, dim), dtype=np.float32)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """The stored vectors, one row per id in `ids` order (a view, not a copy)."""
+        return self._vectors[: len(self)]
+
+    def add(self, ids: Sequence[str], vectors: np.ndarray):
+        vectors = self._check(ids, vectors)
+        rows = self._assign_rows(ids)
+        if len(self) > len(self._vectors):
+            grown = np.empty((max(len(self), 2 * len(self._vectors)), self.dim), dtype=np.float32)
+            grown[: len(self._vectors)] = self._vectors
+            self._vectors = grown
+        self._vectors[rows] = vectors
+
+    def search_rows(self, queries: np.ndarray, k: int, nprobe: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        size = len(self)
+        chunk_rows = max(1024, self.chunk_bytes // (4 * len(queries)))
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, size, chunk_rows):
+            scores = queries @ self._vectors[start : min(start + chunk_rows, size)].T
+            columns, chunk_scores = top_k(scores, k)
+            best_rows, best_scores = merge_top_k(best_rows, best_scores, columns + start, chunk_scores, k)
+        return best_rows, best_scores
+
+    def stats(self) -> dict:
+        return {**super().stats(), "bytes": self.vectors.nbytes}
+
+
+class _TrainedIndex(VectorIndex):
+    """An index that must learn from the data before it can store vectors in its own layout.
+
+    Until `train_size` vectors have been added they are kept in a flat index and searched exactly; then
+    the index is trained once on them, and later adds go straight to the trained layout. Training runs
+    before the add that triggers it stores anything, so if it fails the index is left as it was.
+    """
+
+    def __init__(self, dim: int, train_size: int, seed: int = 0):
+        super().__init__(dim)
+        self.train_size = train_size
+        self.seed = seed
+        self._pending = FlatIndex(dim)  # vectors added before training, by row
+
+    @property
+    @abstractmethod
+    def trained(self) -> bool:
+        """Whether training has happened."""
+
+    @abstractmethod
+    def _fit(self, vectors: np.ndarray):
+        """Learn the layout from `vectors` (sampling them, if many); must change nothing if it raises."""
+
+    @abstractmethod
+    def _add_trained(self, rows: np.ndarray, vectors: np.ndarray, known: int):
+        """Store vectors after training; rows below `known` already hold a vector to replace."""
+
+    @abstractmethod
+    def _search_trained(self, queries: np.ndarray, k: int, nprobe: int | None) -> tuple[np.ndarray, np.ndarray]:
+        """`search_rows` once trained."""
+
+    def _training_sample(self, vectors: np.ndarray, limit: int) -> np.ndarray:
+        """At most `limit` of `vectors`, drawn at random."""
+        rng = np.random.default_rng(self.seed)
+        return vectors[rng.choice(len(vectors), min(len(vectors), limit), replace=False)]
+
+    def add(self, ids: Sequence[str], vectors: np.ndarray):
+        vectors = self._check(ids, vectors)
+        if not self.trained and len(self) + len(set(ids).difference(self._rows)) >= self.train_size:
+            self._fit(np.concatenate([self._pending.vectors, vectors]))
+        known = len(self)
+        rows = self._assign_rows(ids)
+        if not self.trained:
+            self._pending.add([str(row) for row in rows], vectors)
+            return
+        if len(self._pending):
+            # Move the vectors collected before training into the trained layout; none of them is stored yet
+            self._add_trained(np.asarray(self._pending.ids, dtype=np.int64), self._pending.vectors, 0)
+            self._pending = FlatIndex(self.dim)
+        self._add_trained(rows, vectors, known)
+
+    def search_rows(self, queries: np.ndarray, k: int, nprobe: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        if self.trained:
+            return self._search_trained(queries, k, nprobe)
+        rows, scores = self._pending.search_rows(queries, k)
+        # Pending rows are stored under their index row as id; -1 padding stays -1
+        return np.where(rows >= 0, np.asarray(self._pending.ids, dtype=np.int64)[rows], -1), scores
+
+    def stats(self) -> dict:
+        return {**super().stats(), "trained": self.trained, "train_size": self.train_size}
+
+
+class _InvertedList:
+    """The vectors of one IVF cluster, contiguous, with the index rows they belong to."""
+
+    def __init__(self, dim: int):
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.rows = np.empty(0, dtype=np.int64)
+        self.size = 0
+
+    def append(self, rows: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+        """Append entries, growing storage by doubling; returns their positions."""
+        end = self.size + len(rows)
+        if end > len(self.rows):
+            capacity = max(end, 2 * len(self.rows), 16)
+            grown = np.empty((capacity, self.vectors.shape[1]), dtype=np.float32)
+            grown[: self.size] = self.vectors[: self.size]
+            self.vectors = grown
+            self.rows = np.resize(self.rows, capacity)
+        self.vectors[self.size : end] = vectors
+        self.rows[self.size : end] = rows
+        positions = np.arange(self.size, end)
+        self.size = end
+        return positions
+
+    def remove(self, position: int) -> int | None:
+        """Remove the entry at `position` by moving the last entry into it; returns the moved row, if any."""
+        self.size -= 1
+        if position == self.size:
+            return None
+        self.vectors[position] = self.vectors[self.size]
+        self.rows[position] = self.rows[self.size]
+        return int(self.rows[position])
+
+
+class IVFIndex(_TrainedIndex):
+    """Inverted-file index: vectors are bucketed by their nearest k-means centroid, and a query only
+    scans the `nprobe` buckets whose centroids are most similar to it.
+
+    Until `train_size` vectors have been added, vectors are kept unclustered and searched exactly; then
+    the centroids are trained once with spherical k-means and later adds go straight to their bucket.
+    """
+
+    kind = "ivf"
+
+    def __init__(self, dim: int, nlist: int = 1024, nprobe: int = 16, train_size: int | None = None, seed: int = 0):
+        # k-means wants a few dozen points per cluster to place centroids well
+        super().__init__(dim, train_size or 40 * nlist, seed)
+        if nlist < 1 or nprobe < 1:
+            raise ValueError(f"nlist and nprobe must be at least 1, got nlist={nlist}, nprobe={nprobe}")
+        if self.train_size < nlist:
+            raise ValueError(f"train_size ({self.train_size}) must be at least nlist ({nlist})")
+        self.nlist = nlist
+        # Probing more lists than there are scans them all, which is what search does
+        self.nprobe = min(nprobe, nlist)
+        self.centroids: np.ndarray | None = None
+        self.lists: list[_InvertedList] = []
+        # Location of each row once clustered: its list and its position in that list
+        self._row_list = np.empty(0, dtype=np.int64)
+        self._row_position = np.empty(0, dtype=np.int64)
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def _add_trained(self, rows: np.ndarray, vectors: np.ndarray, known: int):
+        self._grow_locations()
+        existing = rows < known
+        for row in np.unique(rows[existing]):
+            self._remove(int(row))
+        self._insert(rows, vectors)
+
+    def _grow_locations(self):
+        if len(self) > len(self._row_list):
+            capacity = max(len(self), 2 * len(self._row_list))
+            self._row_list = np.resize(self._row_list, capacity)
+            self._row_position = np.resize(self._row_position, capacity)
+
+    def _fit(self, vectors: np.ndarray):
+        """Fit the centroids on the vectors (a sample of them, if many)."""
+        centroids = kmeans(self._training_sample(vectors, 256 * self.nlist), self.nlist, seed=self.seed, spherical=True)
+        self.lists = [_InvertedList(self.dim) for _ in range(self.nlist)]
+        self.centroids = centroids
+
+    def _insert(self, rows: np.ndarray, vectors: np.ndarray):
+        # With repeated ids in one add, the last vector wins
+        _, last = np.unique(rows[::-1], return_index=True)
+        keep = np.sort(len(rows) - 1 - last)
+        rows, vectors = rows[keep], vectors[keep]
+        assignment = nearest_centroids(vectors, self.centroids)
+        order = np.argsort(assignment, kind="stable")
+        boundaries = np.flatnonzero(np.diff(assignment[order])) + 1
+        for members in np.split(order, boundaries):
+            list_id = int(assignment[members[0]])
+            positions = self.lists[list_id].append(rows[members], vectors[members])
+            self._row_list[rows[members]] = list_id
+            self._row_position[rows[members]] = positions
+
+    def _remove(self, row: int):
+        inverted_list = self.lists[self._row_list[row]]
+        moved = inverted_list.remove(int(self._row_position[row]))
+        if moved is not None:
+            self._row_position[moved] = self._row_position[row]
+
+    def _search_trained(self, queries: np.ndarray, k: int, nprobe: int | None) -> tuple[np.ndarray, np.ndarray]:
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probes, _ = top_k(queries @ self.centroids.T, nprobe)
+
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        # Visit each probed list once, scoring all the queries that probe it together
+        order = np.argsort(probes, axis=None, kind="stable")
+        probed = probes.ravel()[order]
+        boundaries = np.flatnonzero(np.diff(probed)) + 1
+        for list_id, query_ids in zip(probed[np.r_[0, boundaries]], np.split(order // nprobe, boundaries)):
+            inverted_list = self.lists[list_id]
+            if inverted_list.size == 0:
+                continue
+            scores = queries[query_ids] @ inverted_list.vectors[: inverted_list.size].T
+            columns, list_scores = top_k(scores, k)
+            best_rows[query_ids], best_scores[query_ids] = merge_top_k(
+                best_rows[query_ids], best_scores[query_ids], inverted_list.rows[columns], list_scores, k
+            )
+        return best_rows, best_scores
+
+    def stats(self) -> dict:
+        sizes = np.array([inverted_list.size for inverted_list in self.lists])
+        list_bytes = sum(inverted_list.vectors.nbytes + inverted_list.rows.nbytes for inverted_list in self.lists)
+        return {
+            **super().stats(),
+            "nlist": self.nlist,
+            "nprobe": self.nprobe,
+            "list_sizes": {"min": int(sizes.min()), "mean": float(sizes.mean()), "max": int(sizes.max())}
+            if self.trained
+            else None,
+            "bytes": list_bytes + self._pending.vectors.nbytes,
+        }
+
+
+class ProductQuantizer:
+    """Product-quantization codec: a vector is split into `m` contiguous sub-vectors, and each is stored as
+    the one-byte index of its nearest centroid among 256 learned for that sub-space.
+
+    Inner products with a query are computed from the codes without decoding them (asymmetric distance
+    computation): a lookup table holds the dot product of each query sub-vector with each centroid of its
+    sub-space, and a vector's score is the sum of `m` table entries picked by its codes.
+    """
+
+    centroids_per_subspace = 256
+
+    def __init__(self, dim: int, m: int = 64):
+        if dim % m:
+            raise ValueError(f"Dimension {dim} is not divisible into {m} sub-vectors")
+        self.dim = dim
+        self.m = m
+        self.subdim = dim // m
+        self.codebooks: np.ndarray | None = None  # (m, 256, subdim)
+
+    @property
+    def code_bytes(self) -> int:
+        return self.m
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        """View of (n, dim) vectors as (m, n, subdim) sub-vectors, sub-space first."""
+        return vectors.reshape(len(vectors), self.m, self.subdim).transpose(1, 0, 2)
+
+    def train(self, vectors: np.ndarray, iterations: int = 20, seed: int = 0):
+        """Learn each sub-space's centroids with k-means on the sub-vectors of `vectors`."""
+        self.codebooks = np.stack(
+            [
+                kmeans(np.ascontiguousarray(sub), self.centroids_per_subspace, iterations, seed + j)
+                for j, sub in enumerate(self._split(vectors))
+            ]
+        ).astype(np.float32)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """(m, n) uint8 codes of (n, dim) vectors, sub-space first so a scan reads each row contiguously."""
+        return np.stack(
+            [
+                nearest_centroids(sub, codebook, euclidean=True).astype(np.uint8)
+                for sub, codebook in zip(self._split(vectors), self.codebooks)
+            ]
+        )
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """Approximate (n, dim) vectors from (m, n) codes."""
+        return np.concatenate([codebook[code] for code, codebook in zip(codes, self.codebooks)], axis=1)
+
+    def lookup_tables(self, queries: np.ndarray) -> np.ndarray:
+        """(m, 256, queries) dot products of each centroid with the matching sub-vector of each query."""
+        return np.ascontiguousarray(np.matmul(self.codebooks, self._split(queries).transpose(0, 2, 1)))
+
+    def scores(self, tables: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """(queries, n) approximate inner products of the queries behind `tables` with the coded vectors."""
+        # Each code picks a whole row of per-query entries, so the gathers copy contiguous runs
+        scores = np.zeros((codes.shape[1], tables.shape[2]), dtype=np.float32)
+        for table, code in zip(tables, codes):
+            scores += table[code]
+        return scores.T
+
+
+class PQIndex(_TrainedIndex):
+    """Vectors stored as product-quantization codes of `m` bytes each, scanned with lookup tables.
+
+    With `rerank`, that many candidates per query are taken from the coded scan and re-scored exactly
+    against the original vectors, which are then kept as well. They are kept in memory, or with
+    `rerank_path` in a memory-mapped file, so only the codes and the re-ranked rows need to be resident.
+    """
+
+    kind = "pq"
+
+    def __init__(
+        self,
+        dim: int,
+        m: int = 64,
+        rerank: int = 0,
+        rerank_path: str | None = None,
+        train_size: int | None = None,
+        seed: int = 0,
+        chunk_bytes: int = SEARCH_CHUNK_BYTES,
+    ):
+        # 256 centroids per sub-space want a few dozen training vectors each
+        super().__init__(dim, train_size or 40 * ProductQuantizer.centroids_per_subspace, seed)
+        if self.train_size < ProductQuantizer.centroids_per_subspace:
+            raise ValueError(
+                f"train_size ({self.train_size}) must be at least {ProductQuantizer.centroids_per_subspace}, "
+                "the number of centroids per sub-space"
+            )
+        if rerank < 0:
+            raise ValueError(f"rerank must be at least 0, got {rerank}")
+        self.quantizer = ProductQuantizer(dim, m)
+        self.rerank = rerank
+        self.chunk_bytes = chunk_bytes
+        self._codes = np.empty((m, 0), dtype=np.uint8)
+        self.rerank_path = rerank_path
+        # Original vectors by row, for re-ranking
+        self._exact = np.empty((0, dim), dtype=np.float32) if rerank else None
+        if rerank and rerank_path:
+            open(rerank_path, "wb").close()
+
+    @property
+    def trained(self) -> bool:
+        return self.quantizer.codebooks is not None
+
+    def _fit(self, vectors: np.ndarray):
+        """Learn the codebooks on the vectors (a sample of them, if many)."""
+        sample = self._training_sample(vectors, 32 * ProductQuantizer.centroids_per_subspace)
+        self.quantizer.train(sample, seed=self.seed)
+
+    def _add_trained(self, rows: np.ndarray, vectors: np.ndarray, known: int):
+        if len(self) > self._codes.shape[1]:
+            capacity = max(len(self), 2 * self._codes.shape[1])
+            grown = np.empty((self.quantizer.m, capacity), dtype=np.uint8)
+            grown[:, : self._codes.shape[1]] = self._codes
+            self._codes = grown
+            if self._exact is not None:
+                self._grow_exact(capacity)
+        self._codes[:, rows] = self.quantizer.encode(vectors)
+        if self._exact is not None:
+            self._exact[rows] = vectors
+
+    def _grow_exact(self, capacity: int):
+        if self.rerank_path is None:
+            grown = np.empty((capacity, self.dim), dtype=np.float32)
+            grown[: len(self._exact)] = self._exact
+            self._exact = grown
+            return
+        # Extending the file keeps the rows already written; the mapping is then recreated over it
+        if isinstance(self._exact, np.memmap):
+            self._exact.flush()
+        with open(self.rerank_path, "r+b") as f:
+            f.truncate(capacity * self.dim * 4)
+        self._exact = np.memmap(self.rerank_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def _search_trained(self, queries: np.ndarray, k: int, nprobe: int | None) -> tuple[np.ndarray, np.ndarray]:
+        size = len(self)
+        candidates = max(k, self.rerank)
+        tables = self.quantizer.lookup_tables(queries)
+        chunk_rows = max(1024, self.chunk_bytes // (4 * len(queries)))
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, size, chunk_rows):
+            scores = self.quantizer.scores(tables, self._codes[:, start : min(start + chunk_rows, size)])
+            columns, chunk_scores = top_k(scores, candidates)
+            best_rows, best_scores = merge_top_k(best_rows, best_scores, columns + start, chunk_scores, candidates)
+        if self._exact is None:
+            return best_rows, best_scores
+        exact_scores = np.einsum("qd,qcd->qc", queries, self._exact[best_rows])
+        columns, scores = top_k(exact_scores, k)
+        return np.take_along_axis(best_rows, columns, axis=1), scores
+
+    def stats(self) -> dict:
+        code_bytes = self._codes[:, : len(self)].nbytes
+        exact_bytes = self._exact[: len(self)].nbytes if self._exact is not None else 0
+        in_memory_exact_bytes = 0 if self.rerank_path else exact_bytes
+        return {
+            **super().stats(),
+            "m": self.quantizer.m,
+            "rerank": self.rerank,
+            "code_bytes": code_bytes,
+            "bytes": code_bytes + in_memory_exact_bytes + self._pending.vectors.nbytes,
+            "mapped_bytes": exact_bytes - in_memory_exact_bytes,
+            "float32_bytes": len(self) * self.dim * 4,
+        }
+
+
+INDEX_KINDS = {"flat": FlatIndex, "ivf": IVFIndex, "pq": PQIndex}
+# Integer options each kind takes from clients, e.g. in the body of /collections/create
+INDEX_OPTIONS = {"flat": (), "ivf": ("nlist", "nprobe", "train_size"), "pq": ("m", "rerank", "train_size")}
+
+
+def create_index(kind: str, dim: int, **options) -> VectorIndex:
+    """Build an empty index of the given kind."""
+    if kind not in INDEX_KINDS:
+        raise ValueError(f"Unknown index kind {kind!r}, expected one of {tuple(INDEX_KINDS)}")
+    return INDEX_KINDS[kind](dim, **options)
@@ -0,0 +1,179 @@
+"""
+Recall-vs-latency benchmark for the approximate vector indexes of the CLIP server.
+Builds collections of clustered unit vectors (a stand-in for image embeddings, which are far from
+uniform on the sphere) and takes exact search over a flat index as ground truth. For each `nprobe` it
+reports recall@k and per-query latency of an IVF index, at several collection sizes so the growth of
+latency with size can be compared against exact search. For each product-quantization setting it
+reports the memory saved against float32 storage and the recall lost.
+
+Example:
+    uv run -m src.clip_index_benchmark --sizes 100000,400000 --indexes ivf --nprobes 1,4,16,64
+    uv run -m src.clip_index_benchmark --sizes 200000 --indexes pq --pq-m 32,64 --rerank 0,100
+"""
+
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+
+from src.clip_index import VectorIndex, create_index, normalize_rows
+
+LOGGER = logging.getLogger(__name__)
+
+
+def make_vectors(count: int, dim: int, clusters: int, spread: float, seed: int = 0) -> np.ndarray:
+    """Unit vectors scattered around `clusters` random directions; `spread` is the per-dimension noise."""
+    rng = np.random.default_rng(seed)
+    centers = normalize_rows(rng.standard_normal((clusters, dim)).astype(np.float32))
+    vectors = np.empty((count, dim), dtype=np.float32)
+    # Generated in chunks so the float64 noise never needs the whole collection at once
+    for start in range(0, count, 65536):
+        end = min(start + 65536, count)
+        noise = rng.standard_normal((end - start, dim)).astype(np.float32) * spread
+        vectors[start:end] = centers[rng.integers(0, clusters, end - start)] + noise
+    return normalize_rows(vectors)
+
+
+def _time_search(index: VectorIndex, queries: np.ndarray, k: int, nprobe: int | None, batch: int, repeats: int):
+    """Result rows of all queries and the mean milliseconds per query, searching `batch` queries at a time."""
+    rows = [index.search_rows(queries[start : start + batch], k, nprobe)[0] for start in range(0, len(queries), batch)]
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for offset in range(0, len(queries), batch):
+            index.search_rows(queries[offset : offset + batch], k, nprobe)
+    return np.concatenate(rows), (time.perf_counter() - start) * 1000.0 / (repeats * len(queries))
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    """Fraction of the exact top-k rows that the approximate search also returned."""
+    hits = sum(len(np.intersect1d(row, true_row)) for row, true_row in zip(found, truth))
+    return hits / truth.size
+
+
+def _add_in_batches(index: VectorIndex, ids: list[str], vectors: np.ndarray, batch: int) -> float:
+    """Seconds to fill `index` in batches, like a collection filled through /collections/add."""
+    start = time.perf_counter()
+    for offset in range(0, len(ids), batch):
+        index.add(ids[offset : offset + batch], vectors[offset : offset + batch])
+    return time.perf_counter() - start
+
+
+def _run_ivf(args: argparse.Namespace, ids, vectors, queries, truth, exact_ms: float) -> dict:
+    """Recall and latency of one IVF index for each `nprobe`."""
+    size = len(ids)
+    ivf = create_index("ivf", args.dim, nlist=args.nlist, train_size=min(size, 40 * args.nlist))
+    build_seconds = _add_in_batches(ivf, ids, vectors, args.add_batch)
+    sweep = []
+    for nprobe in (int(value) for value in args.nprobes.split(",")):
+        found, ivf_ms = _time_search(ivf, queries, args.k, nprobe, args.batch, args.repeats)
+        recall = recall_at_k(found, truth)
+        sweep.append({"nprobe": nprobe, "recall": recall, "ms_per_query": ivf_ms, "speedup": exact_ms / ivf_ms})
+        LOGGER.info(f"{size} vectors, nprobe {nprobe}: recall {recall:.3f}, {ivf_ms:.3f} ms/query")
+    stats = ivf.stats()
+    return {
+        "build_seconds": build_seconds,
+        "bytes": stats["bytes"],
+        "list_sizes": stats["list_sizes"],
+        "nprobe_sweep": sweep,
+    }
+
+
+def _run_pq(args: argparse.Namespace, ids, vectors, queries, truth, exact_ms: float, exact_bytes: int) -> list[dict]:
+    """Memory, recall and latency of a PQ index for each code size and re-ranking depth."""
+    size = len(ids)
+    configs = []
+    for m in (int(value) for value in args.pq_m.split(",")):
+        for rerank in (int(value) for value in args.rerank.split(",")):
+            pq = create_index(
+                "pq", args.dim, m=m, rerank=rerank, rerank_path=args.rerank_path, train_size=min(size, 40 * 256)
+            )
+            build_seconds = _add_in_batches(pq, ids, vectors, args.add_batch)
+            found, pq_ms = _time_search(pq, queries, args.k, None, args.batch, args.repeats)
+            stats = pq.stats()
+            pq_bytes = stats["bytes"]
+            config = {
+                "m": m,
+                "rerank": rerank,
+                "bytes": pq_bytes,
+                "mapped_bytes": stats["mapped_bytes"],
+                "bytes_per_vector": pq_bytes / size,
+                "memory_saved": 1.0 - pq_bytes / exact_bytes,
+                "recall": recall_at_k(found, truth),
+                "ms_per_query": pq_ms,
+                "speedup": exact_ms / pq_ms,
+                "build_seconds": build_seconds,
+            }
+            LOGGER.info(
+                f"{size} vectors, pq m={m} rerank={rerank}: {config['bytes_per_vector']:.0f} B/vector, "
+                f"recall {config['recall']:.3f}, {pq_ms:.3f} ms/query"
+            )
+            configs.append(config)
+            del pq
+    return configs
+
+
+def run(args: argparse.Namespace) -> dict:
+    """Measure exact search and the approximate indexes at each collection size."""
+    indexes = args.indexes.split(",")
+    results = []
+    for size in (int(value) for value in args.sizes.split(",")):
+        vectors = make_vectors(size + args.queries, args.dim, args.clusters, args.spread, args.seed)
+        queries, vectors = vectors[: args.queries], vectors[args.queries :]
+        ids = [str(row) for row in range(size)]
+
+        flat = create_index("flat", args.dim)
+        flat.add(ids, vectors)
+        truth, exact_ms = _time_search(flat, queries, args.k, None, args.batch, args.repeats)
+        exact_bytes = flat.stats()["bytes"]
+        del flat
+
+        result = {"size": size, "exact_ms_per_query": exact_ms, "exact_bytes": exact_bytes}
+        if "ivf" in indexes:
+            result["ivf"] = _run_ivf(args, ids, vectors, queries, truth, exact_ms)
+        if "pq" in indexes:
+            result["pq"] = _run_pq(args, ids, vectors, queries, truth, exact_ms, exact_bytes)
+        results.append(result)
+        del vectors
+    return {
+        "dim": args.dim,
+        "k": args.k,
+        "nlist": args.nlist,
+        "queries": args.queries,
+        "query_batch": args.batch,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall, latency and memory of approximate vs exact vector search")
+    parser.add_argument("--sizes", type=str, default="50000,200000", help="Comma-separated collection sizes")
+    parser.add_argument("--dim", type=int, default=512, help="Vector dimension (default: 512)")
+    parser.add_argument("--nlist", type=int, default=1024, help="IVF clusters (default: 1024)")
+    parser.add_argument("--nprobes", type=str, default="1,4,16,64", help="Comma-separated nprobe values to sweep")
+    parser.add_argument("--indexes", type=str, default="ivf,pq", help="Comma-separated index kinds to measure")
+    parser.add_argument("--pq-m", type=str, default="64", help="Comma-separated PQ code sizes in bytes (default: 64)")
+    parser.add_argument(
+        "--rerank", type=str, default="0,100", help="Comma-separated PQ candidates re-scored exactly (default: 0,100)"
+    )
+    parser.add_argument(
+        "--rerank-path", type=str, default=None, help="Memory-map the PQ re-ranking vectors from this file, not RAM"
+    )
+    parser.add_argument("--k", type=int, default=10, help="Neighbors per query (default: 10)")
+    parser.add_argument("--queries", type=int, default=256, help="Query vectors (default: 256)")
+    parser.add_argument("--batch", type=int, default=16, help="Queries per search call (default: 16)")
+    parser.add_argument("--add-batch", type=int, default=10000, help="Vectors per add call (default: 10000)")
+    parser.add_argument("--clusters", type=int, default=2000, help="Clusters in the synthetic data (default: 2000)")
+    parser.add_argument("--spread", type=float, default=0.03, help="Per-dimension noise around each cluster")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed passes over the queries (default: 3)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the vectors")
+    parser.add_argument("--output", type=str, default=None, help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
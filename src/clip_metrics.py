@@ -0,0 +1,229 @@
+"""
+Prometheus metrics for the CLIP server, rendered in the text exposition format by `/metrics`.
+Counters and histograms are plain in-process objects updated from the event loop: an observation
+is a dict lookup, a bisect and two additions, so instrumenting every request and batch stays cheap.
+"""
+
+import time
+from bisect import bisect_left
+from collections.abc import Callable, Iterable
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def samples(self) -> Iterable[str]:
+        yield f"{self.name} {_format_value(self.read())}"
+
+
+class Histogram:
+    """Histogram with fixed upper bounds and optional labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...], labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        # Per label set: [non-cumulative count per bucket (+Inf last), sum, count]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self) -> Iterable[str]:
+        for key, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(float(bound))}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class MetricsRegistry:
+    """Ordered collection of metrics rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics:
+    """The metrics exported by one CLIPEmbeddingServer."""
+
+    def __init__(
+        self,
+        queue_depth: Callable[[], int],
+        queued_inputs: Callable[[], int],
+        batches_in_flight: Callable[[], int],
+    ):
+        self.registry = MetricsRegistry()
+        register = self.registry.register
+        register(Gauge("clip_request_queue_depth", "Requests waiting in the batching queue", queue_depth))
+        register(Gauge("clip_queued_inputs", "Inputs admitted and not yet taken into a batch", queued_inputs))
+        register(Gauge("clip_batches_in_flight", "Batches collected and not yet answered", batches_in_flight))
+        self.requests = register(
+            Counter("clip_requests_total", "HTTP requests handled, by endpoint and status code", ("endpoint", "status"))
+        )
+        self.request_latency = register(
+            Histogram(
+                "clip_request_latency_seconds",
+                "End-to-end HTTP request latency, until the last byte of the response is sent",
+                LATENCY_BUCKETS,
+                ("endpoint",),
+            )
+        )
+        self.stage_latency = register(
+            Histogram(
+                "clip_stage_latency_seconds",
+                "Time spent in each stage: queue_wait per request, decode and preprocess per image, "
+                "forward per batch, serialize per response or streamed chunk, search per collection query batch, "
+                "classify per image-label score matrix",
+                LATENCY_BUCKETS,
+                ("stage",),
+            )
+        )
+        self.batch_size = register(
+            Histogram("clip_batch_size", "Inputs per forward pass, by input type", BATCH_SIZE_BUCKETS, ("type",))
+        )
+        self.text_tokens = register(
+            Counter(
+                "clip_text_tokens_total",
+                "Text positions run through the model: real tokens, and padded positions including them; "
+                "their ratio is the padding efficiency",
+                ("kind",),
+            )
+        )
+        self.embeddings = register(
+            Counter(
+                "clip_embeddings_total",
+                "Inputs embedded, by input type and whether they came from the cache or the model",
+                ("type", "source"),
+            )
+        )
+        self.rejected = register(
+            Counter(
+                "clip_rejected_total",
+                "Inputs shed before reaching the model: queue full, deadline missed or client gone",
+                ("reason",),
+            )
+        )
+        self.item_failures = register(
+            Counter(
+                "clip_item_failures_total",
+                "Inputs that failed on their own, isolated from the rest of their request or batch, "
+                "by input type and stage (preprocess, forward)",
+                ("type", "stage"),
+            )
+        )
+        self.errors = register(
+            Counter("clip_errors_total", "Errors, by where they were raised (batch, endpoint, stream)", ("source",))
+        )
+
+    def render(self) -> str:
+        return self.registry.render()
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting requests and timing them until their response has been fully sent."""
+
+    def __init__(self, app, get_metrics: Callable[[], ServerMetrics | None], endpoints: Iterable[str] = ()):
+        self.app = app
+        self.get_metrics = get_metrics
+        # Unknown paths share one label value, so scanners cannot blow up the series count
+        self.endpoints = set(endpoints)
+
+    async def __call__(self, scope, receive, send):
+        metrics = self.get_metrics() if scope["type"] == "http" else None
+        if metrics is None or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            endpoint = scope["path"] if scope["path"] in self.endpoints else "other"
+            metrics.requests.inc(endpoint=endpoint, status=str(status))
+            metrics.request_latency.observe(time.perf_counter() - start, endpoint=endpoint)
@@ -0,0 +1,342 @@
+"""
+CLIP model execution shared by the embedding server and its replica worker processes.
+Takes preprocessed inputs (pixel values, raw texts) and returns L2-normalized float32 embeddings.
+
+Besides eager PyTorch, the towers can run as exported graphs (TorchScript or ONNX Runtime). Each
+tower is exported once with dynamic batch (and sequence) axes and the artifact is cached on disk,
+keyed by model name, so later starts only load it.
+
+On CPU the vision and text towers can be dynamically quantized to int8. Quantization is checked on
+load against the fp32 model on a small built-in sample set; run `python -m src.clip_model` to print
+the drift and the throughput of both variants.
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import CLIPModel, CLIPProcessor
+
+from src.clip_backends import EmbeddingBackend, TokenizedTexts
+
+LOGGER = logging.getLogger(__name__)
+
+QUANTIZE_MODES = ("int8",)
+RUNTIMES = ("eager", "torchscript", "onnx")
+
+# Input names of each tower, in the order the exported graphs take them
+TOWER_INPUTS = {"image": ("pixel_values",), "text": ("input_ids", "attention_mask")}
+
+# Quantized embeddings whose cosine similarity to fp32 falls below this on the sample set are logged
+DRIFT_WARN_COSINE = 0.98
+
+DRIFT_SAMPLE_TEXTS = [
+    "a photo of a cat",
+    "a photo of a dog playing in the snow",
+    "a diagram of a neural network",
+    "a bowl of ramen with a soft boiled egg",
+    "the skyline of a city at night",
+    "a handwritten note on lined paper",
+    "a red car parked next to a tree",
+    "an oil painting of a stormy sea",
+    "a screenshot of a spreadsheet",
+    "two people shaking hands in an office",
+    "a close-up of a circuit board",
+    "a mountain lake at sunrise",
+    "a cartoon drawing of a robot",
+    "a plate of fresh fruit on a wooden table",
+    "an aerial view of farmland",
+    "a black and white portrait of an old man",
+]
+
+
+def drift_sample_images(count: int = 8, size: int = 256, seed: int = 0) -> list[Image.Image]:
+    """Deterministic synthetic images (smooth gradients, shapes and noise) for the drift check."""
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:size, 0:size] / size
+    images = []
+    for _ in range(count):
+        channels = []
+        for _ in range(3):
+            fx, fy, phase = rng.uniform(0.5, 6.0), rng.uniform(0.5, 6.0), rng.uniform(0, 2 * np.pi)
+            channels.append(0.5 + 0.5 * np.sin(2 * np.pi * (fx * xs + fy * ys) + phase))
+        pixels = np.stack(channels, axis=-1)
+        cx, cy, radius = rng.uniform(0.2, 0.8), rng.uniform(0.2, 0.8), rng.uniform(0.1, 0.3)
+        pixels[(xs - cx) ** 2 + (ys - cy) ** 2 < radius**2] = rng.uniform(0, 1, 3)
+        pixels += rng.normal(0, 0.05, pixels.shape)
+        images.append(Image.fromarray((np.clip(pixels, 0, 1) * 255).astype(np.uint8)))
+    return images
+
+
+def quantize_towers_int8(model: CLIPModel) -> CLIPModel:
+    """Dynamically quantize the linear layers of the vision and text towers to int8, in place.
+
+    The projection heads stay in fp32; they are a single small matmul each.
+    """
+    quantize_dynamic = torch.ao.quantization.quantize_dynamic
+    model.vision_model = quantize_dynamic(model.vision_model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.text_model = quantize_dynamic(model.text_model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def cosine_drift(reference: np.ndarray, candidate: np.ndarray) -> dict:
+    """Summary of the row-wise cosine similarity between two matrices of normalized embeddings."""
+    cosines = np.sum(reference * candidate, axis=1)
+    return {
+        "mean_cosine": float(cosines.mean()),
+        "min_cosine": float(cosines.min()),
+        "max_drift": float(1.0 - cosines.min()),
+    }
+
+
+class ImageTower(torch.nn.Module):
+    """Vision tower and projection, with L2 normalization, as one exportable module."""
+
+    def __init__(self, model: CLIPModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        image_features = self.model.get_image_features(pixel_values=pixel_values)
+        # Normalize the features
+        return image_features / image_features.norm(p=2, dim=-1, keepdim=True)
+
+
+class TextTower(torch.nn.Module):
+    """Text tower and projection, with L2 normalization, as one exportable module."""
+
+    def __init__(self, model: CLIPModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        text_features = self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+        # Normalize the features
+        return text_features / text_features.norm(p=2, dim=-1, keepdim=True)
+
+
+def export_artifact_dir(
+    export_dir: str | Path, model_name: str, runtime: str, device: torch.device, quantize: str | None
+) -> Path:
+    """Directory holding the exported towers of one model, runtime, device and torch version."""
+    variant = "-".join(filter(None, [runtime, device.type, quantize, f"torch{torch.__version__}"]))
+    return Path(export_dir) / model_name.replace("/", "__") / variant
+
+
+def _replace_atomically(path: Path, write):
+    """Write an artifact through a temporary file, so concurrent loaders never see a partial one."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        write(temporary)
+        os.replace(temporary, path)
+    finally:
+        temporary.unlink(missing_ok=True)
+
+
+def _export_torchscript(tower: torch.nn.Module, example_inputs: tuple[torch.Tensor, ...], path: Path):
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(tower, example_inputs, check_trace=False).eval())
+    _replace_atomically(path, lambda temporary: torch.jit.save(traced, str(temporary)))
+
+
+def _export_onnx(tower: torch.nn.Module, example_inputs: tuple[torch.Tensor, ...], kind: str, path: Path):
+    input_names = list(TOWER_INPUTS[kind])
+    dynamic_axes = {name: {0: "batch"} for name in input_names}
+    if kind == "text":
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["embeddings"] = {0: "batch"}
+    _replace_atomically(
+        path,
+        lambda temporary: torch.onnx.export(
+            tower,
+            example_inputs,
+            str(temporary),
+            input_names=input_names,
+            output_names=["embeddings"],
+            dynamic_axes=dynamic_axes,
+            external_data=False,
+        ),
+    )
+
+
+class CLIPModelRunner(EmbeddingBackend):
+    """Loads a CLIP model and runs normalized forward passes on batches."""
+
+    def __init__(
+        self,
+        model_name: str,
+        device: torch.device | None = None,
+        quantize: str | None = None,
+        runtime: str = "eager",
+        export_dir: str | Path = "data/clip_exports",
+    ):
+        self.model_name = model_name
+        self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.quantize = quantize
+        self.runtime = runtime
+        if runtime not in RUNTIMES:
+            raise ValueError(f"Unknown runtime {runtime!r}, expected one of {RUNTIMES}")
+        if runtime == "onnx" and quantize is not None:
+            raise ValueError("Quantization is not supported with the onnx backend")
+        LOGGER.info(f"Loading CLIP model {model_name} on {self.device}")
+
+        self.model = CLIPModel.from_pretrained(model_name)
+        self.processor = CLIPProcessor.from_pretrained(model_name)
+        self.model.to(self.device)
+        self.model.eval()
+        self._towers = {"image": ImageTower(self.model), "text": TextTower(self.model)}
+        self._onnx_sessions = None
+
+        # Drift of the quantized model from fp32 on the built-in sample set, None without quantization
+        self.quantization_report = None
+        if quantize is not None:
+            if quantize not in QUANTIZE_MODES:
+                raise ValueError(f"Unknown quantization {quantize!r}, expected one of {QUANTIZE_MODES}")
+            if self.device.type != "cpu":
+                raise ValueError("Dynamic int8 quantization is only supported on CPU")
+            self._quantize_and_check()
+
+        if runtime != "eager":
+            self._load_exported(export_artifact_dir(export_dir, model_name, runtime, self.device, quantize))
+
+    def _example_inputs(self) -> dict[str, tuple[torch.Tensor, ...]]:
+        """Tracing inputs; batch size 2 so the batch axis is not specialized to 1."""
+        image_size = self.model.config.vision_config.image_size
+        text_inputs = self.processor(text=["a photo", "a photo of a cat"], return_tensors="pt", padding=True)
+        return {
+            "image": (torch.zeros(2, 3, image_size, image_size, device=self.device),),
+            "text": tuple(text_inputs[name].to(self.device) for name in TOWER_INPUTS["text"]),
+        }
+
+    def _load_exported(self, artifact_dir: Path):
+        """Export both towers unless they are already cached in `artifact_dir`, then load them."""
+        if self.runtime == "onnx":
+            try:
+                import onnxruntime
+            except ImportError as e:
+                raise ImportError(
+                    "The onnx backend needs onnx, onnxscript and onnxruntime: pip install -e '.[ml,onnx]'"
+                ) from e
+
+        suffix = ".pt" if self.runtime == "torchscript" else ".onnx"
+        paths = {kind: artifact_dir / f"{kind}{suffix}" for kind in TOWER_INPUTS}
+        if not all(path.exists() for path in paths.values()):
+            LOGGER.info(f"Exporting CLIP towers to {self.runtime} in {artifact_dir}")
+            example_inputs = self._example_inputs()
+            for kind, path in paths.items():
+                if self.runtime == "torchscript":
+                    _export_torchscript(self._towers[kind], example_inputs[kind], path)
+                else:
+                    _export_onnx(self._towers[kind], example_inputs[kind], kind, path)
+
+        LOGGER.info(f"Loading exported {self.runtime} CLIP towers from {artifact_dir}")
+        if self.runtime == "torchscript":
+            self._towers = {kind: torch.jit.load(str(path), map_location=self.device) for kind, path in paths.items()}
+        else:
+            providers = ["CPUExecutionProvider"]
+            if self.device.type == "cuda":
+                providers.insert(0, "CUDAExecutionProvider")
+            self._onnx_sessions = {
+                kind: onnxruntime.InferenceSession(str(path), providers=providers) for kind, path in paths.items()
+            }
+
+    def _run_tower(self, kind: str, inputs: dict[str, np.ndarray]) -> np.ndarray:
+        """Run one tower on numpy inputs with whichever backend is loaded."""
+        if self._onnx_sessions is not None:
+            return self._onnx_sessions[kind].run(None, {name: inputs[name] for name in TOWER_INPUTS[kind]})[0]
+        with torch.no_grad():
+            tensors = [torch.from_numpy(inputs[name]).to(self.device) for name in TOWER_INPUTS[kind]]
+            return self._towers[kind](*tensors).cpu().numpy()
+
+    def _quantize_and_check(self):
+        pixel_values = self.processor(images=drift_sample_images(), return_tensors="np")["pixel_values"]
+        reference_images = self.embed_images(pixel_values)
+        reference_texts = self.embed_texts(DRIFT_SAMPLE_TEXTS)
+
+        # The towers wrap self.model, so they pick up the quantized layers
+        quantize_towers_int8(self.model)
+
+        self.quantization_report = {
+            "mode": self.quantize,
+            "image": cosine_drift(reference_images, self.embed_images(pixel_values)),
+            "text": cosine_drift(reference_texts, self.embed_texts(DRIFT_SAMPLE_TEXTS)),
+        }
+        LOGGER.info(f"Quantized CLIP towers to {self.quantize}, drift from fp32: {self.quantization_report}")
+        for kind in ("image", "text"):
+            if self.quantization_report[kind]["min_cosine"] < DRIFT_WARN_COSINE:
+                LOGGER.warning(
+                    f"{self.quantize} {kind} embeddings drift from fp32 beyond cosine {DRIFT_WARN_COSINE} "
+                    f"on the sample set: {self.quantization_report[kind]}"
+                )
+
+    @property
+    def embedding_dim(self) -> int:
+        return self.model.config.projection_dim
+
+    @property
+    def logit_scale(self) -> float:
+        return self.model.logit_scale.detach().exp().item()
+
+    @property
+    def cache_namespace(self) -> str:
+        # Exported graphs compute the same function as eager; quantized models do not
+        return self.model_name if self.quantize is None else f"{self.model_name}@{self.quantize}"
+
+    def embed_images(self, pixel_values: np.ndarray) -> np.ndarray:
+        """Generate embeddings for a batch of preprocessed images of shape (batch, 3, H, W)."""
+        return self._run_tower("image", {"pixel_values": pixel_values})
+
+    def embed_texts(self, texts: list[str]) -> np.ndarray:
+        """Generate embeddings for multiple texts in a batch."""
+        inputs = self.processor(text=texts, return_tensors="np", padding=True, truncation=True)
+        return self._run_tower("text", {name: inputs[name].astype(np.int64) for name in TOWER_INPUTS["text"]})
+
+    def embed_tokens(self, tokens: TokenizedTexts) -> np.ndarray:
+        """Embed texts from the token ids of CLIPTokenCounter, padded as the processor would pad them."""
+        if tokens.token_ids is None:
+            return self.embed_texts(tokens.texts)
+        input_ids, attention_mask = tokens.padded()
+        return self._run_tower("text", {"input_ids": input_ids, "attention_mask": attention_mask})
+
+
+def _throughput(embed_fn, inputs, repeats: int) -> float:
+    """Items per second of `embed_fn` on `inputs`, after one warm-up call."""
+    embed_fn(inputs)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        embed_fn(inputs)
+    return repeats * len(inputs) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare a quantized CLIP model against fp32 on CPU")
+    parser.add_argument("--model", type=str, default="laion/CLIP-ViT-B-32-laion2B-s34B-b79K", help="Model name")
+    parser.add_argument("--quantize", type=str, default="int8", choices=QUANTIZE_MODES, help="Quantization mode")
+    parser.add_argument("--batch-size", type=int, default=16, help="Batch size for the throughput runs")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed batches per model and input type")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    cpu = torch.device("cpu")
+    fp32 = CLIPModelRunner(args.model, device=cpu)
+    quantized = copy.deepcopy(fp32)
+    quantized.quantize = args.quantize
+    quantized._quantize_and_check()
+
+    pixel_values = fp32.processor(images=drift_sample_images(args.batch_size), return_tensors="np")["pixel_values"]
+    texts = (DRIFT_SAMPLE_TEXTS * (args.batch_size // len(DRIFT_SAMPLE_TEXTS) + 1))[: args.batch_size]
+    report = {"drift": quantized.quantization_report, "throughput": {}}
+    for kind, inputs in (("image", pixel_values), ("text", texts)):
+        baseline = _throughput(getattr(fp32, f"embed_{kind}s"), inputs, args.repeats)
+        candidate = _throughput(getattr(quantized, f"embed_{kind}s"), inputs, args.repeats)
+        report["throughput"][kind] = {"fp32": baseline, args.quantize: candidate, "speedup": candidate / baseline}
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,272 @@
+"""
+Multi-replica CPU serving for the CLIP server.
+Runs several copies of the embedding backend in worker processes, each pinned to its own slice of the CPU cores
+with a matching torch thread count, so independent batches run side by side instead of contending
+for one intra-op thread pool. The server's batching queue stays in front of the pool and hands
+every batch to the replica with the fewest batches outstanding.
+"""
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from typing import Any
+
+import numpy as np
+import torch
+
+from src.clip_backends import TokenizedTexts, create_backend
+
+LOGGER = logging.getLogger(__name__)
+
+
+def available_cores() -> list[int]:
+    """CPU cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores: list[int], num_replicas: int) -> list[list[int]]:
+    """Split cores into `num_replicas` contiguous slices of near-equal size.
+
+    With fewer cores than replicas, replicas get one core each and share them round-robin.
+    """
+    if len(cores) < num_replicas:
+        return [[cores[i % len(cores)]] for i in range(num_replicas)]
+    return [[int(core) for core in part] for part in np.array_split(np.array(cores), num_replicas)]
+
+
+def _replica_main(
+    conn: Connection, model_name: str, cores: list[int], num_threads: int, backend: str, backend_options: dict
+):
+    """Entry point of a replica process: load the backend, then run forward passes until told to stop."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+    try:
+        embedder = create_backend(backend, model_name, device=torch.device("cpu"), **backend_options)
+    except Exception as e:
+        conn.send(("error", str(e)))
+        return
+    conn.send(
+        (
+            "ready",
+            {
+                "embedding_dim": embedder.embedding_dim,
+                "cache_namespace": embedder.cache_namespace,
+                "quantization": embedder.quantization_report,
+                "logit_scale": embedder.logit_scale,
+            },
+        )
+    )
+
+    # Texts arrive tokenized by the front end, which bucketed them by token count
+    embed_fns = {"image": embedder.embed_images, "text": embedder.embed_tokens}
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        job_id, request_type, inputs = message
+        start = time.perf_counter()
+        try:
+            embeddings = embed_fns[request_type](inputs)
+            conn.send((job_id, True, embeddings, time.perf_counter() - start))
+        except Exception as e:
+            conn.send((job_id, False, str(e), time.perf_counter() - start))
+    conn.close()
+
+
+class _Replica:
+    """Parent-side handle of one replica process and its counters."""
+
+    def __init__(self, index: int, cores: list[int], num_threads: int, process, conn: Connection):
+        self.index = index
+        self.cores = cores
+        self.num_threads = num_threads
+        self.process = process
+        self.conn = conn
+        self.alive = True
+        self.futures: dict[int, asyncio.Future] = {}
+        # Pickling a batch into the pipe can take a while, so it happens off the event loop
+        self.sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"clip-replica-{index}-send")
+        self.reader: threading.Thread | None = None
+
+        self.in_flight = 0
+        self.batches = 0
+        self.items = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+
+
+def _resolve(future: asyncio.Future, ok: bool, payload: Any, seconds: float):
+    if future.done():
+        return
+    if ok:
+        future.set_result((payload, seconds))
+    else:
+        future.set_exception(Exception(payload))
+
+
+class ReplicaPool:
+    """Model replicas in pinned worker processes, fed least-loaded first."""
+
+    def __init__(
+        self,
+        model_name: str,
+        num_replicas: int,
+        threads_per_replica: int | None = None,
+        backend: str = "eager",
+        backend_options: dict | None = None,
+        startup_timeout_s: float = 600.0,
+    ):
+        self.model_name = model_name
+        backend_options = backend_options or {}
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self.replicas: list[_Replica] = []
+
+        context = multiprocessing.get_context("spawn")
+        for index, cores in enumerate(split_cores(available_cores(), num_replicas)):
+            num_threads = threads_per_replica or len(cores)
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_replica_main,
+                args=(child_conn, model_name, cores, num_threads, backend, backend_options),
+                name=f"clip-replica-{index}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self.replicas.append(_Replica(index, cores, num_threads, process, parent_conn))
+            LOGGER.info(f"Started CLIP replica {index} (pid {process.pid}) on cores {cores} with {num_threads} threads")
+
+        # Replicas load the model concurrently; wait until all of them are ready
+        self.embedding_dim = None
+        self.cache_namespace = None
+        self.quantization_report = None
+        self.logit_scale = None
+        try:
+            for replica in self.replicas:
+                if not replica.conn.poll(startup_timeout_s):
+                    raise RuntimeError(f"CLIP replica {replica.index} did not start within {startup_timeout_s}s")
+                try:
+                    status, value = replica.conn.recv()
+                except EOFError:
+                    status, value = "error", f"process exited with code {replica.process.exitcode}"
+                if status != "ready":
+                    raise RuntimeError(f"CLIP replica {replica.index} failed to load the model: {value}")
+                self.embedding_dim = value["embedding_dim"]
+                self.cache_namespace = value["cache_namespace"]
+                self.quantization_report = value["quantization"]
+                self.logit_scale = value["logit_scale"]
+        except BaseException:
+            self.close()
+            raise
+
+        for replica in self.replicas:
+            replica.reader = threading.Thread(
+                target=self._read_results, args=(replica,), name=f"clip-replica-{replica.index}-read", daemon=True
+            )
+            replica.reader.start()
+        self.started = time.perf_counter()
+
+    def _read_results(self, replica: _Replica):
+        """Reader thread: hand each result from a replica to the coroutine waiting for it."""
+        while True:
+            try:
+                job_id, ok, payload, seconds = replica.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future = replica.futures.pop(job_id, None)
+            if future is not None:
+                future.get_loop().call_soon_threadsafe(_resolve, future, ok, payload, seconds)
+
+        # The process exited: fail whatever it still owed
+        with self._lock:
+            replica.alive = False
+            pending, replica.futures = list(replica.futures.values()), {}
+        for future in pending:
+            message = f"CLIP replica {replica.index} exited"
+            future.get_loop().call_soon_threadsafe(_resolve, future, False, message, 0.0)
+
+    def _pick_replica(self) -> _Replica:
+        """The live replica with the fewest batches outstanding (then the fewest served)."""
+        candidates = [replica for replica in self.replicas if replica.alive]
+        if not candidates:
+            raise RuntimeError("No CLIP replica processes are running")
+        return min(candidates, key=lambda replica: (replica.in_flight, replica.batches))
+
+    async def run(self, request_type: str, inputs: np.ndarray | TokenizedTexts) -> tuple[np.ndarray, float]:
+        """Embed one batch on the least loaded replica; returns embeddings and the replica's forward time."""
+        loop = asyncio.get_running_loop()
+        replica = self._pick_replica()
+        job_id = next(self._job_ids)
+        future = loop.create_future()
+        with self._lock:
+            replica.futures[job_id] = future
+
+        replica.in_flight += 1
+        try:
+            await loop.run_in_executor(replica.sender, replica.conn.send, (job_id, request_type, inputs))
+            embeddings, seconds = await future
+        except Exception:
+            replica.errors += 1
+            raise
+        finally:
+            replica.in_flight -= 1
+            with self._lock:
+                replica.futures.pop(job_id, None)
+
+        replica.batches += 1
+        replica.items += len(inputs)
+        replica.busy_seconds += seconds
+        return embeddings, seconds
+
+    def close(self):
+        """Stop all replica processes."""
+        for replica in self.replicas:
+            try:
+                replica.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for replica in self.replicas:
+            replica.process.join(timeout=5)
+            if replica.process.is_alive():
+                replica.process.terminate()
+                replica.process.join()
+            replica.sender.shutdown(wait=False, cancel_futures=True)
+            if replica.reader is not None:
+                replica.reader.join(timeout=5)
+            replica.conn.close()
+
+    def stats(self) -> list[dict]:
+        """Per-replica load and throughput for the stats endpoint."""
+        elapsed = time.perf_counter() - self.started
+        return [
+            {
+                "index": replica.index,
+                "pid": replica.process.pid,
+                "alive": replica.alive,
+                "cores": replica.cores,
+                "threads": replica.num_threads,
+                "in_flight": replica.in_flight,
+                "batches": replica.batches,
+                "items": replica.items,
+                "errors": replica.errors,
+                "busy_seconds": replica.busy_seconds,
+                "utilization": replica.busy_seconds / elapsed if elapsed > 0 else 0.0,
+                "items_per_second": replica.items / elapsed if elapsed > 0 else 0.0,
+            }
+            for replica in self.replicas
+        ]
@@ -7,58 +7,362 @@ Supports dynamic batching for improved efficiency.
 import argparse
 import asyncio
 import base64
-import io
+import json
 import logging
-from dataclasses import dataclass
+import math
+import multiprocessing
+import re
+import struct
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Iterator
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
 from typing import Any
 
+import numpy as np
 import torch
 import uvicorn
-from PIL import Image
 from starlette.applications import Starlette
-from starlette.responses import JSONResponse
+from starlette.datastructures import UploadFile
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
 from starlette.routing import Route
-from transformers import CLIPModel, CLIPProcessor
+
+from src.clip_backends import ImagePreprocessor, create_backend, create_image_preprocessor, create_token_counter
+from src.clip_batching import AdaptiveBatchController
+from src.clip_cache import DiskEmbeddingCache, EmbeddingLRUCache, embedding_cache_key
+from src.clip_index import INDEX_OPTIONS, VectorIndex, create_index, top_k
+from src.clip_metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from src.clip_metrics import MetricsMiddleware, ServerMetrics
+from src.clip_replicas import ReplicaPool
 
 LOGGER = logging.getLogger(__name__)
 
+# Binary embedding responses, selected with `Accept: application/octet-stream[; dtype=float16]`.
+# Layout: a 16-byte little-endian header (magic, format version, bytes per element, rows, dim)
+# followed by the row-major little-endian float matrix.
+BINARY_MEDIA_TYPE = "application/octet-stream"
+BINARY_MAGIC = b"CEMB"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sHHII")
+BINARY_DTYPES = {"float32": np.dtype("<f4"), "float16": np.dtype("<f2")}
+
+# Streaming responses of the bulk endpoints, selected with `?stream=true` or `Accept: application/x-ndjson`.
+# NDJSON streams one {"offset", "embeddings"} object per chunk. With `Accept: application/octet-stream`
+# the stream is a sequence of frames, each a uint32 little-endian length followed by either a binary
+# embedding matrix (see above) or, if embedding failed midway, STREAM_ERROR_MAGIC and a UTF-8 message.
+# Inputs that fail on their own (a corrupt image, an input the model rejects) do not fail the others:
+# JSON responses give them a null row and an entry in "errors", binary responses a row of NaNs.
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+FRAME_LENGTH = struct.Struct("<I")
+STREAM_ERROR_MAGIC = b"CERR"
+
+# Names of registered text sets; they double as file names when sets are persisted
+TEXT_SET_NAME = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]{0,127}")
+# Placeholder for the entry in text set templates, e.g. "a photo of a {label}"
+TEMPLATE_PLACEHOLDER = "{label}"
+
+# Optional request header: milliseconds the client is willing to wait. Requests that cannot be answered
+# in time are dropped before they reach the model and answered with 504.
+DEADLINE_HEADER = "x-request-timeout-ms"
+
+
+class QueueFullError(Exception):
+    """The batching queue is at --max-queue-depth; the request is shed instead of queued."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(Exception):
+    """The request's deadline passed, or would pass before the model gets to it."""
+
+
+class ClientDisconnectedError(Exception):
+    """The client went away before its embeddings were ready."""
+
+
+class CollectionNotFoundError(Exception):
+    """No vector collection has the requested name."""
+
+
+class TextSetNotFoundError(Exception):
+    """No text set is registered under the requested name."""
+
+
+class InvalidRequestError(ValueError):
+    """The client sent a malformed or impossible request; answered with 400 and not counted as an error."""
+
+
+# Preprocessor of a preprocessing worker process, unpickled once per process by the pool initializer
+_worker_preprocessor: ImagePreprocessor | None = None
+
+
+def _init_preprocess_worker(preprocessor: ImagePreprocessor):
+    """Initializer for preprocessing worker processes."""
+    global _worker_preprocessor
+    # Workers run one image at a time, so keep torch from oversubscribing the cores
+    torch.set_num_threads(1)
+    _worker_preprocessor = preprocessor
+
+
+def _preprocess_image(
+    image_bytes: bytes, preprocessor: ImagePreprocessor | None = None
+) -> tuple[np.ndarray, float, float]:
+    """Decode an encoded image and turn it into the backend's pixel values, e.g. (3, H, W) for CLIP.
+
+    Also returns the seconds spent decoding and preprocessing, measured inside the worker.
+    """
+    preprocessor = preprocessor or _worker_preprocessor
+    start = time.perf_counter()
+    image = preprocessor.load(image_bytes)
+    decoded = time.perf_counter()
+    pixel_values = preprocessor(image)
+    return pixel_values, decoded - start, time.perf_counter() - decoded
+
+
+def zero_shot_scores(
+    image_embeddings: np.ndarray, label_embeddings: np.ndarray, logit_scale: float, k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Columns and probabilities of the `k` most likely labels of each image, best first.
+
+    One (images x labels) matrix product of normalized embeddings gives the cosine similarities; scaled
+    by CLIP's logit scale, a softmax over the labels turns them into probabilities.
+    """
+    logits = image_embeddings @ label_embeddings.T
+    logits *= logit_scale
+    logits -= logits.max(axis=1, keepdims=True)
+    np.exp(logits, out=logits)
+    logits /= logits.sum(axis=1, keepdims=True)
+    return top_k(logits, k)
+
+
+def _log_disk_cache_failure(future: Future):
+    """Log a background disk cache store that failed; the embeddings are simply not cached."""
+    if not future.cancelled() and future.exception() is not None:
+        LOGGER.error(f"Storing embeddings in the disk cache failed: {future.exception()}")
+
+
+def _run_timed(fn, *args):
+    """Call `fn` and also return how long it took; used to measure busy time inside executors."""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class PipelineStats:
+    """Busy time per pipeline stage, reported as utilization of the stage's workers."""
+
+    def __init__(self, workers: dict[str, int]):
+        self.workers = workers
+        self.started = time.perf_counter()
+        self.busy_seconds = {stage: 0.0 for stage in workers}
+        self.counts = {stage: 0 for stage in workers}
+
+    def record(self, stage: str, seconds: float):
+        self.busy_seconds[stage] += seconds
+        self.counts[stage] += 1
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        return {
+            stage: {
+                "count": self.counts[stage],
+                "busy_seconds": self.busy_seconds[stage],
+                "utilization": self.busy_seconds[stage] / (elapsed * self.workers[stage]) if elapsed > 0 else 0.0,
+            }
+            for stage in self.workers
+        }
+
+
+@dataclass
+class TextSet:
+    """Texts registered once under a name, with their embeddings pinned in memory, one row per entry.
+
+    With templates, each entry is a label and its row is the normalized mean embedding of the label
+    filled into every template (CLIP's prompt ensembling).
+    """
+
+    entries: list[str]
+    embeddings: np.ndarray
+    templates: list[str] | None = None
+    persisted: bool = False
+
 
 @dataclass
 class BatchRequest:
-    """Represents a batched request."""
+    """Represents a batched request of one or more inputs of the same type."""
 
-    data: Any
+    data: list[Any]
     response_queue: asyncio.Queue
     request_type: str  # 'image' or 'text'
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    deadline: float | None = None  # time.perf_counter() value after which the result is useless
+    cancelled: bool = False  # set when nobody waits for the result any more; skipped by the batch collector
 
 
 class CLIPEmbeddingServer:
+    # Chunks of one bulk request that may be queued or in the model at the same time
+    BULK_CHUNKS_IN_FLIGHT = 2
+    # Label lists sent inline to /classify whose embedding matrices are kept for the next call
+    LABEL_MATRIX_CACHE_SIZE = 64
+
     def __init__(
         self,
         model_name: str = "laion/CLIP-ViT-B-32-laion2B-s34B-b79K",
         max_batch_size: int = 8,
         batch_timeout_ms: int = 2,
+        cache_max_entries: int = 100_000,
+        cache_max_bytes: int = 256 * 1024 * 1024,
+        disk_cache_dir: str | None = None,
+        disk_cache_max_rows: int = 1_000_000,
+        preprocess_workers: int = 4,
+        preprocess_pool: str = "thread",
+        pipeline_depth: int = 2,
+        adaptive_batching: bool = False,
+        latency_target_ms: float = 50.0,
+        replicas: int = 0,
+        threads_per_replica: int | None = None,
+        quantize: str | None = None,
+        backend: str = "eager",
+        export_dir: str = "data/clip_exports",
+        backend_options: dict | None = None,
+        max_queue_depth: int = 1024,
+        text_length_buckets: tuple[int, ...] = (16, 32),
+        reduced_image_decode: bool = False,
+        text_set_dir: str | None = None,
     ):
         self.model_name = model_name
         self.max_batch_size = max_batch_size
         self.batch_timeout_ms = batch_timeout_ms
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        LOGGER.info(f"Loading CLIP model {model_name} on {self.device}")
-
-        self.model = CLIPModel.from_pretrained(model_name)
-        self.processor = CLIPProcessor.from_pretrained(model_name)
-        self.model.to(self.device)
-        self.model.eval()
+        self.pipeline_depth = pipeline_depth
+        self.replicas = replicas
+        self.backend_name = backend
+        # Extra options (e.g. the synthetic backend's dim and latency) go straight to the backend
+        backend_options = {"quantize": quantize, "export_dir": export_dir, **(backend_options or {})}
+
+        # With replicas the model only lives in the replica processes; otherwise it runs in this one
+        self.backend = None
+        self.replica_pool = None
+        if replicas > 0:
+            LOGGER.info(f"Starting {replicas} {backend} model replicas for {model_name}")
+            self.replica_pool = ReplicaPool(
+                model_name,
+                replicas,
+                threads_per_replica=threads_per_replica,
+                backend=backend,
+                backend_options=backend_options,
+            )
+            self.embedding_dim = self.replica_pool.embedding_dim
+            self.cache_namespace = self.replica_pool.cache_namespace
+            self.quantization_report = self.replica_pool.quantization_report
+            self.logit_scale = self.replica_pool.logit_scale
+        else:
+            self.backend = create_backend(backend, model_name, **backend_options)
+            self.embedding_dim = self.backend.embedding_dim
+            self.cache_namespace = self.backend.cache_namespace
+            self.quantization_report = self.backend.quantization_report
+            self.logit_scale = self.backend.logit_scale
+        self.image_preprocessor = create_image_preprocessor(
+            backend, model_name, reduced_decode=reduced_image_decode, **backend_options
+        )
+        # Reduced-scale decoding changes image embeddings slightly, so they are cached apart
+        self.image_cache_namespace = self.cache_namespace + ("+reduced-decode" if reduced_image_decode else "")
+        # Texts in a batch are padded to the longest one, so the batch is split into forward passes by
+        # token count: bucket i holds texts with text_length_buckets[i - 1] < tokens <= text_length_buckets[i]
+        self.token_counter = create_token_counter(backend, model_name)
+        self.text_length_buckets = np.asarray(sorted(text_length_buckets), dtype=np.int64)
+
+        # Image decoding and preprocessing run in a worker pool, off the event loop
+        self.preprocess_executor: Executor
+        if preprocess_pool == "process":
+            self.preprocess_executor = ProcessPoolExecutor(
+                max_workers=preprocess_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_preprocess_worker,
+                initargs=(self.image_preprocessor,),
+            )
+            self._preprocess_fn = _preprocess_image
+        elif preprocess_pool == "thread":
+            self.preprocess_executor = ThreadPoolExecutor(
+                max_workers=preprocess_workers, thread_name_prefix="clip-preprocess"
+            )
+            self._preprocess_fn = partial(_preprocess_image, preprocessor=self.image_preprocessor)
+        else:
+            raise ValueError(f"Unknown preprocess pool {preprocess_pool!r}, expected 'thread' or 'process'")
+
+        # The forward pass runs in a dedicated executor so the event loop keeps serving requests
+        self.inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="clip-inference")
+
+        # Vector collections searched server-side. One thread runs all index work, so adds and searches
+        # never overlap and the event loop stays free; numpy's BLAS parallelizes the matrix products.
+        self.collections: dict[str, VectorIndex] = {}
+        self.index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="clip-index")
+
+        # Registered text sets by name, and the most recent label lists sent inline to /classify. Their
+        # work has its own thread, so classifying never waits behind the training of a large index.
+        self.text_sets: dict[str, TextSet] = {}
+        self._label_matrices: OrderedDict[tuple[str, ...], np.ndarray] = OrderedDict()
+        self.classify_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="clip-classify")
+        # Text sets registered with persist=True are saved here and reloaded on startup
+        self.text_set_dir = Path(text_set_dir) if text_set_dir is not None else None
+        if self.text_set_dir is not None:
+            self.text_set_dir.mkdir(parents=True, exist_ok=True)
+            self._load_text_sets()
 
         # Initialize request queue and processing task
         self.request_queue: asyncio.Queue = asyncio.Queue()
         self.processing_task = None
+        self._carried_request: BatchRequest | None = None
+
+        # Admission control: inputs are counted from cache miss until they are taken into a batch,
+        # which covers images being preprocessed as well as queued requests. 0 means unbounded.
+        self.max_queue_depth = max_queue_depth
+        self._queued_inputs = 0
+        # Forward seconds per input (exponentially weighted), to estimate how long the queue takes to drain
+        self._seconds_per_input: float | None = None
+
+        # Up to `pipeline_depth` batches are in flight per replica: while one is in the model, the next is collected
+        self._pipeline_slots: asyncio.Semaphore | None = None
+        self._batch_tasks: set[asyncio.Task] = set()
+        # In adaptive mode, max_batch_size and batch_timeout_ms are upper bounds for the controller
+        self.batch_controller = None
+        if adaptive_batching:
+            self.batch_controller = AdaptiveBatchController(
+                max_batch_size=max_batch_size, max_timeout_ms=batch_timeout_ms, latency_target_ms=latency_target_ms
+            )
+        self.pipeline_stats = PipelineStats(
+            {"collect": 1, "preprocess": preprocess_workers, "forward": max(replicas, 1), "serialize": 1}
+        )
+        self.metrics = ServerMetrics(
+            queue_depth=self.request_queue.qsize,
+            queued_inputs=lambda: self._queued_inputs,
+            batches_in_flight=lambda: len(self._batch_tasks),
+        )
+
+        # Content-addressed cache, consulted before anything is queued
+        self.cache = EmbeddingLRUCache(max_entries=cache_max_entries, max_bytes=cache_max_bytes)
+        self.disk_cache = None
+        if disk_cache_dir is not None:
+            self.disk_cache = DiskEmbeddingCache(
+                Path(disk_cache_dir) / self.cache_namespace.replace("/", "__"),
+                dim=self.embedding_dim,
+                max_rows=disk_cache_max_rows,
+            )
+            LOGGER.info(f"Using on-disk embedding cache at {self.disk_cache.path}")
+        # The on-disk cache is read and written a chunk at a time on its own thread, never on the event loop
+        self.disk_cache_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="clip-disk-cache")
 
         LOGGER.info(f"CLIP model loaded successfully (batch_size={max_batch_size}, timeout={batch_timeout_ms}ms)")
 
     def start_processing(self):
         """Start the background processing task."""
         if self.processing_task is None:
+            self._pipeline_slots = asyncio.Semaphore(self.pipeline_depth * max(self.replicas, 1))
             self.processing_task = asyncio.create_task(self._process_batches())
             LOGGER.info("Started batch processing task")
 
@@ -67,43 +371,161 @@ class CLIPEmbeddingServer:
         if self.processing_task:
             self.processing_task.cancel()
             self.processing_task = None
+            for task in self._batch_tasks:
+                task.cancel()
             LOGGER.info("Stopped batch processing task")
+        # Let queued stores finish before the cache is closed under them
+        self.disk_cache_executor.shutdown(wait=True)
+        if self.disk_cache is not None:
+            self.disk_cache.close()
+            self.disk_cache = None
+        self.preprocess_executor.shutdown(wait=False, cancel_futures=True)
+        self.inference_executor.shutdown(wait=False, cancel_futures=True)
+        self.index_executor.shutdown(wait=False, cancel_futures=True)
+        self.classify_executor.shutdown(wait=False, cancel_futures=True)
+        if self.replica_pool is not None:
+            self.replica_pool.close()
+            self.replica_pool = None
 
     async def _process_batches(self):
-        """Main batch processing loop."""
+        """Main batch processing loop: collect batches and hand them to the inference stage."""
         while True:
             try:
-                # Wait for at least one request
-                first_request = await self.request_queue.get()
-
-                # Collect requests for batching
-                batch_requests = [first_request]
-
-                # Try to collect more requests within timeout
-                timeout_seconds = self.batch_timeout_ms / 1000.0
-                deadline = asyncio.get_event_loop().time() + timeout_seconds
-
-                while len(batch_requests) < self.max_batch_size and asyncio.get_event_loop().time() < deadline:
-                    try:
-                        remaining_time = deadline - asyncio.get_event_loop().time()
-                        if remaining_time <= 0:
-                            break
-
-                        request = await asyncio.wait_for(self.request_queue.get(), timeout=remaining_time)
-                        batch_requests.append(request)
-                    except asyncio.TimeoutError:
-                        break
-
-                # Process the batch
-                await self._process_batch(batch_requests)
+                # Wait for a free pipeline slot, so collection overlaps the forward pass of earlier batches
+                await self._pipeline_slots.acquire()
+                try:
+                    batch_requests = await self._collect_batch()
+                except BaseException:
+                    self._pipeline_slots.release()
+                    raise
+
+                # Process the batch without blocking collection of the next one
+                task = asyncio.create_task(self._process_batch(batch_requests))
+                self._batch_tasks.add(task)
+                task.add_done_callback(self._batch_done)
 
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 LOGGER.error(f"Error in batch processing: {str(e)}")
 
+    def _batch_done(self, task: asyncio.Task):
+        self._batch_tasks.discard(task)
+        self._pipeline_slots.release()
+
+    def _batch_limits(self, started: int) -> tuple[int, float]:
+        """Target batch size and collection timeout in seconds for a batch started by `started` inputs."""
+        if self.batch_controller is not None:
+            return self.batch_controller.decide(self._queued_inputs, started)
+        return self.max_batch_size, self.batch_timeout_ms / 1000.0
+
+    async def _next_request(self, timeout: float | None = None) -> BatchRequest | None:
+        """Take the next queued request (the carried-over one first), or None on timeout."""
+        if self._carried_request is not None:
+            request, self._carried_request = self._carried_request, None
+            return request
+        if timeout is None:
+            return self._dequeued(await self.request_queue.get())
+        if not self.request_queue.empty():
+            return self._dequeued(self.request_queue.get_nowait())
+
+        # asyncio.wait instead of wait_for: on Python < 3.12 wait_for can swallow a cancellation
+        # that races with the timeout, which would leave this loop running after stop_processing()
+        getter = asyncio.ensure_future(self.request_queue.get())
+        try:
+            await asyncio.wait({getter}, timeout=timeout)
+            if not getter.done():
+                getter.cancel()
+                # Let the getter unwind; a cancelled get() leaves its request in the queue
+                await asyncio.wait({getter})
+        except asyncio.CancelledError:
+            getter.cancel()
+            raise
+        return None if getter.cancelled() else self._dequeued(getter.result())
+
+    def _dequeued(self, request: BatchRequest) -> BatchRequest:
+        """Release the admission slots of a request leaving the queue."""
+        self._queued_inputs -= len(request.data)
+        return request
+
+    def _skip(self, request: BatchRequest) -> bool:
+        """Whether a dequeued request should stay out of the batch: cancelled, or would miss its deadline.
+
+        Requests that would miss their deadline are answered with an error; cancelled ones are just dropped.
+        """
+        if request.cancelled:
+            self.metrics.rejected.inc(len(request.data), reason="cancelled")
+            return True
+        if request.deadline is None:
+            return False
+        if time.perf_counter() + self._forward_estimate(len(request.data)) <= request.deadline:
+            return False
+        self.metrics.rejected.inc(len(request.data), reason="deadline")
+        request.response_queue.put_nowait(
+            {"success": False, "error": DeadlineExceededError("Deadline exceeded while queued")}
+        )
+        return True
+
+    async def _collect_batch(self) -> list[BatchRequest]:
+        """Wait for a request, then collect more until the batch is full or the timeout expires.
+
+        Batch size counts inputs, not requests. A request that does not fit is carried over to the
+        next batch; bulk requests are chunked so that no single request exceeds `max_batch_size`.
+        """
+        # Wait for at least one request that is still worth answering
+        first_request = await self._next_request()
+        while self._skip(first_request):
+            first_request = await self._next_request()
+        collect_start = time.perf_counter()
+        max_batch_size, timeout_seconds = self._batch_limits(len(first_request.data))
+
+        # Collect requests for batching, starting with those already queued
+        batch_requests = [first_request]
+        batch_items = len(first_request.data)
+        deadline = asyncio.get_event_loop().time() + timeout_seconds
+
+        while batch_items < max_batch_size:
+            # Try to collect more requests within timeout
+            remaining_time = max(deadline - asyncio.get_event_loop().time(), 0.0)
+            request = await self._next_request(timeout=remaining_time)
+            if request is None:
+                break
+            if self._skip(request):
+                continue
+            if batch_items + len(request.data) > max_batch_size:
+                self._carried_request = request
+                break
+            batch_requests.append(request)
+            batch_items += len(request.data)
+
+        self.pipeline_stats.record("collect", time.perf_counter() - collect_start)
+        return batch_requests
+
+    async def _run_inference(self, request_type: str, inputs) -> np.ndarray:
+        """Run a forward pass on the least loaded replica, or in the inference executor."""
+        if self.replica_pool is not None:
+            embeddings, seconds = await self.replica_pool.run(request_type, inputs)
+        else:
+            embed_fn = self.backend.embed_images if request_type == "image" else self.backend.embed_tokens
+            loop = asyncio.get_running_loop()
+            embeddings, seconds = await loop.run_in_executor(self.inference_executor, _run_timed, embed_fn, inputs)
+        self.pipeline_stats.record("forward", seconds)
+        per_input = seconds / len(inputs)
+        if self._seconds_per_input is None:
+            self._seconds_per_input = per_input
+        else:
+            self._seconds_per_input = 0.9 * self._seconds_per_input + 0.1 * per_input
+        self.metrics.stage_latency.observe(seconds, stage="forward")
+        self.metrics.batch_size.observe(len(inputs), type=request_type)
+        if self.batch_controller is not None:
+            self.batch_controller.record_batch(len(inputs), seconds)
+        return embeddings
+
     async def _process_batch(self, batch_requests: list[BatchRequest]):
         """Process a batch of requests."""
+        started = time.perf_counter()
+        for request in batch_requests:
+            self.metrics.stage_latency.observe(started - request.enqueued_at, stage="queue_wait")
         try:
             # Separate by request type
             image_requests = [r for r in batch_requests if r.request_type == "image"]
@@ -111,76 +533,760 @@ class CLIPEmbeddingServer:
 
             # Process image batch
             if image_requests:
-                images = [r.data for r in image_requests]
-                embeddings = self._embed_images_batch(images)
-
-                for request, embedding in zip(image_requests, embeddings):
-                    await request.response_queue.put({"success": True, "embedding": embedding})
+                # Images arrive already preprocessed, so batching only stacks pixel tensors
+                pixel_values = np.stack([x for r in image_requests for x in r.data])
+                embeddings, errors = await self._run_isolating_failures("image", pixel_values)
+                await self._send_results(image_requests, embeddings, errors)
 
             # Process text batch
             if text_requests:
-                texts = [r.data for r in text_requests]
-                embeddings = self._embed_texts_batch(texts)
-
-                for request, embedding in zip(text_requests, embeddings):
-                    await request.response_queue.put({"success": True, "embedding": embedding})
+                texts = [x for r in text_requests for x in r.data]
+                embeddings, errors = await self._run_text_buckets(texts)
+                await self._send_results(text_requests, embeddings, errors)
 
         except Exception as e:
             LOGGER.error(f"Error processing batch: {str(e)}")
+            self.metrics.errors.inc(source="batch")
             # Send error to all requests in batch
             for request in batch_requests:
                 await request.response_queue.put({"success": False, "error": str(e)})
 
-    def _embed_images_batch(self, images: list[Image.Image]) -> list[list[float]]:
-        """Generate embeddings for multiple images in a batch."""
-        with torch.no_grad():
-            inputs = self.processor(images=images, return_tensors="pt")
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            image_features = self.model.get_image_features(**inputs)
-            # Normalize the features
-            image_features = image_features / image_features.norm(p=2, dim=-1, keepdim=True)
-            return image_features.cpu().numpy().tolist()
-
-    def _embed_texts_batch(self, texts: list[str]) -> list[list[float]]:
-        """Generate embeddings for multiple texts in a batch."""
-        with torch.no_grad():
-            inputs = self.processor(text=texts, return_tensors="pt", padding=True, truncation=True)
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            text_features = self.model.get_text_features(**inputs)
-            # Normalize the features
-            text_features = text_features / text_features.norm(p=2, dim=-1, keepdim=True)
-            return text_features.cpu().numpy().tolist()
-
-    async def embed_image_async(self, image: Image.Image) -> list[float]:
-        """Generate embedding for a single image (async batched)."""
-        response_queue = asyncio.Queue()
-        request = BatchRequest(data=image, response_queue=response_queue, request_type="image")
-
-        await self.request_queue.put(request)
-        result = await response_queue.get()
+    async def _run_isolating_failures(self, request_type: str, inputs) -> tuple[np.ndarray, dict[int, str]]:
+        """Run a forward pass; if it fails, bisect the batch so that only the failing inputs fail.
 
-        if result["success"]:
-            return result["embedding"]
+        Returns the embeddings, with NaN rows for failed inputs, and the error of each failed row.
+        """
+        try:
+            return await self._run_inference(request_type, inputs), {}
+        except Exception as e:
+            if len(inputs) == 1:
+                LOGGER.warning(f"Forward pass failed for a single {request_type}: {str(e)}")
+                self.metrics.item_failures.inc(type=request_type, stage="forward")
+                return np.full((1, self.embedding_dim), np.nan, dtype=np.float32), {0: str(e)}
+            LOGGER.error(f"Forward pass failed for a batch of {len(inputs)} {request_type}s, bisecting: {str(e)}")
+            self.metrics.errors.inc(source="batch")
+
+        middle = len(inputs) // 2
+        left, left_errors = await self._run_isolating_failures(request_type, inputs[:middle])
+        right, right_errors = await self._run_isolating_failures(request_type, inputs[middle:])
+        errors = {**left_errors, **{middle + row: error for row, error in right_errors.items()}}
+        return np.concatenate([left, right]), errors
+
+    async def _run_text_buckets(self, texts: list[str]) -> tuple[np.ndarray, dict[int, str]]:
+        """Run texts through the model in one forward pass per length bucket, in their original order.
+
+        The texts are tokenized once, in the inference executor, and the forward passes reuse the token
+        ids. With replicas the buckets run concurrently, each on the least loaded replica.
+        """
+        loop = asyncio.get_running_loop()
+        tokens = await loop.run_in_executor(self.inference_executor, self.token_counter.tokenize, texts)
+        buckets = np.searchsorted(self.text_length_buckets, tokens.lengths)
+        bucket_rows = [np.flatnonzero(buckets == bucket) for bucket in np.unique(buckets)]
+        runs = (self._run_isolating_failures("text", tokens[rows]) for rows in bucket_rows)
+        if self.replica_pool is not None:
+            results = await asyncio.gather(*runs)
         else:
-            raise Exception(result["error"])
-
-    async def embed_text_async(self, text: str) -> list[float]:
-        """Generate embedding for a single text (async batched)."""
+            results = [await run for run in runs]
+
+        embeddings = np.empty((len(texts), self.embedding_dim), dtype=np.float32)
+        errors = {}
+        for rows, (bucket_embeddings, bucket_errors) in zip(bucket_rows, results):
+            embeddings[rows] = bucket_embeddings
+            errors.update({int(rows[row]): error for row, error in bucket_errors.items()})
+            self.metrics.text_tokens.inc(int(tokens.lengths[rows].sum()), kind="real")
+            self.metrics.text_tokens.inc(int(tokens.lengths[rows].max()) * len(rows), kind="padded")
+        return embeddings, errors
+
+    async def _send_results(self, requests: list[BatchRequest], embeddings: np.ndarray, errors: dict[int, str]):
+        """Hand each request the rows of the batch output, and the errors, that belong to its inputs."""
+        offset = 0
+        for request in requests:
+            count = len(request.data)
+            request_errors = {row - offset: error for row, error in errors.items() if offset <= row < offset + count}
+            await request.response_queue.put(
+                {"success": True, "embeddings": embeddings[offset : offset + count], "errors": request_errors}
+            )
+            offset += count
+
+    def _forward_estimate(self, count: int) -> float:
+        """Rough forward time of `count` inputs, 0 until the first batch has been timed."""
+        return count * (self._seconds_per_input or 0.0)
+
+    def _queue_estimate(self) -> float:
+        """Rough time until inputs admitted now reach the model."""
+        return self._forward_estimate(self._queued_inputs) / max(self.replicas, 1)
+
+    def _admit(self, count: int, deadline: float | None):
+        """Reserve queue capacity for `count` inputs, or shed them."""
+        if self.max_queue_depth and self._queued_inputs + count > self.max_queue_depth:
+            self.metrics.rejected.inc(count, reason="queue_full")
+            retry_after = max(1, math.ceil(self._queue_estimate()))
+            raise QueueFullError(f"Request queue is full ({self._queued_inputs} inputs queued)", retry_after)
+        finish = time.perf_counter() + self._queue_estimate() + self._forward_estimate(count)
+        if deadline is not None and finish > deadline:
+            self.metrics.rejected.inc(count, reason="deadline")
+            raise DeadlineExceededError("Request cannot be embedded before its deadline")
+        self._queued_inputs += count
+
+    async def _submit(
+        self, inputs: list[Any], request_type: str, deadline: float | None = None
+    ) -> tuple[np.ndarray, dict[int, str]]:
+        """Queue inputs for batching as one request and wait for their embeddings and per-input errors."""
         response_queue = asyncio.Queue()
-        request = BatchRequest(data=text, response_queue=response_queue, request_type="text")
+        request = BatchRequest(data=inputs, response_queue=response_queue, request_type=request_type, deadline=deadline)
 
+        enqueued = time.monotonic()
+        if self.batch_controller is not None:
+            self.batch_controller.record_arrival(len(inputs), enqueued)
         await self.request_queue.put(request)
-        result = await response_queue.get()
+        try:
+            result = await response_queue.get()
+        except asyncio.CancelledError:
+            # The caller gave up (client disconnect or timeout): spare the request its forward pass
+            request.cancelled = True
+            raise
+        if self.batch_controller is not None:
+            self.batch_controller.record_latency(time.monotonic() - enqueued)
 
         if result["success"]:
-            return result["embedding"]
+            return result["embeddings"], result["errors"]
+        error = result["error"]
+        raise error if isinstance(error, Exception) else Exception(error)
+
+    async def _preprocess(self, image_bytes: bytes) -> np.ndarray:
+        """Decode and preprocess one image in the preprocessing pool."""
+        loop = asyncio.get_running_loop()
+        pixel_values, decode_seconds, preprocess_seconds = await loop.run_in_executor(
+            self.preprocess_executor, self._preprocess_fn, image_bytes
+        )
+        self.pipeline_stats.record("preprocess", decode_seconds + preprocess_seconds)
+        self.metrics.stage_latency.observe(decode_seconds, stage="decode")
+        self.metrics.stage_latency.observe(preprocess_seconds, stage="preprocess")
+        return pixel_values
+
+    async def _embed_chunk(
+        self, payloads: list[bytes] | list[str], request_type: str, deadline: float | None = None
+    ) -> tuple[np.ndarray, dict[int, str]]:
+        """Embed up to `max_batch_size` inputs, answering cache hits without queueing them.
+
+        Inputs that fail on their own get a NaN row and an entry in the returned errors.
+        """
+        namespace = self.image_cache_namespace if request_type == "image" else self.cache_namespace
+        cache_keys = [
+            embedding_cache_key(namespace, request_type, p if isinstance(p, bytes) else p.encode()) for p in payloads
+        ]
+        embeddings = await self._cached_embeddings(cache_keys)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        self.metrics.embeddings.inc(len(payloads) - len(missing), type=request_type, source="cache")
+        errors: dict[int, str] = {}
+        if missing:
+            self._admit(len(missing), deadline)
+            reserved = len(missing)
+            try:
+                if request_type == "image":
+                    results = await asyncio.gather(
+                        *(self._preprocess(payloads[i]) for i in missing), return_exceptions=True
+                    )
+                    for i, result in zip(missing, results):
+                        if isinstance(result, BaseException):
+                            errors[i] = f"Image preprocessing failed: {result}"
+                    inputs = [result for result in results if not isinstance(result, BaseException)]
+                    if errors:
+                        LOGGER.warning(f"{len(errors)} of {len(payloads)} images failed preprocessing")
+                        self.metrics.item_failures.inc(len(errors), type=request_type, stage="preprocess")
+                        missing = [i for i in missing if i not in errors]
+                        self._queued_inputs -= len(errors)
+                        reserved = len(missing)
+                else:
+                    inputs = [payloads[i] for i in missing]
+                if missing:
+                    # From here on the slots are released when the batch collector takes the request
+                    reserved = 0
+                    computed, forward_errors = await self._submit(inputs, request_type, deadline)
+            finally:
+                self._queued_inputs -= reserved
+            if missing:
+                self.metrics.embeddings.inc(len(missing) - len(forward_errors), type=request_type, source="model")
+                for row, (i, embedding) in enumerate(zip(missing, computed)):
+                    if row in forward_errors:
+                        errors[i] = forward_errors[row]
+                        continue
+                    embeddings[i] = embedding
+                stored = [i for i in missing if i not in errors]
+                self._store_embeddings([cache_keys[i] for i in stored], [embeddings[i] for i in stored])
+        for i in errors:
+            embeddings[i] = np.full(self.embedding_dim, np.nan, dtype=np.float32)
+        return np.stack(embeddings), errors
+
+    async def _embed_chunks(
+        self, payloads: list[bytes] | list[str], request_type: str, deadline: float | None = None
+    ) -> AsyncIterator[tuple[int, np.ndarray, dict[int, str]]]:
+        """Embed many inputs in chunks of at most `max_batch_size`, yielding (offset, embeddings, errors) in order.
+
+        Errors are keyed by the row within the chunk.
+
+        Only BULK_CHUNKS_IN_FLIGHT chunks of a bulk request are queued at a time, so they interleave
+        with single requests instead of filling the queue, and only those chunks are held in memory.
+        """
+        pending: deque[tuple[int, asyncio.Task]] = deque()
+        try:
+            for start in range(0, len(payloads), self.max_batch_size):
+                chunk = payloads[start : start + self.max_batch_size]
+                pending.append((start, asyncio.create_task(self._embed_chunk(chunk, request_type, deadline))))
+                if len(pending) >= self.BULK_CHUNKS_IN_FLIGHT:
+                    offset, task = pending.popleft()
+                    yield offset, *await task
+            while pending:
+                offset, task = pending.popleft()
+                yield offset, *await task
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def _embed_many(
+        self, payloads: list[bytes] | list[str], request_type: str, deadline: float | None = None
+    ) -> tuple[np.ndarray, dict[int, str]]:
+        """Embed many inputs through the batching queue; returns one matrix and the errors of failed rows.
+
+        Fails as a whole only if every input failed.
+        """
+        if not payloads:
+            raise InvalidRequestError(f"No {request_type}s to embed")
+        matrices, errors = [], {}
+        async for offset, embeddings, chunk_errors in self._embed_chunks(payloads, request_type, deadline):
+            matrices.append(embeddings)
+            errors.update({offset + row: error for row, error in chunk_errors.items()})
+        if len(errors) == len(payloads):
+            raise Exception(errors[0])
+        return np.concatenate(matrices), errors
+
+    async def _cached_embeddings(self, cache_keys: list[bytes]) -> list[np.ndarray | None]:
+        """Look up the in-memory cache, then the on-disk cache for the rest (promoting disk hits into memory)."""
+        embeddings = [self.cache.get(cache_key) for cache_key in cache_keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing and self.disk_cache is not None:
+            loop = asyncio.get_running_loop()
+            found = await loop.run_in_executor(
+                self.disk_cache_executor, self.disk_cache.get_many, [cache_keys[i] for i in missing]
+            )
+            for i, embedding in zip(missing, found):
+                if embedding is not None:
+                    self.cache.put(cache_keys[i], embedding)
+                    embeddings[i] = embedding
+        return embeddings
+
+    def _store_embeddings(self, cache_keys: list[bytes], embeddings: list[np.ndarray]):
+        """Record freshly computed embeddings in every cache tier; the disk write happens in the background."""
+        for cache_key, embedding in zip(cache_keys, embeddings):
+            self.cache.put(cache_key, embedding)
+        if cache_keys and self.disk_cache is not None:
+            future = self.disk_cache_executor.submit(self.disk_cache.put_many, cache_keys, embeddings)
+            future.add_done_callback(_log_disk_cache_failure)
+
+    # `deadline` is a time.perf_counter() value; inputs that cannot be embedded before it are dropped
+    # with DeadlineExceededError instead of taking model time
+
+    async def _embed_one(self, payload: bytes | str, request_type: str, deadline: float | None) -> np.ndarray:
+        embeddings, errors = await self._embed_chunk([payload], request_type, deadline)
+        if errors:
+            raise Exception(errors[0])
+        return embeddings[0]
+
+    async def embed_image_async(self, image_bytes: bytes, deadline: float | None = None) -> np.ndarray:
+        """Generate embedding for a single encoded image (cached, async batched)."""
+        return await self._embed_one(image_bytes, "image", deadline)
+
+    async def embed_text_async(self, text: str, deadline: float | None = None) -> np.ndarray:
+        """Generate embedding for a single text (cached, async batched)."""
+        return await self._embed_one(text, "text", deadline)
+
+    # The bulk methods below isolate failures: inputs that fail get a NaN row and an error keyed by their row
+
+    def iter_image_embeddings(
+        self, images: list[bytes], deadline: float | None = None
+    ) -> AsyncIterator[tuple[int, np.ndarray, dict[int, str]]]:
+        """Embed many encoded images, yielding (offset, embeddings, errors) chunks as soon as each is ready."""
+        return self._embed_chunks(images, "image", deadline)
+
+    def iter_text_embeddings(
+        self, texts: list[str], deadline: float | None = None
+    ) -> AsyncIterator[tuple[int, np.ndarray, dict[int, str]]]:
+        """Embed many texts, yielding (offset, embeddings, errors) chunks as soon as each is ready."""
+        return self._embed_chunks(texts, "text", deadline)
+
+    async def embed_images_async(
+        self, images: list[bytes], deadline: float | None = None
+    ) -> tuple[np.ndarray, dict[int, str]]:
+        """Generate embeddings for many encoded images through the batching queue."""
+        return await self._embed_many(images, "image", deadline)
+
+    async def embed_texts_async(
+        self, texts: list[str], deadline: float | None = None
+    ) -> tuple[np.ndarray, dict[int, str]]:
+        """Generate embeddings for many texts through the batching queue."""
+        return await self._embed_many(texts, "text", deadline)
+
+    def collection(self, name: str) -> VectorIndex:
+        """The vector collection called `name`."""
+        index = self.collections.get(name)
+        if index is None:
+            raise CollectionNotFoundError(f"No collection named {name!r}")
+        return index
+
+    def create_collection(self, name: str, kind: str = "flat", **options) -> VectorIndex:
+        """Create an empty collection backed by an index of the given kind, e.g. "ivf" or "pq", and its options."""
+        if name in self.collections:
+            raise InvalidRequestError(f"Collection {name!r} already exists")
+        try:
+            index = create_index(kind, self.embedding_dim, **options)
+        except ValueError as e:
+            # Only the kind and options can be wrong here, and both come from the request
+            raise InvalidRequestError(str(e)) from e
+        self.collections[name] = index
+        return index
+
+    async def add_to_collection(self, name: str, ids: list[str], vectors: np.ndarray) -> int:
+        """Add or replace vectors in a collection, creating a flat one if needed; returns the collection size."""
+        _check_vectors(vectors, self.embedding_dim)
+        if len(ids) != len(vectors):
+            raise InvalidRequestError(f"Got {len(ids)} ids for {len(vectors)} vectors")
+        index = self.collections.get(name)
+        if index is None:
+            index = self.collections[name] = create_index("flat", self.embedding_dim)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.index_executor, index.add, ids, vectors)
+        return len(index)
+
+    def drop_collection(self, name: str):
+        """Delete a collection and its vectors."""
+        self.collection(name)
+        del self.collections[name]
+
+    async def search_collection(
+        self, name: str, queries: np.ndarray, k: int, nprobe: int | None = None
+    ) -> list[list[tuple[str, float]]]:
+        """The `k` most similar (id, cosine) pairs in a collection for each query vector.
+
+        `nprobe` overrides how many clusters an IVF collection scans for these queries.
+        """
+        index = self.collection(name)
+        _check_vectors(queries, index.dim)
+        loop = asyncio.get_running_loop()
+        results, seconds = await loop.run_in_executor(self.index_executor, _run_timed, index.search, queries, k, nprobe)
+        self.metrics.stage_latency.observe(seconds, stage="search")
+        return results
+
+    async def label_embeddings(self, labels: list[str], deadline: float | None = None) -> np.ndarray:
+        """Text embeddings of `labels`, one row each; recently used label lists are not embedded again."""
+        key = tuple(labels)
+        matrix = self._label_matrices.get(key)
+        if matrix is not None:
+            self._label_matrices.move_to_end(key)
+            return matrix
+        matrix, errors = await self.embed_texts_async(labels, deadline)
+        if errors:
+            index, error = min(errors.items())
+            raise ValueError(f"Could not embed label {index}: {error}")
+        self._label_matrices[key] = matrix
+        if len(self._label_matrices) > self.LABEL_MATRIX_CACHE_SIZE:
+            self._label_matrices.popitem(last=False)
+        return matrix
+
+    async def register_text_set(
+        self, name: str, entries: list[str], templates: list[str] | None = None, persist: bool = False
+    ) -> TextSet:
+        """Embed a text set once, through the batching queue, and keep it under `name`, replacing any set
+        of that name. With `templates`, each entry is filled into every template and the embeddings are
+        averaged per entry. With `persist`, the set is also saved to `text_set_dir`.
+        """
+        if not TEXT_SET_NAME.fullmatch(name):
+            raise InvalidRequestError(f"Invalid text set name {name!r}: use letters, digits, '_', '-' and '.'")
+        if not entries:
+            raise InvalidRequestError("A text set needs at least one entry")
+        if persist and self.text_set_dir is None:
+            raise InvalidRequestError("Persisting text sets needs the server to run with --text-set-dir")
+        if templates:
+            if any(TEMPLATE_PLACEHOLDER not in template for template in templates):
+                raise InvalidRequestError(f"Every template must contain {TEMPLATE_PLACEHOLDER}")
+            texts = [template.replace(TEMPLATE_PLACEHOLDER, entry) for entry in entries for template in templates]
+        else:
+            texts = entries
+        matrix, errors = await self.embed_texts_async(texts)
+        if errors:
+            index, error = min(errors.items())
+            raise ValueError(f"Could not embed text {index} of the set: {error}")
+        if templates:
+            matrix = matrix.reshape(len(entries), len(templates), -1).mean(axis=1)
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        text_set = TextSet(list(entries), matrix, list(templates) if templates else None, persist)
+        loop = asyncio.get_running_loop()
+        if persist:
+            await loop.run_in_executor(self.classify_executor, self._save_text_set, name, text_set)
+        elif name in self.text_sets and self.text_sets[name].persisted:
+            await loop.run_in_executor(self.classify_executor, self._delete_text_set_file, name)
+        self.text_sets[name] = text_set
+        return text_set
+
+    def text_set(self, name: str) -> TextSet:
+        """The text set registered as `name`."""
+        text_set = self.text_sets.get(name)
+        if text_set is None:
+            raise TextSetNotFoundError(f"No text set named {name!r}")
+        return text_set
+
+    async def drop_text_set(self, name: str):
+        """Forget a text set, and delete its file if it was persisted."""
+        if self.text_set(name).persisted:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.classify_executor, self._delete_text_set_file, name)
+        self.text_sets.pop(name, None)
+
+    def _text_set_path(self, name: str) -> Path:
+        return self.text_set_dir / f"{name}.npz"
+
+    def _delete_text_set_file(self, name: str):
+        self._text_set_path(name).unlink(missing_ok=True)
+
+    def _save_text_set(self, name: str, text_set: TextSet):
+        """Write a text set next to its final path, then move it into place, so readers never see half a file."""
+        path = self._text_set_path(name)
+        # Set names cannot start with a dot, and the loader only reads *.npz, so this never names a set
+        partial_path = path.with_name(f".{name}.npz.partial")
+        with open(partial_path, "wb") as f:
+            np.savez(
+                f,
+                entries=np.array(text_set.entries, dtype=str),
+                templates=np.array(text_set.templates or [], dtype=str),
+                embeddings=text_set.embeddings,
+                # Embeddings of another model (or quantization) are not comparable; they are skipped on load
+                namespace=np.array(self.cache_namespace),
+            )
+        partial_path.replace(path)
+
+    def _load_text_sets(self):
+        """Load the persisted text sets, skipping files that are not readable text sets of this model."""
+        for path in sorted(self.text_set_dir.glob("*.npz")):
+            name = path.name[: -len(".npz")]
+            if not TEXT_SET_NAME.fullmatch(name):
+                LOGGER.warning(f"Skipping {path}: {name!r} is not a valid text set name")
+                continue
+            try:
+                with np.load(path, allow_pickle=False) as data:
+                    if str(data["namespace"]) != self.cache_namespace:
+                        LOGGER.warning(f"Skipping text set {name!r}: it was embedded with {data['namespace']}")
+                        continue
+                    entries, embeddings = data["entries"].tolist(), data["embeddings"]
+                    templates = data["templates"].tolist() or None
+                if embeddings.shape != (len(entries), self.embedding_dim):
+                    raise ValueError(f"embeddings of shape {embeddings.shape} for {len(entries)} entries")
+            except Exception as e:
+                LOGGER.warning(f"Skipping text set file {path}: {e}")
+                continue
+            self.text_sets[name] = TextSet(entries, embeddings, templates, persisted=True)
+        LOGGER.info(f"Loaded {len(self.text_sets)} text sets from {self.text_set_dir}")
+
+    async def classify(
+        self,
+        images: list[bytes],
+        labels: list[str] | TextSet,
+        k: int = 5,
+        deadline: float | None = None,
+    ) -> tuple[list[list[tuple[str, float]]], dict[int, str]]:
+        """Zero-shot classify encoded images against a label list or the entries of a registered text set.
+
+        Returns the `k` most likely (label, probability) pairs per image, best first, and the errors of
+        images that could not be embedded (their result is empty).
+        """
+        if isinstance(labels, TextSet):
+            label_names, label_matrix = labels.entries, labels.embeddings
+            image_embeddings, errors = await self.embed_images_async(images, deadline)
         else:
-            raise Exception(result["error"])
+            if not labels:
+                raise InvalidRequestError("Expected at least one label")
+            # The labels and the images share the batching queue, so embed them concurrently
+            label_names = labels
+            label_matrix, (image_embeddings, errors) = await asyncio.gather(
+                self.label_embeddings(labels, deadline), self.embed_images_async(images, deadline)
+            )
+        loop = asyncio.get_running_loop()
+        (columns, probabilities), seconds = await loop.run_in_executor(
+            self.classify_executor, _run_timed, zero_shot_scores, image_embeddings, label_matrix, self.logit_scale, k
+        )
+        self.metrics.stage_latency.observe(seconds, stage="classify")
+        results = [
+            [] if row in errors else [(label_names[column], float(p)) for column, p in zip(row_columns, row_probs)]
+            for row, (row_columns, row_probs) in enumerate(zip(columns, probabilities))
+        ]
+        return results, errors
+
+    def record_serialize(self, seconds: float):
+        """Record the time spent encoding one response or streamed chunk."""
+        self.pipeline_stats.record("serialize", seconds)
+        self.metrics.stage_latency.observe(seconds, stage="serialize")
+
+    def stats(self) -> dict:
+        """Runtime statistics exposed by the /stats endpoint."""
+        real_tokens = self.metrics.text_tokens.value(kind="real")
+        padded_tokens = self.metrics.text_tokens.value(kind="padded")
+        return {
+            "model": self.model_name,
+            "backend": self.backend_name,
+            "quantization": self.quantization_report,
+            "queue_depth": self.request_queue.qsize(),
+            "queued_inputs": self._queued_inputs,
+            "max_queue_depth": self.max_queue_depth,
+            "pipeline": {
+                "depth": self.pipeline_depth,
+                "batches_in_flight": len(self._batch_tasks),
+                "stages": self.pipeline_stats.stats(),
+            },
+            "batching": (
+                self.batch_controller.stats()
+                if self.batch_controller is not None
+                else {"max_batch_size": self.max_batch_size, "timeout_ms": self.batch_timeout_ms}
+            ),
+            "text_batching": {
+                "length_buckets": self.text_length_buckets.tolist(),
+                "padding_efficiency": real_tokens / padded_tokens if padded_tokens else None,
+            },
+            "cache": self.cache.stats(),
+            "disk_cache": self.disk_cache.stats() if self.disk_cache is not None else None,
+            "replicas": self.replica_pool.stats() if self.replica_pool is not None else None,
+            "collections": {name: index.stats() for name, index in self.collections.items()},
+            "classification": {
+                "logit_scale": self.logit_scale,
+                "cached_label_lists": len(self._label_matrices),
+            },
+            "text_sets": {
+                name: {
+                    "entries": len(text_set.entries),
+                    "templates": len(text_set.templates or ()),
+                    "persisted": text_set.persisted,
+                }
+                for name, text_set in self.text_sets.items()
+            },
+        }
 
 
 # Global variables to hold the model and configuration
 clip_server = None
-server_config = {"max_batch_size": 8, "batch_timeout_ms": 2}
+server_config = {
+    "model_name": "laion/CLIP-ViT-B-32-laion2B-s34B-b79K",
+    "max_batch_size": 8,
+    "batch_timeout_ms": 2,
+    "cache_max_entries": 100_000,
+    "cache_max_bytes": 256 * 1024 * 1024,
+    "disk_cache_dir": None,
+    "disk_cache_max_rows": 1_000_000,
+    "preprocess_workers": 4,
+    "preprocess_pool": "thread",
+    "pipeline_depth": 2,
+    "adaptive_batching": False,
+    "latency_target_ms": 50.0,
+    "replicas": 0,
+    "threads_per_replica": None,
+    "quantize": None,
+    "backend": "eager",
+    "export_dir": "data/clip_exports",
+    "backend_options": None,
+    "max_queue_depth": 1024,
+    "text_length_buckets": (16, 32),
+    "reduced_image_decode": False,
+    "text_set_dir": None,
+}
+
+
+def _negotiate_binary_dtype(request) -> np.dtype | None:
+    """Return the dtype for a binary response if the client accepts one, otherwise None (JSON)."""
+    for media_range in request.headers.get("accept", "").split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        if media_type.lower() != BINARY_MEDIA_TYPE:
+            continue
+        dtype_name = "float32"
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "dtype":
+                dtype_name = value.strip().strip('"').lower()
+        # Unsupported dtypes are simply not acceptable, so fall through to JSON
+        if dtype_name in BINARY_DTYPES:
+            return BINARY_DTYPES[dtype_name]
+    return None
+
+
+def encode_embeddings_binary(embeddings: np.ndarray, dtype: np.dtype = BINARY_DTYPES["float32"]) -> memoryview:
+    """Encode a (rows, dim) embedding matrix as a shape header followed by the raw buffer."""
+    rows, dim = embeddings.shape
+    body = bytearray(BINARY_HEADER.size + rows * dim * dtype.itemsize)
+    BINARY_HEADER.pack_into(body, 0, BINARY_MAGIC, BINARY_VERSION, dtype.itemsize, rows, dim)
+    # Cast straight into the response buffer, without going through Python floats
+    out = np.frombuffer(body, dtype=dtype, offset=BINARY_HEADER.size).reshape(rows, dim)
+    np.copyto(out, embeddings, casting="same_kind")
+    return memoryview(body)
+
+
+def decode_embeddings_binary(body: bytes) -> np.ndarray:
+    """Decode a binary embedding response back into a (rows, dim) float array."""
+    magic, version, itemsize, rows, dim = BINARY_HEADER.unpack_from(body, 0)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError("Not a binary embedding payload")
+    dtype = BINARY_DTYPES["float32"] if itemsize == 4 else BINARY_DTYPES["float16"]
+    return np.frombuffer(body, dtype=dtype, count=rows * dim, offset=BINARY_HEADER.size).reshape(rows, dim)
+
+
+def decode_embedding_frames(body: bytes) -> Iterator[np.ndarray]:
+    """Decode a streamed binary bulk response into its chunks of embeddings."""
+    position = 0
+    while position < len(body):
+        (length,) = FRAME_LENGTH.unpack_from(body, position)
+        frame = body[position + FRAME_LENGTH.size : position + FRAME_LENGTH.size + length]
+        if frame.startswith(STREAM_ERROR_MAGIC):
+            raise Exception(frame[len(STREAM_ERROR_MAGIC) :].decode())
+        yield decode_embeddings_binary(frame)
+        position += FRAME_LENGTH.size + length
+
+
+def _request_deadline(request) -> float | None:
+    """The request's deadline as a time.perf_counter() value, from the optional timeout header."""
+    timeout_ms = request.headers.get(DEADLINE_HEADER)
+    if timeout_ms is None:
+        return None
+    try:
+        milliseconds = float(timeout_ms)
+    except ValueError:
+        milliseconds = math.nan
+    # "nan" parses, but would compare false against every clock reading and so never expire
+    if not math.isfinite(milliseconds) or milliseconds < 0:
+        raise InvalidRequestError(f"{DEADLINE_HEADER} must be a finite number of milliseconds >= 0, got {timeout_ms!r}")
+    return time.perf_counter() + milliseconds / 1000.0
+
+
+async def _wait_for_disconnect(request):
+    """Return once the client has disconnected. Only call after the request body has been read."""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _unless_disconnected(request, awaitable):
+    """Await `awaitable`, cancelling it (and with it any queued batch requests) if the client disconnects."""
+    work = asyncio.ensure_future(awaitable)
+    watcher = asyncio.create_task(_wait_for_disconnect(request))
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not work.done():
+            work.cancel()
+    if not work.done():
+        raise ClientDisconnectedError("Client disconnected")
+    return work.result()
+
+
+def _error_response(e: Exception, endpoint: str) -> Response:
+    """Map an embedding failure to a response: shed load is 503 or 504, anything else 500."""
+    if isinstance(e, ClientDisconnectedError):
+        # Nobody reads this; 499 (as nginx uses) keeps abandoned requests apart in clip_requests_total
+        return Response(status_code=499)
+    if isinstance(e, QueueFullError):
+        # Shedding is expected under overload; it is counted in clip_rejected_total rather than logged
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": str(e.retry_after)})
+    if isinstance(e, DeadlineExceededError):
+        return JSONResponse({"error": str(e)}, status_code=504)
+    if isinstance(e, (CollectionNotFoundError, TextSetNotFoundError)):
+        return JSONResponse({"error": str(e)}, status_code=404)
+    if isinstance(e, (InvalidRequestError, json.JSONDecodeError)):
+        # The client's mistake, not a server fault: kept out of the log and of clip_errors_total
+        return JSONResponse({"error": str(e)}, status_code=400)
+    LOGGER.error(f"Error in {endpoint}: {str(e)}")
+    clip_server.metrics.errors.inc(source="endpoint")
+    return JSONResponse({"error": str(e)}, status_code=500)
+
+
+def _wants_stream(request) -> bool:
+    """Whether a bulk request asked for a streaming response."""
+    if request.query_params.get("stream", "").lower() in ("1", "true", "yes"):
+        return True
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "").lower()
+
+
+def _check_bulk_inputs(payloads: list, request_type: str):
+    """Reject an empty bulk request before a response mode is chosen, so streaming fails like the plain response."""
+    if not payloads:
+        raise InvalidRequestError(f"No {request_type}s to embed")
+
+
+def _check_vectors(vectors: np.ndarray, dim: int):
+    """Reject vectors sent for a collection that are not a (count, dim) matrix."""
+    if vectors.ndim != 2 or vectors.shape[1] != dim:
+        raise InvalidRequestError(f"Expected {dim}-dimensional vectors, got an array of shape {vectors.shape}")
+
+
+def _json_rows(embeddings: np.ndarray, errors: dict[int, str], offset: int = 0) -> dict:
+    """Embedding rows as lists, with failed rows as null and listed under "errors" by absolute index."""
+    rows = embeddings.tolist()
+    if not errors:
+        return {"embeddings": rows}
+    for row in errors:
+        rows[row] = None
+    return {
+        "embeddings": rows,
+        "errors": [{"index": offset + row, "error": error} for row, error in sorted(errors.items())],
+    }
+
+
+def _embeddings_stream_response(
+    request, chunks: AsyncIterator[tuple[int, np.ndarray, dict[int, str]]]
+) -> StreamingResponse:
+    """Stream chunks of embeddings as NDJSON lines or length-prefixed binary frames as they are computed."""
+    dtype = _negotiate_binary_dtype(request)
+
+    async def ndjson_lines():
+        try:
+            async for offset, embeddings, errors in chunks:
+                serialize_start = time.perf_counter()
+                line = json.dumps({"offset": offset, **_json_rows(embeddings, errors, offset)}) + "\n"
+                clip_server.record_serialize(time.perf_counter() - serialize_start)
+                yield line
+        except Exception as e:
+            # The status line is already sent, so report the failure in-band
+            LOGGER.error(f"Error in embedding stream: {str(e)}")
+            clip_server.metrics.errors.inc(source="stream")
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    async def binary_frames():
+        try:
+            async for _, embeddings, _ in chunks:
+                serialize_start = time.perf_counter()
+                frame = encode_embeddings_binary(embeddings, dtype)
+                clip_server.record_serialize(time.perf_counter() - serialize_start)
+                yield FRAME_LENGTH.pack(len(frame))
+                yield frame
+        except Exception as e:
+            LOGGER.error(f"Error in embedding stream: {str(e)}")
+            clip_server.metrics.errors.inc(source="stream")
+            message = STREAM_ERROR_MAGIC + str(e).encode()
+            yield FRAME_LENGTH.pack(len(message)) + message
+
+    if dtype is not None:
+        return StreamingResponse(binary_frames(), media_type=BINARY_MEDIA_TYPE)
+    return StreamingResponse(ndjson_lines(), media_type=NDJSON_MEDIA_TYPE)
+
+
+def _embeddings_response(request, embeddings: np.ndarray, key: str, errors: dict[int, str] | None = None) -> Response:
+    """Serialize embeddings as JSON under `key`, or as a binary matrix if the client asked for it."""
+    serialize_start = time.perf_counter()
+    dtype = _negotiate_binary_dtype(request)
+    if dtype is not None:
+        matrix = embeddings.reshape(1, -1) if embeddings.ndim == 1 else embeddings
+        response = Response(encode_embeddings_binary(matrix, dtype), media_type=BINARY_MEDIA_TYPE)
+    elif errors:
+        body = _json_rows(embeddings, errors)
+        response = JSONResponse({key: body["embeddings"], "errors": body["errors"]})
+    else:
+        response = JSONResponse({key: embeddings.tolist()})
+    clip_server.record_serialize(time.perf_counter() - serialize_start)
+    return response
 
 
 async def startup_event():
@@ -188,38 +1294,123 @@ async def startup_event():
     global clip_server, server_config
 
     clip_server = CLIPEmbeddingServer(
-        max_batch_size=server_config["max_batch_size"], batch_timeout_ms=server_config["batch_timeout_ms"]
+        model_name=server_config["model_name"],
+        max_batch_size=server_config["max_batch_size"],
+        batch_timeout_ms=server_config["batch_timeout_ms"],
+        cache_max_entries=server_config["cache_max_entries"],
+        cache_max_bytes=server_config["cache_max_bytes"],
+        disk_cache_dir=server_config["disk_cache_dir"],
+        disk_cache_max_rows=server_config["disk_cache_max_rows"],
+        preprocess_workers=server_config["preprocess_workers"],
+        preprocess_pool=server_config["preprocess_pool"],
+        pipeline_depth=server_config["pipeline_depth"],
+        adaptive_batching=server_config["adaptive_batching"],
+        latency_target_ms=server_config["latency_target_ms"],
+        replicas=server_config["replicas"],
+        threads_per_replica=server_config["threads_per_replica"],
+        quantize=server_config["quantize"],
+        backend=server_config["backend"],
+        export_dir=server_config["export_dir"],
+        backend_options=server_config["backend_options"],
+        max_queue_depth=server_config["max_queue_depth"],
+        text_length_buckets=server_config["text_length_buckets"],
+        reduced_image_decode=server_config["reduced_image_decode"],
+        text_set_dir=server_config["text_set_dir"],
     )
     clip_server.start_processing()
     LOGGER.info("CLIP server initialized and batch processing started")
 
 
+async def shutdown_event():
+    """Stop batch processing and flush caches on server shutdown."""
+    if clip_server is not None:
+        clip_server.stop_processing()
+
+
 async def health_check(request):
     """Health check endpoint."""
     return JSONResponse({"status": "healthy", "model": clip_server.model_name if clip_server else None})
 
 
+async def stats_endpoint(request):
+    """Runtime statistics (cache counters, queue depth)."""
+    return JSONResponse(clip_server.stats())
+
+
+async def metrics_endpoint(request):
+    """Prometheus metrics in the text exposition format."""
+    return Response(clip_server.metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+
+async def _read_image_uploads(request) -> tuple[list[bytes], bool]:
+    """Read the uploaded image(s) of a request as raw bytes.
+
+    Accepts a raw body (`application/octet-stream` or `image/*`), `multipart/form-data` with one
+    or more file parts, or a JSON body with a base64-encoded `image` or a list of them in `images`.
+    Returns the image bytes and whether the client sent a list of images.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+
+    if content_type == "multipart/form-data":
+        async with request.form() as form:
+            uploads = [value for _, value in form.multi_items() if isinstance(value, UploadFile)]
+            if not uploads:
+                raise InvalidRequestError("multipart request contains no image files")
+            return [await upload.read() for upload in uploads], True
+
+    if content_type == BINARY_MEDIA_TYPE or content_type.startswith("image/"):
+        return [await request.body()], False
+
+    # JSON body with base64 images
+    data = await request.json()
+    if "images" in data:
+        return [base64.b64decode(image) for image in data["images"]], True
+    if "image" not in data:
+        raise InvalidRequestError("Expected an 'image' or 'images' field")
+    return [base64.b64decode(data["image"])], False
+
+
 async def embed_image_endpoint(request):
-    """Endpoint to embed an image."""
+    """Endpoint to embed an image (raw body, multipart upload of many images, or base64 JSON)."""
     try:
-        data = await request.json()
+        image_blobs, is_list = await _read_image_uploads(request)
 
-        # Decode base64 image
-        image_data = base64.b64decode(data["image"])
-        image = Image.open(io.BytesIO(image_data))
-
-        # Convert to RGB if necessary
-        if image.mode != "RGB":
-            image = image.convert("RGB")
+        if is_list:
+            # Generate embeddings through the batching queue, in chunks of at most max_batch_size
+            embeddings, errors = await _unless_disconnected(
+                request, clip_server.embed_images_async(image_blobs, _request_deadline(request))
+            )
+            return _embeddings_response(request, embeddings, "embeddings", errors)
 
         # Generate embedding using batched async method
-        embedding = await clip_server.embed_image_async(image)
+        embedding = await _unless_disconnected(
+            request, clip_server.embed_image_async(image_blobs[0], _request_deadline(request))
+        )
+        return _embeddings_response(request, embedding, "embedding")
+
+    except Exception as e:
+        return _error_response(e, "embed_image")
+
+
+async def embed_images_batch_endpoint(request):
+    """Endpoint to embed multiple images (multipart upload or JSON `images` list of base64 strings)."""
+    try:
+        image_blobs, _ = await _read_image_uploads(request)
+        _check_bulk_inputs(image_blobs, "image")
+
+        if _wants_stream(request):
+            chunks = clip_server.iter_image_embeddings(image_blobs, _request_deadline(request))
+            return _embeddings_stream_response(request, chunks)
+
+        # Generate embeddings through the batching queue, in chunks of at most max_batch_size
+        embeddings, errors = await _unless_disconnected(
+            request, clip_server.embed_images_async(image_blobs, _request_deadline(request))
+        )
 
-        return JSONResponse({"embedding": embedding})
+        return _embeddings_response(request, embeddings, "embeddings", errors)
 
     except Exception as e:
-        LOGGER.error(f"Error in embed_image: {str(e)}")
-        return JSONResponse({"error": str(e)}, status_code=500)
+        return _error_response(e, "embed_images_batch")
 
 
 async def embed_text_endpoint(request):
@@ -229,13 +1420,12 @@ async def embed_text_endpoint(request):
         text = data["text"]
 
         # Generate embedding using batched async method
-        embedding = await clip_server.embed_text_async(text)
+        embedding = await _unless_disconnected(request, clip_server.embed_text_async(text, _request_deadline(request)))
 
-        return JSONResponse({"embedding": embedding})
+        return _embeddings_response(request, embedding, "embedding")
 
     except Exception as e:
-        LOGGER.error(f"Error in embed_text: {str(e)}")
-        return JSONResponse({"error": str(e)}, status_code=500)
+        return _error_response(e, "embed_text")
 
 
 async def embed_texts_batch_endpoint(request):
@@ -243,43 +1433,391 @@ async def embed_texts_batch_endpoint(request):
     try:
         data = await request.json()
         texts = data["texts"]
+        _check_bulk_inputs(texts, "text")
+
+        if _wants_stream(request):
+            chunks = clip_server.iter_text_embeddings(texts, _request_deadline(request))
+            return _embeddings_stream_response(request, chunks)
+
+        # Generate embeddings through the batching queue, in chunks of at most max_batch_size
+        embeddings, errors = await _unless_disconnected(
+            request, clip_server.embed_texts_async(texts, _request_deadline(request))
+        )
+
+        return _embeddings_response(request, embeddings, "embeddings", errors)
+
+    except Exception as e:
+        return _error_response(e, "embed_texts_batch")
+
+
+async def _query_vectors(request, data: dict) -> np.ndarray:
+    """Vectors given as `vectors` or by `text_set` name, or embedded from `texts` or base64 `images`."""
+    if "vectors" in data:
+        return np.asarray(data["vectors"], dtype=np.float32)
+    if "text_set" in data:
+        return clip_server.text_set(data["text_set"]).embeddings
+    if "texts" in data:
+        embed = clip_server.embed_texts_async(data["texts"], _request_deadline(request))
+    elif "images" in data:
+        embed = clip_server.embed_images_async(
+            [base64.b64decode(image) for image in data["images"]], _request_deadline(request)
+        )
+    else:
+        raise InvalidRequestError("Expected 'vectors', 'text_set', 'texts' or 'images'")
+    embeddings, errors = await _unless_disconnected(request, embed)
+    if errors:
+        index, error = min(errors.items())
+        raise ValueError(f"Could not embed input {index}: {error}")
+    return embeddings
+
+
+async def list_collections_endpoint(request):
+    """Endpoint listing the vector collections and their sizes."""
+    return JSONResponse({name: index.stats() for name, index in clip_server.collections.items()})
+
+
+async def create_collection_endpoint(request):
+    """Endpoint creating an empty collection with a chosen index kind and options."""
+    try:
+        data = await request.json()
+        kind = data.get("index", "flat")
+        # Options of other index kinds are ignored rather than passed to a constructor that rejects them
+        options = {key: int(data[key]) for key in INDEX_OPTIONS.get(kind, ()) if key in data}
+        index = clip_server.create_collection(data["collection"], kind, **options)
+        return JSONResponse({"collection": data["collection"], **index.stats()})
+
+    except Exception as e:
+        return _error_response(e, "create_collection")
+
+
+async def add_to_collection_endpoint(request):
+    """Endpoint adding vectors (given, or embedded from texts or images) under ids to a collection."""
+    try:
+        data = await request.json()
+        vectors = await _query_vectors(request, data)
+        size = await clip_server.add_to_collection(data["collection"], [str(i) for i in data["ids"]], vectors)
+        return JSONResponse({"collection": data["collection"], "added": len(data["ids"]), "size": size})
+
+    except Exception as e:
+        return _error_response(e, "add_to_collection")
+
 
-        # Generate embeddings using the internal batch method
-        embeddings = clip_server._embed_texts_batch(texts)
+async def drop_collection_endpoint(request):
+    """Endpoint deleting a collection."""
+    try:
+        data = await request.json()
+        clip_server.drop_collection(data["collection"])
+        return JSONResponse({"collection": data["collection"], "dropped": True})
+
+    except Exception as e:
+        return _error_response(e, "drop_collection")
 
-        return JSONResponse({"embeddings": embeddings})
+
+async def search_endpoint(request):
+    """Endpoint returning the top-k ids and cosine scores in a collection for one or many queries."""
+    try:
+        data = await request.json()
+        queries = await _query_vectors(request, data)
+        nprobe = int(data["nprobe"]) if "nprobe" in data else None
+        results = await clip_server.search_collection(data["collection"], queries, int(data.get("k", 10)), nprobe)
+        return JSONResponse(
+            {"results": [[{"id": vector_id, "score": score} for vector_id, score in hits] for hits in results]}
+        )
 
     except Exception as e:
-        LOGGER.error(f"Error in embed_texts_batch: {str(e)}")
-        return JSONResponse({"error": str(e)}, status_code=500)
+        return _error_response(e, "search")
+
+
+async def list_text_sets_endpoint(request):
+    """Endpoint listing the registered text sets with their entries and templates."""
+    return JSONResponse(
+        {
+            name: {"entries": text_set.entries, "templates": text_set.templates, "persisted": text_set.persisted}
+            for name, text_set in clip_server.text_sets.items()
+        }
+    )
+
+
+async def register_text_set_endpoint(request):
+    """Endpoint embedding a set of texts (or labels and prompt templates) once and registering it under a name."""
+    try:
+        data = await request.json()
+        name = str(data["text_set"])
+        entries = [str(entry) for entry in data["texts"]]
+        templates = [str(template) for template in data["templates"]] if data.get("templates") else None
+        text_set = await clip_server.register_text_set(name, entries, templates, bool(data.get("persist", False)))
+        return JSONResponse(
+            {
+                "text_set": name,
+                "entries": len(text_set.entries),
+                "templates": len(text_set.templates or ()),
+                "persisted": text_set.persisted,
+            }
+        )
+
+    except Exception as e:
+        return _error_response(e, "register_text_set")
+
+
+async def list_label_sets_endpoint(request):
+    """Endpoint listing the registered text sets as label sets: each name with its labels."""
+    return JSONResponse({name: text_set.entries for name, text_set in clip_server.text_sets.items()})
+
+
+async def register_label_set_endpoint(request):
+    """Endpoint registering a list of labels under a name; a label set is a text set without templates."""
+    try:
+        data = await request.json()
+        name = str(data["label_set"])
+        text_set = await clip_server.register_text_set(name, [str(label) for label in data["labels"]])
+        return JSONResponse({"label_set": name, "labels": len(text_set.entries)})
+
+    except Exception as e:
+        return _error_response(e, "register_label_set")
+
+
+async def drop_text_set_endpoint(request):
+    """Endpoint deleting a text set, and its file if it was persisted."""
+    try:
+        data = await request.json()
+        await clip_server.drop_text_set(data["text_set"])
+        return JSONResponse({"text_set": data["text_set"], "dropped": True})
+
+    except Exception as e:
+        return _error_response(e, "drop_text_set")
+
+
+async def _classify_options(request) -> dict:
+    """The options of a /classify request: its JSON body, or its form fields and query parameters.
+
+    With an image upload (raw body or multipart), labels are given as repeated `labels` fields or
+    parameters, and `k`, `text_set` or `label_set` as single ones.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    multipart = content_type == "multipart/form-data"
+    if not (multipart or content_type == BINARY_MEDIA_TYPE or content_type.startswith("image/")):
+        return await request.json()
+    fields = list(request.query_params.multi_items())
+    if multipart:
+        # The parsed form is cached on the request, for _read_image_uploads to take the files from
+        form = await request.form()
+        fields += [(key, value) for key, value in form.multi_items() if isinstance(value, str)]
+    options = {key: value for key, value in fields if key != "labels"}
+    labels = [value for key, value in fields if key == "labels"]
+    if labels:
+        options["labels"] = labels
+    return options
+
+
+async def classify_endpoint(request):
+    """Endpoint returning the top-k labels and probabilities of each image against a list or set of labels."""
+    try:
+        data = await _classify_options(request)
+        images, _ = await _read_image_uploads(request)
+        # "label_set" is the older name of "text_set"
+        name = data.get("text_set", data.get("label_set"))
+        if name is not None:
+            labels = clip_server.text_set(name)
+        elif "labels" in data:
+            labels = [str(label) for label in data["labels"]]
+        else:
+            raise InvalidRequestError("Expected 'labels', 'text_set' or 'label_set'")
+        k = int(data.get("k", 5))
+        if k < 1:
+            raise InvalidRequestError(f"k must be at least 1, got {k}")
+        k = min(k, len(labels.entries if isinstance(labels, TextSet) else labels))
+        results, errors = await _unless_disconnected(
+            request, clip_server.classify(images, labels, k, _request_deadline(request))
+        )
+        body = {
+            "results": [
+                None if row in errors else [{"label": label, "score": score} for label, score in hits]
+                for row, hits in enumerate(results)
+            ]
+        }
+        if errors:
+            body["errors"] = [{"index": row, "error": error} for row, error in sorted(errors.items())]
+        return JSONResponse(body)
+
+    except Exception as e:
+        return _error_response(e, "classify")
 
 
 # Create the Starlette app
+routes = [
+    Route("/health", health_check, methods=["GET"]),
+    Route("/stats", stats_endpoint, methods=["GET"]),
+    Route("/metrics", metrics_endpoint, methods=["GET"]),
+    Route("/embed_image", embed_image_endpoint, methods=["POST"]),
+    Route("/embed_text", embed_text_endpoint, methods=["POST"]),
+    Route("/embed_texts_batch", embed_texts_batch_endpoint, methods=["POST"]),
+    Route("/embed_images_batch", embed_images_batch_endpoint, methods=["POST"]),
+    Route("/collections", list_collections_endpoint, methods=["GET"]),
+    Route("/collections/create", create_collection_endpoint, methods=["POST"]),
+    Route("/collections/add", add_to_collection_endpoint, methods=["POST"]),
+    Route("/collections/drop", drop_collection_endpoint, methods=["POST"]),
+    Route("/search", search_endpoint, methods=["POST"]),
+    Route("/text_sets", list_text_sets_endpoint, methods=["GET"]),
+    Route("/text_sets", register_text_set_endpoint, methods=["POST"]),
+    Route("/text_sets/drop", drop_text_set_endpoint, methods=["POST"]),
+    Route("/label_sets", list_label_sets_endpoint, methods=["GET"]),
+    Route("/label_sets", register_label_set_endpoint, methods=["POST"]),
+    Route("/classify", classify_endpoint, methods=["POST"]),
+]
 app = Starlette(
     debug=False,
-    routes=[
-        Route("/health", health_check, methods=["GET"]),
-        Route("/embed_image", embed_image_endpoint, methods=["POST"]),
-        Route("/embed_text", embed_text_endpoint, methods=["POST"]),
-        Route("/embed_texts_batch", embed_texts_batch_endpoint, methods=["POST"]),
+    routes=routes,
+    middleware=[
+        Middleware(
+            MetricsMiddleware,
+            get_metrics=lambda: clip_server.metrics if clip_server is not None else None,
+            endpoints=[route.path for route in routes],
+        )
     ],
     on_startup=[startup_event],
+    on_shutdown=[shutdown_event],
 )
 
 
 if __name__ == "__main__":
     # Parse command line arguments
     parser = argparse.ArgumentParser(description="CLIP embedding server with dynamic batching")
+    parser.add_argument(
+        "--model", type=str, default="laion/CLIP-ViT-B-32-laion2B-s34B-b79K", help="Model name or local path"
+    )
     parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum batch size for processing (default: 8)")
     parser.add_argument("--batch-timeout-ms", type=int, default=2, help="Batch timeout in milliseconds (default: 2)")
+    parser.add_argument(
+        "--cache-entries", type=int, default=100_000, help="Max embeddings in the in-memory cache, 0 disables it"
+    )
+    parser.add_argument("--cache-max-mb", type=int, default=256, help="Max size of the in-memory cache in MB")
+    parser.add_argument(
+        "--disk-cache-dir", type=str, default=None, help="Directory for a persistent on-disk embedding cache"
+    )
+    parser.add_argument(
+        "--disk-cache-max-rows", type=int, default=1_000_000, help="Max embeddings in the on-disk cache"
+    )
+    parser.add_argument(
+        "--preprocess-workers", type=int, default=4, help="Workers decoding and preprocessing images (default: 4)"
+    )
+    parser.add_argument(
+        "--preprocess-pool",
+        type=str,
+        default="thread",
+        choices=["thread", "process"],
+        help="Run image preprocessing in a thread or a process pool (default: thread)",
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        type=int,
+        default=2,
+        help="Max batches in flight; >1 overlaps batch collection with the forward pass (default: 2)",
+    )
+    parser.add_argument(
+        "--adaptive-batching",
+        action="store_true",
+        help="Tune batch size and timeout from live traffic, using the two flags above as upper bounds",
+    )
+    parser.add_argument(
+        "--latency-target-ms", type=float, default=50.0, help="p99 latency target for adaptive batching (default: 50)"
+    )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=0,
+        help="Run the model in this many worker processes pinned to disjoint CPU cores (default: 0, in-process)",
+    )
+    parser.add_argument(
+        "--threads-per-replica",
+        type=int,
+        default=None,
+        help="Torch threads per replica (default: the number of cores pinned to it)",
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["int8"],
+        help="Dynamically quantize the model's linear layers (CPU only); drift from fp32 is checked on load",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="eager",
+        choices=["eager", "torchscript", "onnx", "synthetic"],
+        help="Run the model eagerly or through a graph exported once and cached on disk, or use the "
+        "deterministic synthetic backend that needs no model (default: eager)",
+    )
+    parser.add_argument(
+        "--export-dir",
+        type=str,
+        default="data/clip_exports",
+        help="Cache directory for exported TorchScript/ONNX models (default: data/clip_exports)",
+    )
+    parser.add_argument("--synthetic-dim", type=int, default=512, help="Synthetic backend embedding size")
+    parser.add_argument(
+        "--synthetic-latency-ms", type=float, default=0.0, help="Synthetic backend sleep per batch (default: 0)"
+    )
+    parser.add_argument(
+        "--synthetic-per-item-ms", type=float, default=0.0, help="Synthetic backend sleep per input (default: 0)"
+    )
+    parser.add_argument(
+        "--max-queue-depth",
+        type=int,
+        default=1024,
+        help="Max inputs waiting for the model before requests get 503 and Retry-After, 0 for no limit (default: 1024)",
+    )
+    parser.add_argument(
+        "--text-length-buckets",
+        type=str,
+        default="16,32",
+        help="Token-count bounds splitting a text batch into forward passes of similar length, '' for one pass "
+        "(default: 16,32)",
+    )
+    parser.add_argument(
+        "--reduced-image-decode",
+        action="store_true",
+        help="Decode large JPEGs at a reduced scale close to the model's input size (default: off, full decode)",
+    )
+    parser.add_argument(
+        "--text-set-dir",
+        type=str,
+        default=None,
+        help="Directory where text sets registered with persist=true are saved and reloaded from (default: none)",
+    )
     parser.add_argument("--host", type=str, default="0.0.0.0", help="Host to bind to (default: 0.0.0.0)")
     parser.add_argument("--port", type=int, default=8000, help="Port to bind to (default: 8000)")
 
     args = parser.parse_args()
 
     # Set server configuration
+    server_config["model_name"] = args.model
     server_config["max_batch_size"] = args.max_batch_size
     server_config["batch_timeout_ms"] = args.batch_timeout_ms
+    server_config["cache_max_entries"] = args.cache_entries
+    server_config["cache_max_bytes"] = args.cache_max_mb * 1024 * 1024
+    server_config["disk_cache_dir"] = args.disk_cache_dir
+    server_config["disk_cache_max_rows"] = args.disk_cache_max_rows
+    server_config["preprocess_workers"] = args.preprocess_workers
+    server_config["preprocess_pool"] = args.preprocess_pool
+    server_config["pipeline_depth"] = args.pipeline_depth
+    server_config["adaptive_batching"] = args.adaptive_batching
+    server_config["latency_target_ms"] = args.latency_target_ms
+    server_config["replicas"] = args.replicas
+    server_config["threads_per_replica"] = args.threads_per_replica
+    server_config["quantize"] = args.quantize
+    server_config["backend"] = args.backend
+    server_config["export_dir"] = args.export_dir
+    server_config["max_queue_depth"] = args.max_queue_depth
+    server_config["reduced_image_decode"] = args.reduced_image_decode
+    server_config["text_set_dir"] = args.text_set_dir
+    server_config["text_length_buckets"] = tuple(int(bound) for bound in args.text_length_buckets.split(",") if bound)
+    if args.backend == "synthetic":
+        server_config["backend_options"] = {
+            "dim": args.synthetic_dim,
+            "latency_ms": args.synthetic_latency_ms,
+            "per_item_latency_ms": args.synthetic_per_item_ms,
+        }
 
     # Set up logging
     logging.basicConfig(
@@ -0,0 +1,67 @@
+import numpy as np
+
+from src.clip_cache import DiskEmbeddingCache, EmbeddingLRUCache, embedding_cache_key
+
+
+def key(value: int) -> bytes:
+    return embedding_cache_key("model", "text", str(value).encode())
+
+
+def vector(value: float, dim: int = 8) -> np.ndarray:
+    return np.full(dim, value, dtype=np.float32)
+
+
+def test_disk_cache_survives_reopen(tmp_path):
+    cache = DiskEmbeddingCache(tmp_path, dim=8, max_rows=10)
+    cache.put_many([key(0), key(1)], [vector(0.0), vector(1.0)])
+    cache.close()
+
+    cache = DiskEmbeddingCache(tmp_path, dim=8, max_rows=10)
+    found = cache.get_many([key(0), key(1), key(2)])
+
+    np.testing.assert_array_equal(found[0], vector(0.0))
+    np.testing.assert_array_equal(found[1], vector(1.0))
+    assert found[2] is None
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (2, 1)
+    assert cache.stats()["entries"] == 2
+    cache.close()
+
+
+def test_disk_cache_recycles_least_recently_used_row(tmp_path):
+    cache = DiskEmbeddingCache(tmp_path, dim=8, max_rows=3)
+    for value in range(3):
+        cache.put(key(value), vector(value))
+    assert cache.get(key(0)) is not None  # key 1 is now the least recently used
+
+    cache.put(key(3), vector(3.0))
+
+    assert cache.get(key(1)) is None
+    for value in (0, 2, 3):
+        np.testing.assert_array_equal(cache.get(key(value)), vector(value))
+    assert cache.stats()["entries"] == 3
+    assert cache.stats()["evictions"] == 1
+    cache.close()
+
+
+def test_disk_cache_batch_larger_than_capacity_keeps_the_latest(tmp_path):
+    cache = DiskEmbeddingCache(tmp_path, dim=8, max_rows=2)
+    cache.put_many([key(value) for value in range(4)], [vector(value) for value in range(4)])
+
+    found = cache.get_many([key(value) for value in range(4)])
+
+    assert found[0] is None and found[1] is None
+    np.testing.assert_array_equal(found[2], vector(2.0))
+    np.testing.assert_array_equal(found[3], vector(3.0))
+    cache.close()
+
+
+def test_lru_cache_evicts_by_entry_count():
+    cache = EmbeddingLRUCache(max_entries=2)
+    cache.put(key(0), vector(0.0))
+    cache.put(key(1), vector(1.0))
+    cache.get(key(0))
+    cache.put(key(2), vector(2.0))
+
+    assert cache.get(key(1)) is None
+    assert cache.get(key(0)) is not None and cache.get(key(2)) is not None
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from src.clip_index import FlatIndex, IVFIndex, PQIndex, ProductQuantizer, create_index, normalize_rows
+
+
+def random_vectors(count: int, dim: int, seed: int = 0) -> np.ndarray:
+    return normalize_rows(np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32))
+
+
+def test_flat_search_matches_brute_force():
+    vectors, queries = random_vectors(500, 32), random_vectors(20, 32, seed=1)
+    index = FlatIndex(32, chunk_bytes=4096)  # small chunks, so the search spans several blocks
+    index.add([f"v{row}" for row in range(len(vectors))], vectors)
+
+    rows, scores = index.search_rows(queries, 5)
+
+    expected = np.argsort(-(queries @ vectors.T), axis=1, kind="stable")[:, :5]
+    np.testing.assert_array_equal(rows, expected)
+    np.testing.assert_allclose(scores, np.take_along_axis(queries @ vectors.T, expected, axis=1), rtol=1e-5)
+
+
+def test_ivf_recall_is_exact_when_every_list_is_probed():
+    vectors, queries = random_vectors(2000, 32), random_vectors(50, 32, seed=1)
+    ids = [str(row) for row in range(len(vectors))]
+    flat, ivf = FlatIndex(32), IVFIndex(32, nlist=16, nprobe=1, train_size=400)
+    flat.add(ids, vectors)
+    for start in range(0, len(ids), 500):
+        ivf.add(ids[start : start + 500], vectors[start : start + 500])
+    assert ivf.trained
+
+    truth, _ = flat.search_rows(queries, 10)
+    found, _ = ivf.search_rows(queries, 10, nprobe=16)
+
+    assert all(set(row) == set(true_row) for row, true_row in zip(found, truth))
+
+
+def test_ivf_nprobe_is_clamped_to_nlist():
+    assert IVFIndex(32, nlist=4).stats()["nprobe"] == 4
+
+
+@pytest.mark.parametrize(
+    "kind, options", [("ivf", {"nlist": 8, "train_size": 300}), ("pq", {"m": 8, "train_size": 300})]
+)
+def test_upsert_after_training_keeps_one_entry_per_id(kind, options):
+    vectors = random_vectors(600, 32)
+    index = create_index(kind, 32, **options)
+    index.add([str(row) for row in range(400)], vectors[:400])
+    assert index.trained
+
+    # Replace ids both inside and past the training batch, repeating one within the same add
+    index.add(["5", "350", "5", "599"], vectors[[100, 101, 102, 599]])
+
+    assert len(index) == 401
+    assert sorted(index.ids, key=int) == [str(row) for row in range(400)] + ["599"]
+    assert index.stats()["size"] == 401
+    if kind == "ivf":
+        assert sum(inverted_list.size for inverted_list in index.lists) == 401
+    best = [hits[0][0] for hits in index.search(vectors[[102, 101]], 1, nprobe=8)]
+    assert best == ["5", "350"]
+
+
+def test_failed_training_leaves_index_unchanged():
+    vectors = random_vectors(400, 32)
+    index = IVFIndex(32, nlist=8, train_size=300)
+    index.add([str(row) for row in range(200)], vectors[:200])
+
+    def fail(vectors):
+        raise RuntimeError("k-means failed")
+
+    index._fit = fail
+    with pytest.raises(RuntimeError):
+        index.add([str(row) for row in range(200, 400)], vectors[200:])
+
+    assert len(index) == 200 and not index.trained
+    del index._fit
+    index.add([str(row) for row in range(200, 400)], vectors[200:])
+    assert len(index) == 400 and index.trained
+
+
+def test_pq_lookup_table_scores_equal_decoded_dot_products():
+    vectors, queries = random_vectors(1000, 32), random_vectors(8, 32, seed=1)
+    quantizer = ProductQuantizer(32, m=8)
+    quantizer.train(vectors, iterations=5)
+    codes = quantizer.encode(vectors)
+
+    scores = quantizer.scores(quantizer.lookup_tables(queries), codes)
+
+    np.testing.assert_allclose(scores, queries @ quantizer.decode(codes).T, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("options", [{"train_size": 100}, {"rerank": -1}])
+def test_pq_rejects_invalid_options(options):
+    with pytest.raises(ValueError):
+        PQIndex(32, m=8, **options)
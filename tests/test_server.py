@@ -0,0 +1,260 @@
+import asyncio
+import base64
+import io
+import json
+from contextlib import asynccontextmanager
+
+import httpx
+import numpy as np
+import pytest
+from PIL import Image
+
+import src.clip_server as server
+
+pytestmark = pytest.mark.anyio
+
+SYNTHETIC_CONFIG = {
+    "backend": "synthetic",
+    "backend_options": {"dim": 32},
+    "cache_max_entries": 0,
+    "disk_cache_dir": None,
+    "text_set_dir": None,
+}
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@asynccontextmanager
+async def serve(**config):
+    """Run the app on the synthetic backend, with `config` overriding the server config."""
+    saved = dict(server.server_config)
+    server.server_config.update(SYNTHETIC_CONFIG, **config)
+    await server.startup_event()
+    try:
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            yield client
+    finally:
+        await server.shutdown_event()
+        server.server_config.clear()
+        server.server_config.update(saved)
+
+
+def image_bytes(color: tuple[int, int, int]) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def b64(blob: bytes) -> str:
+    return base64.b64encode(blob).decode()
+
+
+IMAGES = [image_bytes(color) for color in ((255, 0, 0), (0, 255, 0), (0, 0, 255))]
+
+
+async def test_synthetic_backend_embeds_equal_texts_equally():
+    async with serve() as client:
+        single = (await client.post("/embed_text", json={"text": "a photo of a cat"})).json()["embedding"]
+        batch = (await client.post("/embed_texts_batch", json={"texts": ["a dog", "a photo of a cat"]})).json()
+
+    assert len(single) == 32
+    np.testing.assert_allclose(batch["embeddings"][1], single, atol=1e-6)
+    assert not np.allclose(batch["embeddings"][0], single)
+
+
+async def test_binary_responses_decode_to_the_json_embeddings():
+    texts = ["a cat", "a dog", "a bird"]
+    async with serve() as client:
+        as_json = (await client.post("/embed_texts_batch", json={"texts": texts})).json()["embeddings"]
+        as_float32 = await client.post(
+            "/embed_texts_batch", json={"texts": texts}, headers={"Accept": server.BINARY_MEDIA_TYPE}
+        )
+        as_float16 = await client.post(
+            "/embed_texts_batch",
+            json={"texts": texts},
+            headers={"Accept": f"{server.BINARY_MEDIA_TYPE}; dtype=float16"},
+        )
+
+    assert as_float32.headers["content-type"] == server.BINARY_MEDIA_TYPE
+    float32 = server.decode_embeddings_binary(as_float32.content)
+    float16 = server.decode_embeddings_binary(as_float16.content)
+    assert (float32.dtype, float16.dtype) == (np.float32, np.float16)
+    np.testing.assert_allclose(float32, as_json, atol=1e-6)
+    np.testing.assert_allclose(float16, as_json, atol=1e-3)
+
+
+async def test_raw_and_multipart_uploads_match_base64_json():
+    async with serve() as client:
+        as_json = (await client.post("/embed_images_batch", json={"images": [b64(blob) for blob in IMAGES]})).json()
+        raw = await client.post("/embed_image", content=IMAGES[0], headers={"Content-Type": "image/png"})
+        multipart = await client.post(
+            "/embed_images_batch", files=[("images", (f"{i}.png", blob, "image/png")) for i, blob in enumerate(IMAGES)]
+        )
+        empty = await client.post("/embed_images_batch", files={"note": (None, "no files here")})
+
+    np.testing.assert_allclose(raw.json()["embedding"], as_json["embeddings"][0], atol=1e-6)
+    np.testing.assert_allclose(multipart.json()["embeddings"], as_json["embeddings"], atol=1e-6)
+    assert empty.status_code == 400
+
+
+async def test_streamed_bulk_responses_match_the_plain_response():
+    texts = [f"text number {i}" for i in range(10)]
+    async with serve(max_batch_size=4) as client:
+        plain = (await client.post("/embed_texts_batch", json={"texts": texts})).json()["embeddings"]
+        ndjson = await client.post("/embed_texts_batch?stream=true", json={"texts": texts})
+        frames = await client.post(
+            "/embed_texts_batch?stream=true", json={"texts": texts}, headers={"Accept": server.BINARY_MEDIA_TYPE}
+        )
+
+    assert ndjson.headers["content-type"].startswith(server.NDJSON_MEDIA_TYPE)
+    lines = [json.loads(line) for line in ndjson.text.splitlines()]
+    assert [line["offset"] for line in lines] == [0, 4, 8]
+    np.testing.assert_allclose([row for line in lines for row in line["embeddings"]], plain, atol=1e-6)
+    chunks = list(server.decode_embedding_frames(frames.content))
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    np.testing.assert_allclose(np.concatenate(chunks), plain, atol=1e-6)
+
+
+async def test_full_queue_is_shed_with_retry_after():
+    async with serve(max_queue_depth=2) as client:
+        shed = await client.post("/embed_texts_batch", json={"texts": ["a", "b", "c"]})
+        admitted = await client.post("/embed_texts_batch", json={"texts": ["a", "b"]})
+        rejected = server.clip_server.metrics.rejected.value(reason="queue_full")
+
+    assert shed.status_code == 503
+    assert int(shed.headers["Retry-After"]) >= 1
+    assert admitted.status_code == 200
+    assert rejected == 3
+
+
+async def test_request_deadline_header():
+    async with serve() as client:
+        expired = await client.post("/embed_text", json={"text": "a cat"}, headers={server.DEADLINE_HEADER: "0"})
+        relaxed = await client.post("/embed_text", json={"text": "a cat"}, headers={server.DEADLINE_HEADER: "5000"})
+        malformed = [
+            await client.post("/embed_text", json={"text": "a cat"}, headers={server.DEADLINE_HEADER: value})
+            for value in ("soon", "nan", "-1")
+        ]
+        errors = server.clip_server.metrics.errors.value(source="endpoint")
+
+    assert expired.status_code == 504
+    assert relaxed.status_code == 200
+    assert [response.status_code for response in malformed] == [400, 400, 400]
+    assert errors == 0
+
+
+async def test_cancelled_requests_are_skipped_by_the_batch_collector():
+    # One batch in flight at a time, so the second request waits in the queue while the first runs
+    async with serve(pipeline_depth=1, backend_options={"dim": 32, "latency_ms": 200}):
+        instance = server.clip_server
+        running = asyncio.create_task(instance.embed_texts_async(["first"]))
+        await asyncio.sleep(0.05)
+        abandoned = asyncio.create_task(instance.embed_texts_async(["second", "third"]))
+        await asyncio.sleep(0.05)
+        abandoned.cancel()
+        await running
+        # Queued behind the abandoned request, so it has been dropped once this one is answered
+        await instance.embed_texts_async(["fourth"])
+
+        assert instance.metrics.rejected.value(reason="cancelled") == 2
+        assert instance.metrics.embeddings.value(type="text", source="model") == 2
+
+
+async def test_corrupt_image_fails_alone():
+    images = [IMAGES[0], b"not an image", IMAGES[1]]
+    async with serve() as client:
+        expected = (await client.post("/embed_images_batch", json={"images": [b64(blob) for blob in IMAGES]})).json()
+        response = await client.post("/embed_images_batch", json={"images": [b64(blob) for blob in images]})
+
+    body = response.json()
+    assert response.status_code == 200
+    assert body["embeddings"][1] is None
+    assert [error["index"] for error in body["errors"]] == [1]
+    np.testing.assert_allclose(body["embeddings"][0], expected["embeddings"][0], atol=1e-6)
+    np.testing.assert_allclose(body["embeddings"][2], expected["embeddings"][1], atol=1e-6)
+
+
+async def test_failed_forward_pass_is_bisected_to_the_failing_text(monkeypatch):
+    texts = ["a cat", "poison", "a dog", "a bird"]
+    async with serve() as client:
+        expected = (await client.post("/embed_texts_batch", json={"texts": texts})).json()["embeddings"]
+        backend = server.clip_server.backend
+        embed_tokens = backend.embed_tokens
+
+        def failing_embed_tokens(tokens):
+            if "poison" in tokens.texts:
+                raise RuntimeError("forward pass failed")
+            return embed_tokens(tokens)
+
+        monkeypatch.setattr(backend, "embed_tokens", failing_embed_tokens)
+        body = (await client.post("/embed_texts_batch", json={"texts": texts})).json()
+        failures = server.clip_server.metrics.item_failures.value(type="text", stage="forward")
+
+    assert body["embeddings"][1] is None
+    assert body["errors"] == [{"index": 1, "error": "forward pass failed"}]
+    for row in (0, 2, 3):
+        np.testing.assert_allclose(body["embeddings"][row], expected[row], atol=1e-6)
+    assert failures == 1
+
+
+async def test_bucketed_texts_come_back_in_request_order():
+    # 3, 42, 5 and 22 tokens for the synthetic counter (words + 2): three buckets with the default 16,32
+    texts = ["one", " ".join(["long"] * 40), "a short one", " ".join(["middle"] * 20)]
+    async with serve() as client:
+        bulk = (await client.post("/embed_texts_batch", json={"texts": texts})).json()["embeddings"]
+        metrics = server.clip_server.metrics.text_tokens
+        tokens = metrics.value(kind="real"), metrics.value(kind="padded")
+        singles = [(await client.post("/embed_text", json={"text": text})).json()["embedding"] for text in texts]
+
+    np.testing.assert_allclose(bulk, singles, atol=1e-6)
+    assert tokens == (3 + 42 + 5 + 22, 5 * 2 + 42 + 22)
+
+
+async def test_classify_ranks_labels_by_probability():
+    labels = ["red", "green", "blue"]
+    async with serve() as client:
+        response = await client.post(
+            "/classify", json={"images": [b64(blob) for blob in IMAGES[:2]], "labels": labels, "k": 3}
+        )
+        raw = await client.post(
+            "/classify?labels=red&labels=green&k=1", content=IMAGES[0], headers={"Content-Type": "image/png"}
+        )
+        invalid = await client.post("/classify", json={"images": [b64(IMAGES[0])], "labels": labels, "k": 0})
+
+    results = response.json()["results"]
+    assert len(results) == 2
+    for hits in results:
+        scores = [hit["score"] for hit in hits]
+        assert sorted(hit["label"] for hit in hits) == sorted(labels)
+        assert scores == sorted(scores, reverse=True)
+        assert sum(scores) == pytest.approx(1.0, abs=1e-5)
+    assert len(raw.json()["results"][0]) == 1
+    assert raw.json()["results"][0][0]["label"] in ("red", "green")
+    assert invalid.status_code == 400
+
+
+async def test_persisted_text_set_survives_a_restart(tmp_path):
+    text_set = {"text_set": "colors", "texts": ["red", "blue"], "templates": ["a photo of {label}"], "persist": True}
+    query = {"images": [b64(IMAGES[0])], "text_set": "colors", "k": 2}
+    async with serve(text_set_dir=str(tmp_path)) as client:
+        registered = (await client.post("/text_sets", json=text_set)).json()
+        before = (await client.post("/classify", json=query)).json()
+
+    assert registered == {"text_set": "colors", "entries": 2, "templates": 1, "persisted": True}
+    assert (tmp_path / "colors.npz").exists()
+
+    async with serve(text_set_dir=str(tmp_path)) as client:
+        listed = (await client.get("/text_sets")).json()
+        after = (await client.post("/classify", json=query)).json()
+        dropped = await client.post("/text_sets/drop", json={"text_set": "colors"})
+        missing = await client.post("/classify", json=query)
+
+    assert listed == {"colors": {"entries": ["red", "blue"], "templates": ["a photo of {label}"], "persisted": True}}
+    assert after == before
+    assert dropped.status_code == 200
+    assert not (tmp_path / "colors.npz").exists()
+    assert missing.status_code == 404